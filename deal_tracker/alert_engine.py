@@ -0,0 +1,219 @@
+# deal_tracker/alert_engine.py
+"""
+Движок ценовых алертов SL/TP.
+Активные уровни хранятся в отсортированных списках по каждой паре (символ, биржа),
+поэтому на каждый тик цены через bisect проверяются только ближайшие уровни,
+а не все сделки. Сработавшие уровни удаляются и запоминаются (с сохранением на диск),
+чтобы один и тот же алерт не отправлялся повторно.
+По умолчанию алерты ставятся в очередь notifier.NotificationOutbox: всплеск
+срабатываний не блокирует цикл цен и отправляется сводками с учетом лимитов
+Telegram. Уровень считается сработавшим только после доставки алерта; уровень,
+не принятый переполненной очередью или не доставленный, возвращается в книгу.
+"""
+import bisect
+import functools
+import json
+import logging
+import os
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import notifier
+from notifier import DeliveryCallback
+from models import TradeData, PositionData
+
+logger = logging.getLogger(__name__)
+
+AlertKey = Tuple[str, str]  # (SYMBOL, exchange)
+# Ставит алерт в очередь (True - принят) и позже сообщает результат доставки в callback
+SendAlert = Callable[[str, DeliveryCallback], Awaitable[bool]]
+
+# Уровни, срабатывающие при росте цены (TP) и при падении (SL) для длинных позиций
+TAKE_PROFIT_FIELDS = ('tp1', 'tp2', 'tp3')
+STOP_LOSS_FIELDS = ('sl',)
+
+
+@dataclass
+class AlertLevel:
+    """Один ценовой уровень одной сделки."""
+    symbol: str
+    exchange: str
+    trade_id: str
+    level_name: str
+    price: Decimal
+    risk_usd: Optional[Decimal] = None
+
+    @property
+    def fired_key(self) -> str:
+        return f"{self.trade_id}:{self.level_name}"
+
+
+class _SortedLevels:
+    """Уровни одной пары, отсортированные по цене (параллельные списки для bisect)."""
+
+    def __init__(self):
+        self.prices: List[Decimal] = []
+        self.levels: List[AlertLevel] = []
+
+    def add(self, level: AlertLevel) -> None:
+        idx = bisect.bisect_right(self.prices, level.price)
+        self.prices.insert(idx, level.price)
+        self.levels.insert(idx, level)
+
+    def pop_at_or_below(self, price: Decimal) -> List[AlertLevel]:
+        """Снимает уровни <= price (пройденные TP при росте цены)."""
+        idx = bisect.bisect_right(self.prices, price)
+        fired = self.levels[:idx]
+        del self.prices[:idx], self.levels[:idx]
+        return fired
+
+    def pop_at_or_above(self, price: Decimal) -> List[AlertLevel]:
+        """Снимает уровни >= price (пробитые SL при падении цены)."""
+        idx = bisect.bisect_left(self.prices, price)
+        fired = self.levels[idx:]
+        del self.prices[idx:], self.levels[idx:]
+        return fired
+
+    def __len__(self) -> int:
+        return len(self.levels)
+
+
+class PriceAlertEngine:
+    """Проверяет тики цен против уровней SL/TP и отправляет алерты через notifier."""
+
+    def __init__(
+        self,
+        send_alert: Optional[SendAlert] = None,
+        fired_store_path: Optional[str] = None,
+    ):
+        self._send_alert = send_alert or notifier.get_outbox().send
+        self._fired_store_path = fired_store_path
+        self._take_profits: Dict[AlertKey, _SortedLevels] = {}
+        self._stop_losses: Dict[AlertKey, _SortedLevels] = {}
+        self._fired: Set[str] = self._load_fired()
+        # Уровни, алерты которых приняты в очередь, но еще не доставлены
+        self._pending: Dict[str, AlertLevel] = {}
+
+    # --- Хранилище сработавших алертов ---
+
+    def _load_fired(self) -> Set[str]:
+        if not self._fired_store_path:
+            return set()
+        try:
+            with open(self._fired_store_path, 'r', encoding='utf-8') as f:
+                return set(json.load(f))
+        except FileNotFoundError:
+            return set()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать список сработавших алертов: {e}")
+            return set()
+
+    def _save_fired(self) -> None:
+        if not self._fired_store_path:
+            return
+        tmp_path = f"{self._fired_store_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self._fired_store_path) or '.', exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(sorted(self._fired), f)
+            os.replace(tmp_path, self._fired_store_path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить список сработавших алертов: {e}")
+
+    # --- Загрузка уровней ---
+
+    def load_levels(self, trades: Iterable[TradeData], positions: Iterable[PositionData]) -> int:
+        """
+        Перестраивает активные уровни: берутся BUY-сделки с заданными SL/TP,
+        по которым еще есть открытая позиция. Уже сработавшие уровни пропускаются.
+        """
+        open_keys = {(p.symbol.upper(), p.exchange.lower())
+                     for p in positions if p.symbol and p.exchange}
+        self._take_profits.clear()
+        self._stop_losses.clear()
+        count = 0
+        for trade in trades:
+            if trade.trade_type != 'BUY' or not trade.symbol or not trade.exchange:
+                continue
+            key = (trade.symbol.upper(), trade.exchange.lower())
+            if key not in open_keys:
+                continue
+            for fields, book in ((TAKE_PROFIT_FIELDS, self._take_profits), (STOP_LOSS_FIELDS, self._stop_losses)):
+                for field_name in fields:
+                    level_price = getattr(trade, field_name, None)
+                    if not level_price or level_price <= 0:
+                        continue
+                    level = AlertLevel(symbol=key[0], exchange=key[1], trade_id=trade.trade_id,
+                                       level_name=field_name.upper(), price=level_price,
+                                       risk_usd=trade.risk_usd)
+                    if level.fired_key in self._fired or level.fired_key in self._pending:
+                        continue
+                    book.setdefault(key, _SortedLevels()).add(level)
+                    count += 1
+        logger.info(f"Загружено {count} активных уровней SL/TP для {len(open_keys)} позиций.")
+        return count
+
+    # --- Проверка цен ---
+
+    def check_price(self, symbol: str, exchange: str, price: Decimal) -> List[AlertLevel]:
+        """Возвращает уровни, пройденные ценой, и снимает их с отслеживания."""
+        key = (symbol.upper(), exchange.lower())
+        fired: List[AlertLevel] = []
+        if key in self._take_profits:
+            fired.extend(self._take_profits[key].pop_at_or_below(price))
+        if key in self._stop_losses:
+            fired.extend(self._stop_losses[key].pop_at_or_above(price))
+        return [level for level in fired if level.fired_key not in self._fired]
+
+    @staticmethod
+    def format_alert(level: AlertLevel, price: Decimal) -> str:
+        if level.level_name in ('SL',):
+            header = f"🛑 {level.level_name} {level.symbol} ({level.exchange}): цена {price} ≤ {level.price}"
+        else:
+            header = f"🎯 {level.level_name} {level.symbol} ({level.exchange}): цена {price} ≥ {level.price}"
+        text = f"{header}\nСделка: {level.trade_id}"
+        if level.risk_usd:
+            text += f"\nРиск: {level.risk_usd} USD"
+        return text
+
+    def _return_level(self, level: AlertLevel) -> None:
+        book = self._stop_losses if level.level_name == 'SL' else self._take_profits
+        book.setdefault((level.symbol, level.exchange), _SortedLevels()).add(level)
+
+    def _on_delivery(self, level: AlertLevel, delivered: bool) -> None:
+        """Результат отправки алерта: доставленный уровень запоминается, недоставленный возвращается в книгу."""
+        self._pending.pop(level.fired_key, None)
+        if delivered:
+            self._fired.add(level.fired_key)
+            self._save_fired()
+        else:
+            logger.warning(f"Алерт {level.fired_key} не доставлен, уровень снова отслеживается.")
+            self._return_level(level)
+
+    async def on_price(self, symbol: str, exchange: str, price: Decimal) -> List[AlertLevel]:
+        """
+        Проверяет тик и ставит алерты в очередь. Возвращает принятые очередью уровни;
+        сработавшими они считаются после доставки, непринятые возвращаются в книгу.
+        """
+        fired = self.check_price(symbol, exchange, price)
+        queued = []
+        for level in fired:
+            self._pending[level.fired_key] = level
+            on_result = functools.partial(self._on_delivery, level)
+            if await self._send_alert(self.format_alert(level, price), on_result):
+                queued.append(level)
+            else:
+                self._pending.pop(level.fired_key, None)
+                self._return_level(level)
+        return queued
+
+    async def consume_prices(self, price_source: AsyncIterable[Tuple[str, str, Decimal]]) -> int:
+        """Прогоняет поток тиков (символ, биржа, цена) через движок. Возвращает число алертов."""
+        total = 0
+        async for symbol, exchange, price in price_source:
+            total += len(await self.on_price(symbol, exchange, price))
+        return total
+
+    def active_levels_count(self) -> int:
+        return sum(len(v) for v in self._take_profits.values()) + sum(len(v) for v in self._stop_losses.values())
@@ -1,8 +1,8 @@
 # deal_tracker/analytics_service.py
 import logging
 from decimal import Decimal
-from datetime import datetime
-from typing import List, Tuple
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, List, Optional, Tuple
 
 import sheets_service
 import config
@@ -10,6 +10,27 @@ from models import TradeData, FifoLogData, PositionData, MovementData, Analytics
 
 logger = logging.getLogger(__name__)
 
+# progress(этап, процент): сообщает ход пересчета фоновой задаче бота (bot_jobs).
+# Может поднять исключение для отмены. Этапы 5-40% идут до записи в таблицу, а 60-90% -
+# после записи FIFO: отмена на них оставляет FIFO записанным без строки аналитики.
+ProgressCallback = Callable[[str, int], None]
+
+
+def _report(progress: Optional[ProgressCallback], stage: str, percent: int,
+            completed: Optional[str] = None) -> None:
+    """
+    completed - что уже записано в таблицу к этому этапу. Если progress отменяет
+    задачу, это сохраняется в исключении (partial_result) как частичный результат.
+    """
+    if not progress:
+        return
+    try:
+        progress(stage, percent)
+    except Exception as e:
+        if completed:
+            e.partial_result = completed
+        raise
+
 
 def _calculate_pnl_metrics(fifo_logs: List[FifoLogData], open_positions: List[PositionData]) -> Tuple[Decimal, Decimal, Decimal]:
     """Рассчитывает PNL, работая с типизированными моделями."""
@@ -55,9 +76,10 @@ def _calculate_trade_stats(fifo_logs: List[FifoLogData]) -> dict:
     }
 
 
-def process_fifo_transactions() -> Tuple[bool, str]:
+def process_fifo_transactions(progress: Optional[ProgressCallback] = None) -> Tuple[bool, str]:
     """Обрабатывает транзакции по FIFO, работая с моделями TradeData."""
     logger.info("Запуск FIFO обработки...")
+    _report(progress, "Чтение сделок", 5)
     all_trades = sheets_service.get_all_core_trades()
     if not all_trades:
         return True, "Нет сделок для FIFO обработки."
@@ -72,6 +94,7 @@ def process_fifo_transactions() -> Tuple[bool, str]:
     if not sells_to_process:
         return True, "Нет новых продаж для FIFO обработки."
 
+    _report(progress, f"FIFO: сопоставление {len(sells_to_process)} продаж", 20)
     fifo_log_entries = []
     trade_updates = []
 
@@ -123,6 +146,7 @@ def process_fifo_transactions() -> Tuple[bool, str]:
             trade_updates.append(
                 {'row_number': trade_to_update.row_number, 'fifo_consumed_qty': consumed_qty})
 
+    _report(progress, f"FIFO: запись {len(fifo_log_entries)} логов", 40)
     # Пакетно записываем все изменения
     logs_ok = sheets_service.batch_append_fifo_logs(fifo_log_entries)
     updates_ok = sheets_service.batch_update_trades_fifo_fields(trade_updates)
@@ -135,20 +159,22 @@ def process_fifo_transactions() -> Tuple[bool, str]:
     return True, msg
 
 
-def calculate_and_update_analytics_sheet() -> Tuple[bool, str]:
+def calculate_and_update_analytics_sheet(progress: Optional[ProgressCallback] = None) -> Tuple[bool, str]:
     """Главная функция, запускающая полный пересчет и обновление листа аналитики."""
     logger.info("Запуск полного обновления аналитики...")
 
-    fifo_success, fifo_message = process_fifo_transactions()
+    fifo_success, fifo_message = process_fifo_transactions(progress)
     if not fifo_success:
         return False, fifo_message
 
+    _report(progress, "Чтение логов FIFO и позиций", 60, fifo_message)
     # Загружаем все данные заново, т.к. FIFO мог их изменить
     fifo_logs = sheets_service.get_all_fifo_logs()
     open_positions = sheets_service.get_all_open_positions()
     # Другие данные (движения, все сделки) можно было бы не перезагружать, но для надежности сделаем
     fund_movements = sheets_service.get_all_fund_movements()
 
+    _report(progress, "Расчет метрик", 80, fifo_message)
     # Расчеты
     realized_pnl, unrealized_pnl, net_pnl = _calculate_pnl_metrics(
         fifo_logs, open_positions)
@@ -180,6 +206,7 @@ def calculate_and_update_analytics_sheet() -> Tuple[bool, str]:
         total_equity=net_invested + net_pnl,
     )
 
+    _report(progress, "Запись аналитики", 90, fifo_message)
     # Запись в таблицу
     if sheets_service.add_analytics_record(analytics_record):
         msg = f"Аналитика успешно обновлена. {fifo_message}"
@@ -187,3 +214,38 @@ def calculate_and_update_analytics_sheet() -> Tuple[bool, str]:
         return True, msg
     else:
         return False, "Не удалось записать итоговую строку аналитики."
+
+
+def _local_date(value: datetime) -> date:
+    if value.tzinfo:
+        return value.astimezone(timezone(timedelta(hours=config.TZ_OFFSET_HOURS))).date()
+    return value.date()
+
+
+def build_daily_digest() -> str:
+    """Текст ежедневной сводки PnL: итоги дня по сделкам и FIFO плюс открытые позиции."""
+    today = datetime.now(timezone(timedelta(hours=config.TZ_OFFSET_HOURS))).date()
+    fifo_logs = sheets_service.get_all_fifo_logs()
+    open_positions = sheets_service.get_all_open_positions()
+    trades_today = [t for t in sheets_service.get_all_core_trades()
+                    if t.timestamp and _local_date(t.timestamp) == today]
+
+    realized, unrealized, net = _calculate_pnl_metrics(fifo_logs, open_positions)
+    realized_today = sum((log.fifo_pnl for log in fifo_logs
+                          if log.fifo_pnl and log.timestamp_closed and _local_date(log.timestamp_closed) == today),
+                         Decimal('0'))
+    top = sorted((p for p in open_positions if p.unrealized_pnl is not None),
+                 key=lambda p: abs(p.unrealized_pnl), reverse=True)[:5]
+
+    lines = [f"📊 Сводка за {today:%Y-%m-%d}",
+             f"Сделок за день: {len(trades_today)} "
+             f"(покупок {sum(1 for t in trades_today if t.trade_type == 'BUY')}, "
+             f"продаж {sum(1 for t in trades_today if t.trade_type == 'SELL')})",
+             f"Реализованный PnL за день: {realized_today:+.2f}",
+             f"Реализованный PnL всего: {realized:+.2f}",
+             f"Нереализованный PnL: {unrealized:+.2f}",
+             f"Итого PnL: {net:+.2f}",
+             f"Открытых позиций: {len(open_positions)}"]
+    for pos in top:
+        lines.append(f"  {pos.symbol} ({pos.exchange}): {pos.unrealized_pnl:+.2f}")
+    return "\n".join(lines)
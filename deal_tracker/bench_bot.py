@@ -0,0 +1,265 @@
+# deal_tracker/bench_bot.py
+"""
+Нагрузочный тест обработчиков команд бота без Telegram: команды вызываются
+напрямую из telegram_handlers с поддельными Update/Context против локальной
+таблицы (local_sheets в памяти, LOCAL_SHEETS_LATENCY_MS на каждый вызов).
+
+Для каждой команды и каждого уровня параллельности печатает p50/p95/p99
+задержки, пропускную способность и, чтобы было видно, куда уходит время,
+число вызовов таблицы на команду, время в них и глубину очереди пула потоков
+bot_executor. Сценарий mix чередует /buy и /portfolio: каждая сделка
+сбрасывает снимок портфеля.
+
+В отличие от webhook_harness.py (полный бот в отдельном процессе, HTTP и
+очередь обновлений PTB) здесь измеряются только обработчики и слой учета.
+
+Запуск:
+    python bench_bot.py --commands buy,portfolio,history,average,mix --concurrency 1,4,16 --requests 200 --latency-ms 20
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import stress_ledger
+
+FIRST_USER_ID = 7000
+EXCHANGE = 'bench'
+SYMBOLS = ['BTC/USDT', 'ETH/USDT', 'SOL/USDT']
+BUSY_PREFIX = '⏳'
+
+
+class _FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = 'Bench'
+
+
+class _FakeMessage:
+    """Сообщение, запоминающее ответы обработчика вместо отправки в Telegram."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.replies: List[str] = []
+
+    async def reply_text(self, text: str, **kwargs: Any) -> None:
+        self.replies.append(text)
+
+    async def reply_photo(self, photo: Any, **kwargs: Any) -> None:
+        self.replies.append('<photo>')
+
+
+class _FakeUpdate:
+    def __init__(self, user_id: int, text: str):
+        self.effective_user = _FakeUser(user_id)
+        self.message = _FakeMessage(text)
+
+
+class _FakeContext:
+    def __init__(self, args: List[str]):
+        self.args = args
+
+
+class _SheetCallStats:
+    """Число и суммарное время вызовов локальной таблицы (из потоков пула)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+
+    def reset(self) -> None:
+        with self.lock:
+            self.calls, self.seconds = 0, 0.0
+
+
+def _instrument_sheets(stats: _SheetCallStats) -> None:
+    import local_sheets
+
+    original = local_sheets.LocalSpreadsheet._data
+
+    @contextmanager
+    def timed_data(self, write: bool = False) -> Iterator[Dict[str, Dict[str, Any]]]:
+        started = time.perf_counter()
+        try:
+            with original(self, write) as data:
+                yield data
+        finally:
+            with stats.lock:
+                stats.calls += 1
+                stats.seconds += time.perf_counter() - started
+
+    local_sheets.LocalSpreadsheet._data = timed_data
+
+
+def _seed_ledger() -> None:
+    import trade_logger
+    started = datetime.now() - timedelta(days=30)
+    trade_logger.log_fund_movement('DEPOSIT', 'USDT', Decimal('10000000'), started, destination_name=EXCHANGE)
+    for i, symbol in enumerate(SYMBOLS):
+        for j in range(20):
+            trade_logger.log_trade('BUY', EXCHANGE, symbol, Decimal('1'), Decimal(100 + j),
+                                   started + timedelta(hours=24 * i + j))
+
+
+def _command(name: str) -> Tuple[Callable, Callable[[int], List[str]]]:
+    """Обработчик и генератор аргументов для i-го запроса."""
+    import telegram_handlers as h
+
+    if name == 'buy':
+        # Уникальный id: иначе повтор был бы отклонен как дубликат
+        return h.buy_command, lambda i: [SYMBOLS[i % len(SYMBOLS)], '0.001', str(100 + i % 50),
+                                         f'exch:{EXCHANGE}', f'id:bench-{time.time_ns()}-{i}']
+    if name == 'portfolio':
+        return h.portfolio_command, lambda i: []
+    if name == 'history':
+        return h.history_command, lambda i: [SYMBOLS[i % len(SYMBOLS)]]
+    if name == 'average':
+        return h.average_command, lambda i: [SYMBOLS[i % len(SYMBOLS)]]
+    if name == 'mix':
+        buy, buy_args = _command('buy')
+        portfolio, _ = _command('portfolio')
+
+        async def mixed(update, context):
+            handler = buy if update.message.text.startswith('/buy') else portfolio
+            await handler(update, context)
+        return mixed, lambda i: buy_args(i) if i % 2 == 0 else []
+    raise ValueError(f"Неизвестная команда '{name}'")
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def _run_level(name: str, concurrency: int, requests: int,
+                     sheet_stats: _SheetCallStats) -> Dict[str, Any]:
+    from bot_executor import executor
+
+    handler, make_args = _command(name)
+    latencies: List[float] = []
+    failures: List[str] = []
+    busy = 0
+    counter = iter(range(requests))
+    io_stats = executor._stats['io']
+    io_stats.max_queue_depth = 0
+    sheet_stats.reset()
+
+    async def worker(slot: int) -> None:
+        nonlocal busy
+        # Свой пользователь на каждый слот: лимит на пользователя не срабатывает
+        user_id = FIRST_USER_ID + slot
+        for i in counter:
+            args = make_args(i)
+            command = 'buy' if name == 'buy' or (name == 'mix' and i % 2 == 0) else name
+            update = _FakeUpdate(user_id, ' '.join([f'/{command}'] + args))
+            started = time.perf_counter()
+            try:
+                await handler(update, _FakeContext(args))
+            except Exception as e:
+                failures.append(f"{name} #{i}: {e}")
+                continue
+            latencies.append(time.perf_counter() - started)
+            reply = update.message.replies[-1] if update.message.replies else ''
+            if reply.startswith(BUSY_PREFIX):
+                busy += 1
+            elif reply.startswith('❌') or reply.startswith('Ошибка'):
+                failures.append(f"{name} #{i}: {reply[:120]}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(slot) for slot in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    done = len(latencies)
+    return {
+        'command': name, 'concurrency': concurrency, 'done': done, 'elapsed': elapsed,
+        'p50': _percentile(latencies, 50), 'p95': _percentile(latencies, 95),
+        'p99': _percentile(latencies, 99), 'throughput': done / elapsed if elapsed else 0.0,
+        'sheet_calls': sheet_stats.calls / max(1, done), 'sheet_ms': sheet_stats.seconds / max(1, done) * 1000,
+        'max_queued': io_stats.max_queue_depth, 'busy': busy, 'failures': failures,
+    }
+
+
+def _print_header() -> None:
+    print(f"{'команда':<10}{'парал.':>7}{'готово':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}"
+          f"{'ком/с':>9}{'вызовов':>9}{'табл. мс':>10}{'очередь':>9}")
+
+
+def _print_row(r: Dict[str, Any]) -> None:
+    print(f"{r['command']:<10}{r['concurrency']:>7}{r['done']:>8}{r['p50'] * 1000:>9.1f}"
+          f"{r['p95'] * 1000:>9.1f}{r['p99'] * 1000:>9.1f}{r['throughput']:>9.1f}"
+          f"{r['sheet_calls']:>9.1f}{r['sheet_ms']:>10.1f}{r['max_queued']:>9}")
+
+
+async def _run_all(commands: List[str], levels: List[int], requests: int,
+                   sheet_stats: _SheetCallStats) -> List[Dict[str, Any]]:
+    results = []
+    _print_header()
+    for name in commands:
+        for concurrency in levels:
+            result = await _run_level(name, concurrency, requests, sheet_stats)
+            _print_row(result)
+            results.append(result)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков команд бота.")
+    parser.add_argument('--commands', default='buy,portfolio,history,average,mix',
+                        help="Через запятую: buy, portfolio, history, average, mix")
+    parser.add_argument('--concurrency', default='1,4,16', help="Уровни параллельности через запятую")
+    parser.add_argument('--requests', type=int, default=200, help="Команд на каждый уровень")
+    parser.add_argument('--latency-ms', type=int, default=20, help="Задержка вызова локальной таблицы")
+    parser.add_argument('--file-backend', action='store_true',
+                        help="Хранить таблицу в JSON-файле (как в многопроцессном режиме), а не в памяти")
+    parser.add_argument('--keep', action='store_true', help="Не удалять рабочий каталог")
+    args = parser.parse_args()
+    commands = [c.strip() for c in args.commands.split(',') if c.strip()]
+    levels = [int(c) for c in args.concurrency.split(',') if c.strip()]
+
+    work_dir = tempfile.mkdtemp(prefix='deal_tracker_bench_')
+    stress_ledger._configure_env(work_dir, args.latency_ms)
+    if not args.file_backend:
+        os.environ['LOCAL_SHEETS_PATH'] = ''
+    os.environ['TELEGRAM_ADMIN_IDS_STR'] = ','.join(str(FIRST_USER_ID + s) for s in range(max(levels)))
+    os.environ.setdefault('LOGS_DIR', os.path.join(work_dir, 'logs'))
+
+    import sheets_service
+    from bot_executor import executor
+
+    sheet_stats = _SheetCallStats()
+    _instrument_sheets(sheet_stats)
+    sheets_service._get_spreadsheet().seed(stress_ledger.SHEET_HEADERS)
+    _seed_ledger()
+    print(f"Таблица: {'JSON-файл' if args.file_backend else 'память'}, задержка {args.latency_ms} мс, "
+          f"потоков ввода-вывода {executor.io_workers}, команд на уровень {args.requests}")
+
+    try:
+        results = asyncio.run(_run_all(commands, levels, args.requests, sheet_stats))
+    finally:
+        executor.shutdown()
+    failures = [f for r in results for f in r['failures']]
+    busy = sum(r['busy'] for r in results)
+    for failure in failures[:10]:
+        print(f"  ✗ {failure}")
+    if busy:
+        print(f"Отклонено лимитом на пользователя: {busy}")
+    print("Результат: OK" if not failures else f"Результат: ОШИБКИ ({len(failures)})")
+    if args.keep:
+        print(f"Рабочий каталог: {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0 if not failures else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
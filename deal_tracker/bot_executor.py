@@ -0,0 +1,167 @@
+# deal_tracker/bot_executor.py
+"""
+Выполнение блокирующей работы бота вне цикла событий PTB.
+
+- run_io: вызовы gspread и логирование операций - в ограниченном пуле потоков.
+- run_cpu: FIFO и пересчет аналитики - в пуле процессов (не держат GIL бота).
+- per_user_limit: не больше BOT_PER_USER_CONCURRENCY команд пользователя
+  одновременно и не больше BOT_PER_USER_MAX_PENDING в очереди; лишние
+  команды сразу получают ответ "занято".
+
+Глубина очереди (задачи, ожидающие свободного потока/процесса) доступна
+в stats() и командой /bot_status; при превышении BOT_QUEUE_WARN_DEPTH пишется
+предупреждение в лог.
+"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class _PoolStats:
+    """Счетчики пула. Меняются только из цикла событий, поэтому без блокировок."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'workers': self.workers, 'running': min(self.in_flight, self.workers),
+                'queued': self.queue_depth, 'max_queued': self.max_queue_depth,
+                'completed': self.completed, 'failed': self.failed}
+
+
+class BotExecutor:
+    """Пулы потоков и процессов для обработчиков команд."""
+
+    def __init__(self, io_workers: Optional[int] = None, cpu_workers: Optional[int] = None):
+        self.io_workers = io_workers or config.BOT_IO_WORKERS
+        self.cpu_workers = cpu_workers or config.BOT_CPU_WORKERS
+        self._io_pool: Optional[ThreadPoolExecutor] = None
+        self._cpu_pool: Optional[ProcessPoolExecutor] = None
+        self._stats = {'io': _PoolStats(self.io_workers), 'cpu': _PoolStats(self.cpu_workers)}
+        self._user_active: Dict[int, int] = defaultdict(int)
+        self._user_semaphores: Dict[int, asyncio.Semaphore] = {}
+        self.rejected = 0
+
+    def _pool(self, kind: str) -> Executor:
+        if kind == 'io':
+            if self._io_pool is None:
+                self._io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='bot-io')
+            return self._io_pool
+        if self._cpu_pool is None:
+            # spawn: дочерний процесс не наследует потоки и блокировки бота
+            self._cpu_pool = ProcessPoolExecutor(
+                max_workers=self.cpu_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._cpu_pool
+
+    async def _run(self, kind: str, call: Callable[[], Any]) -> Any:
+        stats = self._stats[kind]
+        stats.in_flight += 1
+        stats.max_queue_depth = max(stats.max_queue_depth, stats.queue_depth)
+        if stats.queue_depth >= config.BOT_QUEUE_WARN_DEPTH:
+            logger.warning(f"Очередь пула {kind}: {stats.queue_depth} задач ждут исполнителя.")
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._pool(kind), call)
+            stats.completed += 1
+            return result
+        except Exception:
+            stats.failed += 1
+            raise
+        finally:
+            stats.in_flight -= 1
+
+    async def run_io(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Выполняет блокирующий ввод-вывод (gspread, логирование) в пуле потоков."""
+        return await self._run('io', functools.partial(func, *args, **kwargs))
+
+    async def run_cpu(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Выполняет тяжелый расчет в пуле процессов. func и аргументы должны сериализоваться."""
+        return await self._run('cpu', functools.partial(func, *args))
+
+    # --- Ограничение на пользователя ---
+
+    def try_enter_user(self, user_id: int) -> bool:
+        """Регистрирует команду пользователя; False, если у него уже слишком много команд."""
+        if self._user_active[user_id] >= config.BOT_PER_USER_MAX_PENDING:
+            self.rejected += 1
+            return False
+        self._user_active[user_id] += 1
+        return True
+
+    def leave_user(self, user_id: int) -> None:
+        self._user_active[user_id] -= 1
+        if self._user_active[user_id] <= 0:
+            del self._user_active[user_id]
+            self._user_semaphores.pop(user_id, None)
+
+    def user_semaphore(self, user_id: int) -> asyncio.Semaphore:
+        if user_id not in self._user_semaphores:
+            self._user_semaphores[user_id] = asyncio.Semaphore(config.BOT_PER_USER_CONCURRENCY)
+        return self._user_semaphores[user_id]
+
+    # --- Метрики и завершение ---
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'io': self._stats['io'].as_dict(),
+            'cpu': self._stats['cpu'].as_dict(),
+            'active_users': len(self._user_active),
+            'user_commands': sum(self._user_active.values()),
+            'rejected': self.rejected,
+        }
+
+    def shutdown(self) -> None:
+        for pool in (self._io_pool, self._cpu_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._io_pool = self._cpu_pool = None
+
+
+executor = BotExecutor()
+
+
+def per_user_limit(func):
+    """Декоратор обработчика: ограничивает число одновременных команд одного пользователя."""
+    @functools.wraps(func)
+    async def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
+        user_id = update.effective_user.id if update.effective_user else 0
+        if not executor.try_enter_user(user_id):
+            await update.message.reply_text("⏳ Предыдущие команды еще выполняются, повторите позже.")
+            return
+        try:
+            async with executor.user_semaphore(user_id):
+                return await func(update, context, *args, **kwargs)
+        finally:
+            executor.leave_user(user_id)
+    return wrapped
+
+
+def format_stats() -> str:
+    """Состояние пулов для /bot_status (HTML)."""
+    stats = executor.stats()
+    lines = ["<u><b>🤖 Состояние бота</b></u>"]
+    for kind, title in (('io', 'Потоки (таблица)'), ('cpu', 'Процессы (аналитика)')):
+        s = stats[kind]
+        lines.append(f"<b>{title}:</b> выполняется {s['running']}/{s['workers']}, в очереди {s['queued']} "
+                     f"(макс. {s['max_queued']}), выполнено {s['completed']}, ошибок {s['failed']}")
+    lines.append(f"Команд в работе: {stats['user_commands']} от {stats['active_users']} польз., "
+                 f"отклонено по лимиту: {stats['rejected']}")
+    return "\n".join(lines)
@@ -0,0 +1,240 @@
+# deal_tracker/bot_jobs.py
+"""
+Фоновые задачи бота для тяжелых команд (/update_analytics).
+
+Команда ставит задачу и сразу отвечает сообщением с ее номером; это сообщение
+раз в JOB_PROGRESS_INTERVAL_SECONDS редактируется, показывая этап и процент.
+Одинаковые задачи (с одним ключом) объединяются: пока задача выполняется,
+повторные запросы подписываются на нее, а не запускают второй пересчет.
+/cancel_job ID отменяет задачу на ближайшей контрольной точке.
+
+Задача выполняется в пуле процессов bot_executor; этап и флаг отмены
+передаются через общий словарь multiprocessing.Manager.
+"""
+import asyncio
+import html
+import itertools
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+
+import config
+from bot_executor import executor
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'QUEUED'
+STATUS_RUNNING = 'RUNNING'
+STATUS_DONE = 'DONE'
+STATUS_FAILED = 'FAILED'
+STATUS_CANCELLED = 'CANCELLED'
+FINAL_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+_STATUS_ICONS = {STATUS_QUEUED: '🕓', STATUS_RUNNING: '⚙️', STATUS_DONE: '✅',
+                 STATUS_FAILED: '❌', STATUS_CANCELLED: '🚫'}
+
+
+class JobCancelled(Exception):
+    """
+    Поднимается внутри задачи на контрольной точке после /cancel_job. Если задача
+    успела что-то записать, она сохраняет это в атрибуте partial_result.
+    """
+
+
+class JobProgress:
+    """Колбэк progress(этап, процент) для функции задачи; передается в дочерний процесс."""
+
+    def __init__(self, state: Any):
+        self._state = state
+
+    def __call__(self, stage: str, percent: int) -> None:
+        if self._state.get('cancel'):
+            raise JobCancelled()
+        self._state.update(stage=stage, percent=percent)
+
+
+def _run_job(func: Callable[..., Tuple[bool, str]], progress: JobProgress) -> Tuple[bool, str]:
+    return func(progress=progress)
+
+
+@dataclass
+class Job:
+    job_id: int
+    key: str
+    title: str
+    status: str = STATUS_QUEUED
+    stage: str = 'В очереди'
+    percent: int = 0
+    result: str = ''
+    cancel_requested: bool = False
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+    # (chat_id, message_id) сообщений, которые показывают прогресс
+    subscribers: List[Tuple[int, int]] = field(default_factory=list)
+    state: Any = None
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    def text(self) -> str:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        lines = [f"{_STATUS_ICONS[self.status]} <b>Задача #{self.job_id}</b>: {html.escape(self.title)}"]
+        if self.status in FINAL_STATUSES:
+            lines.append(f"Завершена за {elapsed:.0f} с.")
+            if self.result:
+                lines.append(html.escape(self.result))
+        else:
+            lines.append(f"{html.escape(self.stage)} - {self.percent}% ({elapsed:.0f} с.)")
+            lines.append(f"Отмена: <code>/cancel_job {self.job_id}</code>")
+        return "\n".join(lines)
+
+
+class JobManager:
+    """Реестр фоновых задач: запуск, объединение по ключу, прогресс и отмена."""
+
+    def __init__(self, history_limit: Optional[int] = None, progress_interval: Optional[float] = None):
+        self.history_limit = history_limit or config.JOB_HISTORY_LIMIT
+        self.progress_interval = progress_interval or config.JOB_PROGRESS_INTERVAL_SECONDS
+        self._jobs: "OrderedDict[int, Job]" = OrderedDict()
+        self._active: Dict[str, Job] = {}
+        self._ids = itertools.count(1)
+        self._manager = None
+        self._tasks: set = set()
+
+    def _shared_state(self) -> Any:
+        if self._manager is None:
+            self._manager = multiprocessing.get_context('spawn').Manager()
+        return self._manager.dict(cancel=False, stage='Запуск', percent=0)
+
+    def _remember(self, job: Job) -> None:
+        self._jobs[job.job_id] = job
+        while len(self._jobs) > self.history_limit:
+            oldest_id = next(iter(self._jobs))
+            if self._jobs[oldest_id].status not in FINAL_STATUSES:
+                break
+            del self._jobs[oldest_id]
+
+    def get(self, job_id: int) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def active_jobs(self) -> List[Job]:
+        return list(self._active.values())
+
+    async def submit(self, key: str, title: str, func: Callable[..., Tuple[bool, str]],
+                     bot: Bot, chat_id: Optional[int] = None) -> Tuple[Job, bool]:
+        """
+        Ставит задачу func(progress=...) -> (bool, str) и отправляет в chat_id сообщение
+        с прогрессом (без chat_id - тихий запуск, например по расписанию). Если задача
+        с таким ключом уже выполняется, подписывает чат на нее.
+        Возвращает (задача, создана ли новая); дождаться окончания - job.done.wait().
+        """
+        job = self._active.get(key)
+        created = job is None
+        if created:
+            job = Job(job_id=next(self._ids), key=key, title=title)
+            self._active[key] = job
+            self._remember(job)
+            task = asyncio.create_task(self._run(job, func, bot))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            logger.info(f"Запрос '{key}' присоединен к выполняющейся задаче #{job.job_id}.")
+
+        if chat_id is None:
+            return job, created
+        message = await bot.send_message(chat_id, job.text(), parse_mode=ParseMode.HTML)
+        job.subscribers.append((chat_id, message.message_id))
+        if job.status in FINAL_STATUSES:
+            # Задача успела завершиться, пока отправлялось сообщение
+            await self._edit(bot, chat_id, message.message_id, job.text())
+        return job, created
+
+    async def cancel(self, job_id: int) -> Tuple[bool, str]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return False, f"Задача #{job_id} не найдена."
+        if job.status in FINAL_STATUSES:
+            return False, f"Задача #{job_id} уже завершена ({job.status})."
+        job.cancel_requested = True
+        if job.state is not None:
+            await executor.run_io(job.state.__setitem__, 'cancel', True)
+        logger.info(f"Запрошена отмена задачи #{job_id} ({job.title}).")
+        return True, f"Отмена задачи #{job_id} запрошена, она остановится на ближайшей контрольной точке."
+
+    async def _run(self, job: Job, func: Callable[..., Tuple[bool, str]], bot: Bot) -> None:
+        pump = None
+        try:
+            job.state = await executor.run_io(self._shared_state)
+            if job.cancel_requested:
+                raise JobCancelled()
+            job.status = STATUS_RUNNING
+            pump = asyncio.create_task(self._pump(job, bot))
+            success, message = await executor.run_cpu(_run_job, func, JobProgress(job.state))
+            job.status = STATUS_DONE if success else STATUS_FAILED
+            job.result = message
+            if success:
+                job.percent = 100
+        except JobCancelled as e:
+            job.status = STATUS_CANCELLED
+            partial = getattr(e, 'partial_result', None)
+            job.result = (f"Отменена пользователем после частичного выполнения: {partial} "
+                          f"Остальные этапы не выполнены." if partial else "Отменена пользователем.")
+        except Exception as e:
+            logger.error(f"Задача #{job.job_id} ({job.title}) завершилась ошибкой: {e}", exc_info=True)
+            job.status = STATUS_FAILED
+            job.result = f"Ошибка: {e}"
+        finally:
+            if pump is not None:
+                pump.cancel()
+            job.finished = time.monotonic()
+            job.state = None
+            if self._active.get(job.key) is job:
+                del self._active[job.key]
+            job.done.set()
+            logger.info(f"Задача #{job.job_id} ({job.title}): {job.status}. {job.result}")
+        await self._publish(job, bot)
+
+    async def _pump(self, job: Job, bot: Bot) -> None:
+        """Периодически переносит этап из дочернего процесса в сообщения подписчиков."""
+        last_text = None
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            state = job.state
+            if state is None:
+                return
+            snapshot = await executor.run_io(state.copy)
+            job.stage = snapshot.get('stage', job.stage)
+            job.percent = snapshot.get('percent', job.percent)
+            text = job.text()
+            if text != last_text:
+                await self._publish(job, bot, text)
+                last_text = text
+
+    async def _publish(self, job: Job, bot: Bot, text: Optional[str] = None) -> None:
+        text = text or job.text()
+        for chat_id, message_id in list(job.subscribers):
+            await self._edit(bot, chat_id, message_id, text)
+
+    @staticmethod
+    async def _edit(bot: Bot, chat_id: int, message_id: int, text: str) -> None:
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                        parse_mode=ParseMode.HTML)
+        except TelegramError as e:
+            # В т.ч. "message is not modified" - прогресс не изменился
+            logger.debug(f"Не удалось обновить сообщение {chat_id}/{message_id}: {e}")
+
+    def shutdown(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+jobs = JobManager()
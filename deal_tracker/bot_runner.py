@@ -1,4 +1,5 @@
 # deal_tracker/bot_runner.py
+import asyncio
 import logging
 import os
 from telegram.ext import Application, CommandHandler
@@ -12,12 +13,19 @@ from telegram_handlers import (
     deposit_command,
     withdraw_command,
     transfer_command,
+    batch_command,
     portfolio_command,
     history_command,
     average_command,
     updater_status_command,
-    update_analytics_command
+    update_analytics_command,
+    cancel_job_command,
+    reconcile_command,
+    bot_status_command
 )
+from bot_executor import executor
+from bot_jobs import jobs
+from bot_schedule import register_scheduled_jobs
 
 # Настройка логирования
 os.makedirs(getattr(config, 'LOGS_DIR', 'logs'), exist_ok=True)
@@ -44,6 +52,11 @@ logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+async def _shutdown_workers(application: Application) -> None:
+    jobs.shutdown()
+    executor.shutdown()
+
+
 def main() -> None:
     logger.info("Запуск Telegram бота...")
 
@@ -51,7 +64,24 @@ def main() -> None:
         logger.critical("TELEGRAM_TOKEN не найден. Бот не может быть запущен.")
         return
 
-    application = Application.builder().token(config.TELEGRAM_TOKEN).build()
+    if config.BOT_MODE not in ('polling', 'webhook'):
+        logger.critical(f"Неизвестный BOT_MODE '{config.BOT_MODE}': ожидается polling или webhook.")
+        return
+    if config.BOT_MODE == 'webhook' and not config.WEBHOOK_URL:
+        logger.critical("BOT_MODE=webhook, но WEBHOOK_URL не задан. Бот не может быть запущен.")
+        return
+
+    # Обработчики выполняются параллельно; блокирующая работа уходит в пулы bot_executor
+    builder = (Application.builder()
+               .token(config.TELEGRAM_TOKEN)
+               .concurrent_updates(config.BOT_CONCURRENT_UPDATES)
+               .post_shutdown(_shutdown_workers))
+    if config.TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(config.TELEGRAM_API_BASE_URL)
+    if config.BOT_UPDATE_QUEUE_SIZE > 0:
+        # Ограниченная очередь: полная очередь задерживает прием новых обновлений
+        builder = builder.update_queue(asyncio.Queue(maxsize=config.BOT_UPDATE_QUEUE_SIZE))
+    application = builder.build()
 
     # Регистрация обработчиков команд (только существующих)
     application.add_handler(CommandHandler("start", start_command))
@@ -61,6 +91,7 @@ def main() -> None:
     application.add_handler(CommandHandler("deposit", deposit_command))
     application.add_handler(CommandHandler("withdraw", withdraw_command))
     application.add_handler(CommandHandler("transfer", transfer_command))
+    application.add_handler(CommandHandler("batch", batch_command))
     application.add_handler(CommandHandler("portfolio", portfolio_command))
     application.add_handler(CommandHandler("history", history_command))
     application.add_handler(CommandHandler("average", average_command))
@@ -68,9 +99,28 @@ def main() -> None:
         "updater_status", updater_status_command))
     application.add_handler(CommandHandler(
         "update_analytics", update_analytics_command))
+    application.add_handler(CommandHandler("cancel_job", cancel_job_command))
+    application.add_handler(CommandHandler("reconcile", reconcile_command))
+    application.add_handler(CommandHandler("bot_status", bot_status_command))
+
+    register_scheduled_jobs(application)
 
-    logger.info("Бот запущен и готов принимать команды.")
-    application.run_polling()
+    if config.BOT_MODE == 'webhook':
+        if not config.WEBHOOK_SECRET_TOKEN:
+            logger.warning("WEBHOOK_SECRET_TOKEN не задан: webhook примет запросы от кого угодно.")
+        webhook_url = f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}"
+        logger.info(f"Бот запущен в режиме webhook: {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}, {webhook_url}")
+        application.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=config.WEBHOOK_SECRET_TOKEN or None,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        logger.info("Бот запущен и готов принимать команды.")
+        application.run_polling()
     logger.info("Бот остановлен.")
 
 
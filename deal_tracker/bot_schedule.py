@@ -0,0 +1,105 @@
+# deal_tracker/bot_schedule.py
+"""
+Регулярные задачи бота на JobQueue PTB.
+
+- analytics_refresh: каждые ANALYTICS_REFRESH_INTERVAL_SECONDS пересчитывает
+  FIFO и аналитику через bot_jobs (тот же ключ, что и /update_analytics, поэтому
+  ручной и плановый запуск не идут параллельно).
+- daily_digest: в DAILY_DIGEST_TIME (по TZ_OFFSET_HOURS) отправляет сводку PnL
+  через notifier.
+
+Каждая задача хранит отпечаток своих входных листов и пропускает запуск, если
+с прошлого успешного запуска они не менялись. Open_Positions в отпечаток
+пересчета не входит: цены в нем обновляются постоянно, а FIFO зависит только
+от сделок и движений средств. Не входят и FIFO-столбцы Core_Trades: их пишет
+сам пересчет, и иначе после каждой продажи он запускался бы повторно, добавляя
+в Analytics одинаковые строки. Проверка отпечатка читает входные листы целиком
+(один запрос на лист), поэтому интервалы задач не стоит делать короткими.
+"""
+import logging
+from datetime import time as dt_time, timedelta, timezone
+from typing import List, Optional, Sequence
+
+from telegram.ext import Application, CallbackContext
+
+import analytics_service
+import config
+import notifier
+import sheets_service
+from bot_executor import executor
+from bot_jobs import STATUS_DONE, jobs
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_INPUT_SHEETS = [config.CORE_TRADES_SHEET_NAME, config.FUND_MOVEMENTS_SHEET_NAME]
+# Поля Core_Trades, которые записывает сам пересчет FIFO
+ANALYTICS_OUTPUT_FIELDS = ['fifo_consumed_qty', 'fifo_sell_processed']
+DIGEST_INPUT_SHEETS = [config.CORE_TRADES_SHEET_NAME, config.FIFO_LOG_SHEET_NAME,
+                       config.OPEN_POSITIONS_SHEET_NAME]
+
+
+async def _changed_fingerprint(context: CallbackContext, sheet_names: List[str],
+                               exclude_fields: Sequence[str] = ()) -> Optional[str]:
+    """Новый отпечаток листов или None, если данные не менялись (или не прочитались)."""
+    fingerprint = await executor.run_io(sheets_service.get_sheets_fingerprint, sheet_names, exclude_fields)
+    if fingerprint is None:
+        logger.warning(f"Задача '{context.job.name}': не удалось получить отпечаток листов, запуск пропущен.")
+        return None
+    if fingerprint == context.job.data.get('fingerprint'):
+        logger.info(f"Задача '{context.job.name}': данные не менялись, запуск пропущен.")
+        return None
+    return fingerprint
+
+
+async def analytics_refresh_job(context: CallbackContext) -> None:
+    # Отпечаток берется до пересчета: сделка, записанная во время него, попадет в следующий запуск
+    fingerprint = await _changed_fingerprint(context, ANALYTICS_INPUT_SHEETS, ANALYTICS_OUTPUT_FIELDS)
+    if fingerprint is None:
+        return
+    job, _ = await jobs.submit('analytics', "Обновление аналитики и FIFO",
+                               analytics_service.calculate_and_update_analytics_sheet, context.bot)
+    await job.done.wait()
+    if job.status == STATUS_DONE:
+        context.job.data['fingerprint'] = fingerprint
+
+
+async def daily_digest_job(context: CallbackContext) -> None:
+    fingerprint = await _changed_fingerprint(context, DIGEST_INPUT_SHEETS)
+    if fingerprint is None:
+        return
+    try:
+        digest = await executor.run_io(analytics_service.build_daily_digest)
+    except Exception as e:
+        logger.error(f"Ошибка формирования ежедневной сводки: {e}", exc_info=True)
+        return
+    if await notifier.send_telegram_alert(digest, bot_instance=context.bot):
+        context.job.data['fingerprint'] = fingerprint
+
+
+def _parse_digest_time(value: str) -> Optional[dt_time]:
+    try:
+        hours, minutes = (int(part) for part in value.split(':'))
+        return dt_time(hours, minutes, tzinfo=timezone(timedelta(hours=config.TZ_OFFSET_HOURS)))
+    except ValueError:
+        logger.error(f"Некорректное DAILY_DIGEST_TIME '{value}', ожидается ЧЧ:ММ.")
+        return None
+
+
+def register_scheduled_jobs(application: Application) -> None:
+    """Регистрирует регулярные задачи; без JobQueue (нет extra job-queue) только пишет предупреждение."""
+    job_queue = application.job_queue
+    if job_queue is None:
+        logger.warning("JobQueue недоступна (установите python-telegram-bot[job-queue]), "
+                       "регулярные задачи не запущены.")
+        return
+
+    if config.ANALYTICS_REFRESH_INTERVAL_SECONDS > 0:
+        job_queue.run_repeating(analytics_refresh_job, interval=config.ANALYTICS_REFRESH_INTERVAL_SECONDS,
+                                first=config.ANALYTICS_REFRESH_FIRST_DELAY_SECONDS,
+                                name='analytics_refresh', data={})
+        logger.info(f"Плановый пересчет аналитики: каждые {config.ANALYTICS_REFRESH_INTERVAL_SECONDS} с.")
+
+    digest_time = _parse_digest_time(config.DAILY_DIGEST_TIME) if config.DAILY_DIGEST_TIME else None
+    if digest_time:
+        job_queue.run_daily(daily_digest_job, time=digest_time, name='daily_digest', data={})
+        logger.info(f"Ежедневная сводка PnL: в {config.DAILY_DIGEST_TIME}.")
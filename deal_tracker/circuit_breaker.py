@@ -0,0 +1,111 @@
+# deal_tracker/circuit_breaker.py
+"""
+Circuit breaker для внешних API (бирж).
+После серии сетевых ошибок цепь размыкается, и запросы к бирже не выполняются
+до истечения паузы. Затем пропускается один пробный запрос (HALF_OPEN):
+успех замыкает цепь, ошибка снова размыкает ее с удвоенной паузой.
+"""
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+STATE_CLOSED = "CLOSED"
+STATE_OPEN = "OPEN"
+STATE_HALF_OPEN = "HALF_OPEN"
+
+
+class CircuitBreaker:
+    """Счетчик ошибок и состояние цепи для одной биржи."""
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        cooldown_seconds: float,
+        max_cooldown_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self._clock = clock
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.total_successes = 0
+        self.trips = 0
+        self.last_error: Optional[str] = None
+        self.last_success_at: Optional[datetime] = None
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def _current_cooldown(self) -> float:
+        return min(self.max_cooldown_seconds, self.cooldown_seconds * (2 ** max(0, self.trips - 1)))
+
+    def seconds_until_retry(self) -> float:
+        if self.state != STATE_OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self._current_cooldown() - self._clock())
+
+    def allow_request(self) -> bool:
+        """Можно ли сейчас обращаться к бирже. В HALF_OPEN пропускается один пробный запрос."""
+        if self.state == STATE_OPEN and self.seconds_until_retry() <= 0:
+            self.state = STATE_HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.total_successes += 1
+        self.last_success_at = datetime.now()
+        self._probe_in_flight = False
+
+    def record_failure(self, error: str) -> None:
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        self.last_error = error
+        self._probe_in_flight = False
+        if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != STATE_OPEN:
+                self.trips += 1
+            self.state = STATE_OPEN
+            self._opened_at = self._clock()
+
+    def snapshot(self) -> Dict[str, object]:
+        """Состояние для публикации в System_Status и /updater_status."""
+        return {
+            'component': f"exchange:{self.name}",
+            'status': self.state,
+            'last_success': self.last_success_at,
+            'error': (f"{self.consecutive_failures} ошибок подряд, повтор через "
+                      f"{self.seconds_until_retry():.0f} с: {self.last_error}")
+            if self.state != STATE_CLOSED else "",
+        }
+
+
+class CircuitBreakerRegistry:
+    """Набор circuit breaker'ов, создаваемых по имени биржи."""
+
+    def __init__(self, failure_threshold: int, cooldown_seconds: float, max_cooldown_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        key = name.lower()
+        if key not in self._breakers:
+            self._breakers[key] = CircuitBreaker(
+                key, self.failure_threshold, self.cooldown_seconds, self.max_cooldown_seconds)
+        return self._breakers[key]
+
+    def snapshot(self) -> List[Dict[str, object]]:
+        return [b.snapshot() for _, b in sorted(self._breakers.items())]
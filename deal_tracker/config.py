@@ -20,6 +20,23 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', 'ВАШ_ТЕЛЕГРАМ_ТОКЕН
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID', 'ВАШ_ТЕЛЕГРАМ_CHAT_ID')
 # Для нескольких администраторов через запятую. Если пусто, используется TELEGRAM_CHAT_ID.
 TELEGRAM_ADMIN_IDS_STR = os.getenv('TELEGRAM_ADMIN_IDS_STR', TELEGRAM_CHAT_ID)
+# Адрес Bot API; пусто - стандартный api.telegram.org (свой - для локального Bot API или webhook_harness)
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', '')
+
+# Режим получения обновлений: 'polling' или 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Webhook: локальный адрес HTTP-сервера PTB, публичный URL (без пути) и путь обработчика
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (1-256 символов A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+# Сколько одновременных HTTPS-соединений Telegram открывает к webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Размер очереди обновлений; при заполнении webhook отвечает Telegram медленнее,
+# и он сам придерживает новые обновления (0 - без ограничения)
+BOT_UPDATE_QUEUE_SIZE = int(os.getenv('BOT_UPDATE_QUEUE_SIZE', '256'))
 
 # --- Настройки Google Sheets ---
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID', 'ВАШ_SPREADSHEET_ID')
@@ -27,6 +44,12 @@ SPREADSHEET_ID = os.getenv('SPREADSHEET_ID', 'ВАШ_SPREADSHEET_ID')
 # ИЗМЕНЕНО: Название переменной приведено в соответствие с sheets_service.py
 GOOGLE_CREDS_JSON_PATH = os.getenv(
     'GOOGLE_CREDS_JSON_PATH', 'credentials.json')
+# Бэкенд таблицы: 'google' или 'local' (локальный файл для стресс- и нагрузочных тестов)
+SHEETS_BACKEND = os.getenv('SHEETS_BACKEND', 'google').lower()
+# Путь к файлу локальной таблицы; пусто - данные только в памяти процесса
+LOCAL_SHEETS_PATH = os.getenv('LOCAL_SHEETS_PATH', '')
+# Искусственная задержка каждого вызова локальной таблицы (имитация сети)
+LOCAL_SHEETS_LATENCY_MS = int(os.getenv('LOCAL_SHEETS_LATENCY_MS', '0'))
 
 # --- Имена листов в Google Sheets ---
 # Эти переменные теперь будут использоваться в sheets_service.py
@@ -93,10 +116,124 @@ UPDATER_STATUS_CELL = os.getenv('UPDATER_STATUS_CELL', 'B1')
 PRICE_UPDATER_LOG_FILE = os.getenv(
     'PRICE_UPDATER_LOG_FILE', 'price_updater.log')
 
+# --- Локальное состояние (кэши, курсоры и т.п.) ---
+STATE_DIR = os.getenv('STATE_DIR', 'state')
+# Через сколько секунд in-memory состояние балансов/позиций перечитывается из таблицы
+# (подхватывает ручные правки значений; новые строки в листы учета вручную не добавлять)
+LEDGER_STATE_TTL_SECONDS = int(os.getenv('LEDGER_STATE_TTL_SECONDS', '300'))
+# Фоновое применение журнала после сбоя записи: первая пауза и предел ее удвоения
+JOURNAL_REPLAY_RETRY_SECONDS = float(os.getenv('JOURNAL_REPLAY_RETRY_SECONDS', '30'))
+JOURNAL_REPLAY_MAX_DELAY_SECONDS = float(os.getenv('JOURNAL_REPLAY_MAX_DELAY_SECONDS', '600'))
+# На сколько строк расширять лист, когда пакетной записи не хватает его сетки
+SHEET_GROW_ROWS = int(os.getenv('SHEET_GROW_ROWS', '500'))
+# Размер порции строк при потоковом импорте CSV-выгрузок бирж
+CSV_IMPORT_CHUNK_SIZE = int(os.getenv('CSV_IMPORT_CHUNK_SIZE', '500'))
+# Время жизни дискового кэша метаданных рынков CCXT
+MARKET_CACHE_TTL_SECONDS = int(os.getenv('MARKET_CACHE_TTL_SECONDS', '86400'))
+
+# --- Circuit breaker для бирж в price_updater ---
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv('CIRCUIT_COOLDOWN_SECONDS', '60'))
+CIRCUIT_MAX_COOLDOWN_SECONDS = float(
+    os.getenv('CIRCUIT_MAX_COOLDOWN_SECONDS', '900'))
+# Блок состояния бирж в System_Status: строка заголовка и максимум строк под биржи
+EXCHANGE_HEALTH_START_ROW = int(os.getenv('EXCHANGE_HEALTH_START_ROW', '3'))
+EXCHANGE_HEALTH_MAX_ROWS = int(os.getenv('EXCHANGE_HEALTH_MAX_ROWS', '20'))
+
+# --- Синхронизация сделок и движений с бирж (exchange_sync) ---
+# Биржи для синхронизации через запятую (id CCXT). Ключи API: <ID>_API_KEY, <ID>_API_SECRET
+SYNC_EXCHANGES = [e.strip().lower() for e in os.getenv('SYNC_EXCHANGES', '').split(',') if e.strip()]
+# Пары, по которым запрашивать сделки, если биржа требует символ (плюс пары открытых позиций)
+SYNC_SYMBOLS = [s.strip().upper() for s in os.getenv('SYNC_SYMBOLS', '').split(',') if s.strip()]
+SYNC_MAX_CONCURRENCY = int(os.getenv('SYNC_MAX_CONCURRENCY', '2'))
+SYNC_PAGE_LIMIT = int(os.getenv('SYNC_PAGE_LIMIT', '500'))
+# Глубина первой синхронизации, пока курсора еще нет
+SYNC_INITIAL_LOOKBACK_DAYS = int(os.getenv('SYNC_INITIAL_LOOKBACK_DAYS', '30'))
+SYNC_INTERVAL_SECONDS = int(os.getenv('SYNC_INTERVAL_SECONDS', '900'))
+
+# --- Сверка балансов с биржами (reconciliation) ---
+# Биржи для сверки (по умолчанию те же, что и для синхронизации)
+RECONCILE_EXCHANGES = [e.strip().lower() for e in os.getenv('RECONCILE_EXCHANGES', '').split(',')
+                       if e.strip()] or SYNC_EXCHANGES
+# Расхождение считается значимым, если превышает и абсолютный, и относительный порог
+RECONCILE_ABS_THRESHOLD = os.getenv('RECONCILE_ABS_THRESHOLD', '0.00000001')
+RECONCILE_REL_THRESHOLD_PCT = os.getenv('RECONCILE_REL_THRESHOLD_PCT', '0.1')
+
+# --- Ценовые алерты SL/TP ---
+PRICE_ALERTS_ENABLED = os.getenv(
+    'PRICE_ALERTS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Как часто перечитывать уровни SL/TP из Core_Trades
+ALERT_LEVELS_REFRESH_SECONDS = int(
+    os.getenv('ALERT_LEVELS_REFRESH_SECONDS', '900'))
+
+# --- Очередь уведомлений (notifier.NotificationOutbox) ---
+# Минимальная пауза между сообщениями в один чат (Telegram допускает ~1 сообщение/с)
+NOTIFIER_MIN_INTERVAL_SECONDS = float(os.getenv('NOTIFIER_MIN_INTERVAL_SECONDS', '1.1'))
+# Уведомления, поставленные в течение этого окна, отправляются одной сводкой
+NOTIFIER_COALESCE_WINDOW_SECONDS = float(os.getenv('NOTIFIER_COALESCE_WINDOW_SECONDS', '2'))
+# Максимум неотправленных уведомлений на чат; сверх него enqueue() отклоняет сообщение
+NOTIFIER_MAX_QUEUE = int(os.getenv('NOTIFIER_MAX_QUEUE', '500'))
+# Повторы отправки при RetryAfter и сетевых ошибках
+NOTIFIER_MAX_RETRIES = int(os.getenv('NOTIFIER_MAX_RETRIES', '5'))
+# Сколько price_updater ждет отправки очереди при остановке
+NOTIFIER_SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv('NOTIFIER_SHUTDOWN_TIMEOUT_SECONDS', '10'))
+
+# --- Адаптивный опрос цен ---
+# Интервал для позиции "эталонной" стоимости без волатильности равен PRICE_UPDATE_INTERVAL_SECONDS;
+# более крупные/волатильные позиции опрашиваются чаще, мелкие - реже, в пределах [MIN, MAX].
+PRICE_POLL_MIN_INTERVAL_SECONDS = float(
+    os.getenv('PRICE_POLL_MIN_INTERVAL_SECONDS', '5'))
+PRICE_POLL_MAX_INTERVAL_SECONDS = float(
+    os.getenv('PRICE_POLL_MAX_INTERVAL_SECONDS', '3600'))
+# Эталонная стоимость позиции в BASE_CURRENCY
+PRICE_POLL_REFERENCE_VALUE = os.getenv('PRICE_POLL_REFERENCE_VALUE', '1000')
+# Эталонная волатильность (ст. отклонение изменения цены за минуту), удваивающая частоту опроса
+PRICE_POLL_REFERENCE_VOLATILITY = float(
+    os.getenv('PRICE_POLL_REFERENCE_VOLATILITY', '0.005'))
+# Бюджет запросов к биржам в минуту (суммарно по всем позициям)
+PRICE_POLL_MAX_REQUESTS_PER_MINUTE = float(
+    os.getenv('PRICE_POLL_MAX_REQUESTS_PER_MINUTE', '60'))
+# Как часто перечитывать список позиций и сбрасывать накопленные цены в таблицу
+PRICE_POSITIONS_REFRESH_SECONDS = int(
+    os.getenv('PRICE_POSITIONS_REFRESH_SECONDS', str(PRICE_UPDATE_INTERVAL_SECONDS)))
+PRICE_WRITE_FLUSH_SECONDS = int(os.getenv('PRICE_WRITE_FLUSH_SECONDS', '15'))
+# Как часто price_updater удаляет из Open_Positions строки закрытых позиций (0 - не удалять)
+POSITIONS_COMPACTION_INTERVAL_SECONDS = int(os.getenv('POSITIONS_COMPACTION_INTERVAL_SECONDS', '3600'))
+# Сжимать лист, только если накопилось не меньше стольких закрытых или пустых строк
+POSITIONS_COMPACTION_MIN_ROWS = int(os.getenv('POSITIONS_COMPACTION_MIN_ROWS', '20'))
+
 # --- Настройки аналитики ---
 INVESTMENT_ASSETS = ['USD', 'USDT', 'USDC',
                      'DAI', 'BUSD', 'TUSD', 'USDP', 'FDUSD']
 
+# --- Исполнение команд бота ---
+# Сколько обновлений Telegram обрабатывается одновременно
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', '32'))
+# Потоки для вызовов таблицы и процессы для FIFO/аналитики
+BOT_IO_WORKERS = int(os.getenv('BOT_IO_WORKERS', '8'))
+BOT_CPU_WORKERS = int(os.getenv('BOT_CPU_WORKERS', '2'))
+# Команд одного пользователя: выполняются одновременно / всего в работе (остальные отклоняются)
+BOT_PER_USER_CONCURRENCY = int(os.getenv('BOT_PER_USER_CONCURRENCY', '2'))
+BOT_PER_USER_MAX_PENDING = int(os.getenv('BOT_PER_USER_MAX_PENDING', '5'))
+# Глубина очереди пула, начиная с которой пишется предупреждение
+BOT_QUEUE_WARN_DEPTH = int(os.getenv('BOT_QUEUE_WARN_DEPTH', '20'))
+# Фоновые задачи: как часто обновлять сообщение с прогрессом и сколько завершенных помнить
+JOB_PROGRESS_INTERVAL_SECONDS = float(os.getenv('JOB_PROGRESS_INTERVAL_SECONDS', '3'))
+JOB_HISTORY_LIMIT = int(os.getenv('JOB_HISTORY_LIMIT', '20'))
+# Регулярные задачи бота (JobQueue): пересчет аналитики (0 - выключен) и сводка PnL ('' - выключена)
+ANALYTICS_REFRESH_INTERVAL_SECONDS = int(os.getenv('ANALYTICS_REFRESH_INTERVAL_SECONDS', '1800'))
+ANALYTICS_REFRESH_FIRST_DELAY_SECONDS = int(os.getenv('ANALYTICS_REFRESH_FIRST_DELAY_SECONDS', '60'))
+DAILY_DIGEST_TIME = os.getenv('DAILY_DIGEST_TIME', '21:00')
+# /history и /average: срок жизни кэша сделок (сбрасывается и при новых строках) и размер страницы
+TRADE_QUERY_CACHE_TTL_SECONDS = int(os.getenv('TRADE_QUERY_CACHE_TTL_SECONDS', '300'))
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '10'))
+# Снимок /portfolio сбрасывается по меткам учета и цен; TTL - на случай ручных правок таблицы
+PORTFOLIO_CACHE_TTL_SECONDS = int(os.getenv('PORTFOLIO_CACHE_TTL_SECONDS', '300'))
+# Сколько отрисованных графиков портфеля хранить в памяти
+PORTFOLIO_CHART_CACHE_SIZE = int(os.getenv('PORTFOLIO_CHART_CACHE_SIZE', '16'))
+# Максимум операций в одном сообщении /batch
+BATCH_MAX_OPERATIONS = int(os.getenv('BATCH_MAX_OPERATIONS', '50'))
+
 # --- Настройки логирования ---
 LOG_LEVEL_STR = os.getenv('LOG_LEVEL', 'INFO').upper()
 LOG_LEVEL = getattr(logging, LOG_LEVEL_STR, logging.INFO)
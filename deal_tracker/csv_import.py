@@ -0,0 +1,430 @@
+# deal_tracker/csv_import.py
+"""
+Потоковый импорт CSV-выгрузок бирж (Binance, Bybit) в учет.
+Файл читается построчно генераторами, строки сопоставляются с TradeData/MovementData
+по описанию колонок конкретной выгрузки и передаются в пакетное логирование
+(trade_logger.log_trades / log_fund_movements) порциями фиксированного размера.
+Память не растет с размером файла: в ней одновременно находится только одна порция.
+Выгрузки от новых к старым читаются в два прохода: первый запоминает смещения
+порций записей, второй разбирает порции от последней к первой и отдает записи
+каждой в обратном порядке (значения в кавычках могут содержать переводы строк).
+
+Запуск из консоли:
+    python csv_import.py history.csv --format binance_trades [--chunk 500] [--exchange binance]
+"""
+import argparse
+import codecs
+import csv
+import io
+import logging
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import config
+import trade_logger
+from dedupe_index import fill_order_id
+from models import TradeData, MovementData
+
+logger = logging.getLogger(__name__)
+
+# Котируемые валюты для разбора слитных пар вида BTCUSDT (длинные - раньше)
+QUOTE_ASSETS = ['FDUSD', 'USDT', 'USDC', 'BUSD', 'TUSD', 'DAI', 'BTC', 'ETH', 'BNB', 'EUR', 'USD', 'TRY']
+# Статусы строк выгрузки, считающиеся исполненными
+COMPLETED_STATUSES = {'completed', 'success', 'successful', 'filled', 'done', '1'}
+# Сколько текстов ошибок хранить в отчете (остальные только считаются)
+MAX_REPORTED_ERRORS = 50
+
+
+@dataclass
+class CsvLayout:
+    """Описание колонок выгрузки: поле модели -> возможные заголовки."""
+    kind: str  # 'trade' или 'movement'
+    columns: Dict[str, List[str]]
+    exchange: Optional[str] = None
+    movement_type: Optional[str] = None
+    # Выгрузка отсортирована от новых к старым - читать файл с конца
+    newest_first: bool = False
+
+
+LAYOUTS: Dict[str, CsvLayout] = {
+    'binance_trades': CsvLayout(
+        kind='trade', exchange='binance', newest_first=True,
+        columns={
+            'timestamp': ['Date(UTC)', 'Date(UTC+0)', 'Time'],
+            'symbol': ['Pair', 'Market', 'Symbol'],
+            'trade_type': ['Side', 'Type'],
+            'price': ['Price'],
+            'amount': ['Executed', 'Amount'],
+            'commission': ['Fee'],
+            'commission_asset': ['Fee Coin', 'Fee Asset'],
+            'order_id': ['Order ID', 'OrderId'],
+            'fill_id': ['Trade ID', 'TradeId'],
+        }),
+    'binance_deposits': CsvLayout(
+        kind='movement', exchange='binance', movement_type='DEPOSIT', newest_first=True,
+        columns={
+            'timestamp': ['Date(UTC)', 'Date(UTC+0)', 'Time'],
+            'asset': ['Coin', 'Asset'],
+            'amount': ['Amount'],
+            'fee_amount': ['TransactionFee', 'Fee'],
+            'transaction_id_blockchain': ['TXID', 'TxID', 'Transaction ID'],
+            'status': ['Status'],
+        }),
+    'binance_withdrawals': CsvLayout(
+        kind='movement', exchange='binance', movement_type='WITHDRAWAL', newest_first=True,
+        columns={
+            'timestamp': ['Date(UTC)', 'Date(UTC+0)', 'Time'],
+            'asset': ['Coin', 'Asset'],
+            'amount': ['Amount'],
+            'fee_amount': ['TransactionFee', 'Fee'],
+            'transaction_id_blockchain': ['TXID', 'TxID', 'Transaction ID'],
+            'status': ['Status'],
+        }),
+    'bybit_trades': CsvLayout(
+        kind='trade', exchange='bybit', newest_first=True,
+        columns={
+            'timestamp': ['Transaction Time', 'Trade Time', 'Order Time', 'Time'],
+            'symbol': ['Symbol', 'Spot Pairs', 'Contract'],
+            'trade_type': ['Side', 'Direction'],
+            'price': ['Filled Price', 'Avg. Filled Price', 'Exec Price', 'Price'],
+            'amount': ['Filled Qty', 'Filled Quantity', 'Exec Qty', 'Quantity', 'Qty'],
+            'commission': ['Fee', 'Trading Fee', 'Fees'],
+            'commission_asset': ['Fee Currency', 'Fee Coin', 'Fee Asset'],
+            'order_id': ['Order No.', 'Order ID', 'Order No'],
+            'fill_id': ['Trade ID', 'Exec ID', 'Transaction ID'],
+        }),
+    'bybit_deposits': CsvLayout(
+        kind='movement', exchange='bybit', movement_type='DEPOSIT', newest_first=True,
+        columns={
+            'timestamp': ['Time', 'Date & Time', 'Deposit Time'],
+            'asset': ['Coin', 'Currency'],
+            'amount': ['Qty', 'Amount', 'Quantity'],
+            'transaction_id_blockchain': ['TXID', 'Transaction Hash', 'Hash'],
+            'status': ['Status'],
+        }),
+    'bybit_withdrawals': CsvLayout(
+        kind='movement', exchange='bybit', movement_type='WITHDRAWAL', newest_first=True,
+        columns={
+            'timestamp': ['Time', 'Date & Time', 'Withdrawal Time'],
+            'asset': ['Coin', 'Currency'],
+            'amount': ['Qty', 'Amount', 'Quantity'],
+            'fee_amount': ['Fee', 'Withdrawal Fee'],
+            'transaction_id_blockchain': ['TXID', 'Transaction Hash', 'Hash'],
+            'status': ['Status'],
+        }),
+}
+
+
+@dataclass
+class ImportStats:
+    """Ход и итог импорта."""
+    rows: int = 0
+    accepted: int = 0
+    rejected: int = 0
+    skipped: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    def add_error(self, message: str) -> None:
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(message)
+
+
+# --- Чтение файла ---
+
+
+def _iter_records_forward(stream: BinaryIO, encoding: str) -> Iterator[Tuple[int, List[str]]]:
+    reader = csv.reader(io.TextIOWrapper(stream, encoding=encoding, newline=''))
+    yield from enumerate(reader, start=1)
+
+
+def _read_record(stream: BinaryIO) -> bytes:
+    """Байты одной записи CSV: строки до перевода строки вне кавычек."""
+    record = b''
+    quotes = 0
+    while True:
+        line = stream.readline()
+        if not line:
+            return record
+        record += line
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            return record
+
+
+def _iter_records_reversed(stream: BinaryIO, encoding: str, chunk_rows: int) -> Iterator[Tuple[int, List[str]]]:
+    """
+    Заголовок, затем записи файла с конца к началу вместе с их номерами в файле.
+    Первый проход запоминает только смещение и номер первой записи каждой порции
+    из chunk_rows записей; второй разбирает порции csv.reader с последней и отдает
+    их записи в обратном порядке. В памяти одновременно одна порция.
+    """
+    stream.seek(0)
+    header = _read_record(stream)
+    chunks: List[Tuple[int, int]] = []
+    row_no, in_chunk = 1, chunk_rows
+    while True:
+        offset = stream.tell()
+        if not _read_record(stream):
+            break
+        row_no += 1
+        if in_chunk == chunk_rows:
+            chunks.append((offset, row_no))
+            in_chunk = 0
+        in_chunk += 1
+    end = stream.tell()
+
+    yield from _parse_records(header, encoding, 1)
+    bounds = [offset for offset, _ in chunks] + [end]
+    for index in range(len(chunks) - 1, -1, -1):
+        offset, first_row_no = chunks[index]
+        stream.seek(offset)
+        raw = stream.read(bounds[index + 1] - offset)
+        yield from reversed(list(_parse_records(raw, encoding, first_row_no)))
+
+
+def _parse_records(raw: bytes, encoding: str, first_row_no: int) -> Iterator[Tuple[int, List[str]]]:
+    reader = csv.reader(io.StringIO(raw.decode(encoding), newline=''))
+    yield from enumerate(reader, start=first_row_no)
+
+
+def iter_numbered_csv_rows(stream: BinaryIO, newest_first: bool = False, encoding: str = 'utf-8-sig',
+                           chunk_rows: Optional[int] = None) -> Iterator[Tuple[int, Dict[str, str]]]:
+    """
+    Генератор (номер строки в файле, строка в виде словаря); при newest_first -
+    в хронологическом порядке. Номер строки считается, как в табличном редакторе:
+    заголовок - строка 1, запись с переводами строк в кавычках - одна строка.
+    """
+    can_reverse = newest_first and stream.seekable()
+    if newest_first and not can_reverse:
+        logger.warning("Поток не поддерживает seek: строки будут обработаны в порядке файла.")
+    records = (_iter_records_reversed(stream, encoding, chunk_rows or config.CSV_IMPORT_CHUNK_SIZE)
+               if can_reverse else _iter_records_forward(stream, encoding))
+    try:
+        _, header = next(records)
+    except StopIteration:
+        return
+    headers = [h.strip().lstrip(codecs.BOM_UTF8.decode('utf-8')) for h in header]
+    for row_no, values in records:
+        if not any(v.strip() for v in values):
+            continue
+        yield row_no, dict(zip(headers, (v.strip() for v in values)))
+
+
+def iter_csv_rows(stream: BinaryIO, newest_first: bool = False, encoding: str = 'utf-8-sig') -> Iterator[Dict[str, str]]:
+    """Генератор строк CSV в виде словарей; при newest_first - в хронологическом порядке."""
+    for _, row in iter_numbered_csv_rows(stream, newest_first, encoding):
+        yield row
+
+
+def chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# --- Сопоставление строк с моделями ---
+
+_AMOUNT_WITH_ASSET_RE = re.compile(r'^\s*([-+]?[\d\s.,]*\d)\s*([A-Za-z][A-Za-z0-9]*)?\s*$')
+_TARGET_TZ = timezone(timedelta(hours=config.TZ_OFFSET_HOURS))
+
+
+def _get(row: Dict[str, str], layout: CsvLayout, field_name: str) -> Optional[str]:
+    for header in layout.columns.get(field_name, []):
+        value = row.get(header)
+        if value not in (None, ''):
+            return value
+    return None
+
+
+def _parse_amount(value: Optional[str]) -> Tuple[Optional[Decimal], Optional[str]]:
+    """'0.5BTC' -> (Decimal('0.5'), 'BTC'); '1,234.5' -> (Decimal('1234.5'), None)."""
+    if not value:
+        return None, None
+    match = _AMOUNT_WITH_ASSET_RE.match(value)
+    if not match:
+        return None, None
+    number = match.group(1).replace(' ', '')
+    # Запятая - разделитель тысяч, если есть и точка; иначе - десятичный разделитель
+    number = number.replace(',', '') if '.' in number else number.replace(',', '.')
+    try:
+        return Decimal(number), (match.group(2) or None)
+    except InvalidOperation:
+        return None, None
+
+
+def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Время выгрузки (UTC) в часовом поясе учета. Быстрый путь - ISO-формат."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        from dateutil.parser import parse as parse_datetime_flexible
+        try:
+            dt = parse_datetime_flexible(value)
+        except (ValueError, OverflowError):
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(_TARGET_TZ)
+
+
+def normalize_symbol(value: str) -> Optional[str]:
+    """BTCUSDT, BTC-USDT, BTC_USDT, BTC/USDT -> BTC/USDT."""
+    symbol = value.strip().upper().replace('-', '/').replace('_', '/')
+    if '/' in symbol:
+        return symbol if symbol.count('/') == 1 else None
+    for quote in QUOTE_ASSETS:
+        if symbol.endswith(quote) and len(symbol) > len(quote):
+            return f"{symbol[:-len(quote)]}/{quote}"
+    return None
+
+
+def row_to_trade(row: Dict[str, str], layout: CsvLayout, exchange: str) -> TradeData:
+    symbol = normalize_symbol(_get(row, layout, 'symbol') or '')
+    if not symbol:
+        raise ValueError(f"не распознана пара '{_get(row, layout, 'symbol')}'")
+    side = (_get(row, layout, 'trade_type') or '').upper()
+    if side not in ('BUY', 'SELL'):
+        raise ValueError(f"неизвестное направление '{side}'")
+    timestamp = _parse_timestamp(_get(row, layout, 'timestamp'))
+    amount, _ = _parse_amount(_get(row, layout, 'amount'))
+    price, _ = _parse_amount(_get(row, layout, 'price'))
+    if timestamp is None or amount is None or price is None:
+        raise ValueError("не удалось разобрать время, количество или цену")
+    commission, commission_asset = _parse_amount(_get(row, layout, 'commission'))
+    order_id, fill_id = _get(row, layout, 'order_id'), _get(row, layout, 'fill_id')
+    if order_id and not fill_id:
+        # Выгрузка без номера исполнения: различаем исполнения ордера по времени, объему и цене
+        fill_id = f"{timestamp:%Y%m%d%H%M%S%f}-{amount.normalize()}-{price.normalize()}"
+    return TradeData(
+        timestamp=timestamp, exchange=exchange, symbol=symbol, trade_type=side,
+        amount=amount, price=price, trade_id='',
+        order_id=fill_order_id(order_id, fill_id),
+        commission=commission or None,
+        commission_asset=(_get(row, layout, 'commission_asset') or commission_asset) if commission else None,
+        source='CSV import',
+    )
+
+
+def row_to_movement(row: Dict[str, str], layout: CsvLayout, exchange: str) -> Optional[MovementData]:
+    status = _get(row, layout, 'status')
+    if status and status.strip().lower() not in COMPLETED_STATUSES:
+        return None
+    timestamp = _parse_timestamp(_get(row, layout, 'timestamp'))
+    amount, _ = _parse_amount(_get(row, layout, 'amount'))
+    asset = _get(row, layout, 'asset')
+    if timestamp is None or amount is None or not asset:
+        raise ValueError("не удалось разобрать время, актив или сумму")
+    fee_amount, _ = _parse_amount(_get(row, layout, 'fee_amount'))
+    is_deposit = layout.movement_type == 'DEPOSIT'
+    return MovementData(
+        timestamp=timestamp, movement_type=layout.movement_type, asset=asset.upper(), amount=abs(amount),
+        source_name=None if is_deposit else exchange,
+        destination_name=exchange if is_deposit else None,
+        fee_amount=fee_amount or None, fee_asset=asset.upper() if fee_amount else None,
+        transaction_id_blockchain=_get(row, layout, 'transaction_id_blockchain'),
+        notes='CSV import',
+    )
+
+
+# --- Импорт ---
+
+
+def import_csv(
+    stream: BinaryIO,
+    layout_name: str,
+    exchange: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+    progress: Optional[Callable[[ImportStats], None]] = None,
+) -> ImportStats:
+    """
+    Импортирует выгрузку потоково: строки -> модели -> порции по chunk_size
+    в пакетное логирование. progress вызывается после каждой порции.
+    """
+    layout = LAYOUTS[layout_name]
+    account = (exchange or layout.exchange or '').lower()
+    if not account:
+        raise ValueError("Для этой выгрузки нужно указать биржу/счет.")
+    chunk_size = chunk_size or config.CSV_IMPORT_CHUNK_SIZE
+    stats = ImportStats()
+    ingest = trade_logger.log_trades if layout.kind == 'trade' else trade_logger.log_fund_movements
+
+    def records() -> Iterator[Tuple[int, Any]]:
+        for row_no, row in iter_numbered_csv_rows(stream, layout.newest_first, chunk_rows=chunk_size):
+            stats.rows += 1
+            try:
+                record = (row_to_trade(row, layout, account) if layout.kind == 'trade'
+                          else row_to_movement(row, layout, account))
+            except ValueError as e:
+                stats.add_error(f"Строка {row_no}: {e}")
+                continue
+            if record is None:
+                stats.skipped += 1
+                continue
+            yield row_no, record
+
+    for chunk in chunked(records(), chunk_size):
+        for result in ingest([record for _, record in chunk]):
+            if result.success:
+                stats.accepted += 1
+            elif result.duplicate:
+                stats.skipped += 1
+            else:
+                row_no, record = chunk[result.index]
+                stats.add_error(f"Строка {row_no} ({record.timestamp:%Y-%m-%d %H:%M:%S}): {result.message}")
+        if progress:
+            progress(stats)
+    logger.info(
+        f"Импорт {layout_name}: {stats.rows} строк, принято {stats.accepted}, отклонено {stats.rejected}, "
+        f"пропущено {stats.skipped} за {stats.elapsed:.1f} с ({stats.rows_per_sec:.0f} строк/с).")
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Импорт CSV-выгрузки биржи в учет.")
+    parser.add_argument('path', help="Путь к CSV-файлу")
+    parser.add_argument('--format', required=True, choices=sorted(LAYOUTS), help="Формат выгрузки")
+    parser.add_argument('--exchange', help="Имя счета/биржи (по умолчанию из формата)")
+    parser.add_argument('--chunk', type=int, default=None, help="Размер порции для пакетной записи")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=config.LOG_LEVEL,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def print_progress(stats: ImportStats) -> None:
+        sys.stdout.write(f"\r{stats.rows} строк | принято {stats.accepted} | отклонено {stats.rejected} | "
+                         f"{stats.rows_per_sec:.0f} строк/с")
+        sys.stdout.flush()
+
+    with open(args.path, 'rb') as f:
+        stats = import_csv(f, args.format, exchange=args.exchange,
+                           chunk_size=args.chunk, progress=print_progress)
+    print()
+    for error in stats.errors:
+        print(f"  - {error}")
+    if stats.rejected > len(stats.errors):
+        print(f"  ... и еще {stats.rejected - len(stats.errors)} ошибок")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# deal_tracker/dedupe_index.py
+"""
+Индекс для идемпотентного логирования: ключи (биржа, ордер#исполнение) сделок и
+transaction_id_blockchain движений средств в множествах (проверка за O(1)).
+
+Индекс строится один раз из Core_Trades и Fund_Movements и хранится на диске
+в STATE_DIR как журнал добавлений (JSONL), поэтому запись новых ключей стоит
+O(новых ключей), а не O(размера индекса). Вместе с ключами сохраняется число
+строк листов; если при загрузке оно не совпадает с таблицей (лист правили
+вручную), индекс перестраивается из таблицы. Ключи, дописанные другими
+процессами, подхватываются sync() чтением только нового хвоста файла.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import config
+import ledger_locks
+import sheets_service
+from models import TradeData, MovementData
+
+logger = logging.getLogger(__name__)
+
+TradeKey = Tuple[str, str]  # (exchange.lower(), 'ордер#исполнение')
+
+INDEXED_SHEETS = (config.CORE_TRADES_SHEET_NAME, config.FUND_MOVEMENTS_SHEET_NAME)
+
+
+def fill_order_id(order_id: Optional[Any], fill_id: Optional[Any]) -> Optional[str]:
+    """
+    order_id сделки в учете: 'ордер#исполнение'. У одного ордера бывает несколько
+    исполнений (fills), поэтому ключом дубликатов служит пара, а не номер ордера.
+    Один и тот же формат используют csv_import и exchange_sync, чтобы исполнение,
+    пришедшее из выгрузки и из синхронизации, давало один ключ.
+    """
+    parts = [str(part).strip() for part in (order_id, fill_id) if part is not None and str(part).strip()]
+    return '#'.join(parts) or None
+
+
+def trade_key(exchange: Optional[str], order_id: Optional[str]) -> Optional[TradeKey]:
+    if not exchange or not order_id or not str(order_id).strip():
+        return None
+    return exchange.strip().lower(), str(order_id).strip()
+
+
+def tx_key(transaction_id: Optional[str]) -> Optional[str]:
+    if not transaction_id or not transaction_id.strip():
+        return None
+    return transaction_id.strip()
+
+
+class DedupeIndex:
+    """Множества уже записанных ключей сделок и движений."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(config.STATE_DIR, 'dedupe_index.jsonl')
+        self.trade_keys: Set[TradeKey] = set()
+        self.tx_ids: Set[str] = set()
+        self.loaded = False
+        self._offset = 0
+        self._load_lock = threading.Lock()
+        # Ключи, добавленные потоком в память, но еще не сохраненные на диск
+        self._local = threading.local()
+
+    def _unsaved(self) -> threading.local:
+        if not hasattr(self._local, 'trades'):
+            self._local.trades = []
+            self._local.tx_ids = []
+        return self._local
+
+    # --- Загрузка ---
+
+    def load(self) -> None:
+        """Загружает индекс с диска, если он соответствует таблице, иначе строит заново."""
+        row_counts = {name: sheets_service.get_last_row_number(name) for name in INDEXED_SHEETS}
+        if None in row_counts.values():
+            raise RuntimeError("Не удалось определить размер листов для индекса дубликатов.")
+        with ledger_locks.file_lock('dedupe_index'):
+            if self._load_from_disk() == row_counts:
+                logger.info(
+                    f"Индекс дубликатов загружен с диска: {len(self.trade_keys)} сделок, {len(self.tx_ids)} движений.")
+            else:
+                self.rebuild(row_counts)
+        self.loaded = True
+
+    def _read_entries(self, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Читает полные строки файла начиная с offset. Возвращает записи и новое смещение."""
+        entries = []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Строку еще дописывает другой процесс
+                    break
+                offset += len(line)
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Пропущена поврежденная строка индекса дубликатов.")
+        return entries, offset
+
+    def _apply_entries(self, entries: List[Dict[str, Any]]) -> Optional[Dict[str, int]]:
+        row_counts = None
+        for entry in entries:
+            if 'rows' in entry:
+                row_counts = entry['rows']
+            self.trade_keys.update(tuple(k) for k in entry.get('trades', []))
+            self.tx_ids.update(entry.get('tx_ids', []))
+        return row_counts
+
+    def _load_from_disk(self) -> Optional[Dict[str, int]]:
+        self.trade_keys, self.tx_ids = set(), set()
+        try:
+            entries, self._offset = self._read_entries(0)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать индекс дубликатов: {e}")
+            return None
+        return self._apply_entries(entries)
+
+    def sync(self) -> None:
+        """Подхватывает ключи, дописанные в файл другими процессами."""
+        try:
+            if os.path.getsize(self.path) < self._offset:
+                # Файл перестроен другим процессом
+                self._load_from_disk()
+                return
+            entries, self._offset = self._read_entries(self._offset)
+        except OSError:
+            return
+        self._apply_entries(entries)
+
+    def rebuild(self, row_counts: Dict[str, int]) -> None:
+        """Строит индекс полным чтением Core_Trades и Fund_Movements и перезаписывает файл."""
+        self.trade_keys = {key for t in sheets_service.get_all_core_trades()
+                           if (key := trade_key(t.exchange, t.order_id))}
+        self.tx_ids = {key for m in sheets_service.get_all_fund_movements()
+                       if (key := tx_key(m.transaction_id_blockchain))}
+        self._local = threading.local()
+        self._write_entry({'rows': row_counts, 'trades': sorted(self.trade_keys),
+                           'tx_ids': sorted(self.tx_ids)}, mode='w')
+        logger.info(
+            f"Индекс дубликатов построен из таблицы: {len(self.trade_keys)} сделок, {len(self.tx_ids)} движений.")
+
+    def invalidate(self) -> None:
+        """Сбрасывает индекс в памяти; следующее обращение загрузит его заново."""
+        self.loaded = False
+        self._local = threading.local()
+
+    # --- Проверка и обновление ---
+
+    def is_duplicate(self, item: Any) -> bool:
+        if isinstance(item, TradeData):
+            key = trade_key(item.exchange, item.order_id)
+            return key is not None and key in self.trade_keys
+        if isinstance(item, MovementData):
+            key = tx_key(item.transaction_id_blockchain)
+            return key is not None and key in self.tx_ids
+        return False
+
+    def add(self, item: Any) -> None:
+        """Добавляет ключ записи в память; на диск он попадет при save()."""
+        if isinstance(item, TradeData):
+            key = trade_key(item.exchange, item.order_id)
+            if key is not None and key not in self.trade_keys:
+                self.trade_keys.add(key)
+                self._unsaved().trades.append(key)
+        elif isinstance(item, MovementData):
+            key = tx_key(item.transaction_id_blockchain)
+            if key is not None and key not in self.tx_ids:
+                self.tx_ids.add(key)
+                self._unsaved().tx_ids.append(key)
+
+    def save(self, row_counts: Dict[str, int]) -> None:
+        """Дописывает на диск новые ключи потока и текущее число строк листов."""
+        unsaved = self._unsaved()
+        entry: Dict[str, Any] = {'rows': row_counts}
+        if unsaved.trades:
+            entry['trades'] = unsaved.trades
+        if unsaved.tx_ids:
+            entry['tx_ids'] = unsaved.tx_ids
+        self._write_entry(entry, mode='a')
+        unsaved.trades = []
+        unsaved.tx_ids = []
+
+    def _write_entry(self, entry: Dict[str, Any], mode: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, mode, encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            if mode == 'w':
+                self._offset = os.path.getsize(self.path)
+        except OSError as e:
+            # Без файла индекс останется рабочим в памяти и будет перестроен при следующем запуске
+            logger.warning(f"Не удалось сохранить индекс дубликатов: {e}")
+
+
+_dedupe_index = DedupeIndex()
+
+
+def get_dedupe_index() -> DedupeIndex:
+    """Возвращает общий индекс дубликатов, загружая его при первом обращении."""
+    if not _dedupe_index.loaded:
+        with _dedupe_index._load_lock:
+            if not _dedupe_index.loaded:
+                _dedupe_index.load()
+    return _dedupe_index
@@ -0,0 +1,412 @@
+# deal_tracker/exchange_sync.py
+"""
+Инкрементальная синхронизация сделок, депозитов и выводов с бирж через CCXT.
+
+Для каждой биржи запрашиваются fetch_deposits/fetch_withdrawals и fetch_my_trades
+начиная с сохраненных курсоров (время последней полученной записи, мс), с
+постраничной загрузкой. Новые записи передаются в пакетное идемпотентное
+логирование (trade_logger.log_fund_movements / log_trades): повторно полученные
+записи отсекаются индексом дубликатов. Курсор указывает на последнюю полученную
+запись включительно (у нескольких исполнений может быть одна миллисекунда) и
+сдвигается только после записи пакета: при сбое таблицы или журнала пакет будет
+запрошен снова. Записи, отклоненные проверками учета (например, нехватка
+баланса), попадают в отчет и в лог и больше не запрашиваются - иначе одна
+такая запись навсегда остановила бы поток.
+
+Биржи синхронизируются параллельно (не более SYNC_MAX_CONCURRENCY одновременно).
+Фабрика экземпляров бирж и функции записи подменяются (см. tests/fake_exchange.py).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import ccxt.async_support as ccxt_async
+
+import config
+import market_cache
+import sheets_service
+import trade_logger
+from dedupe_index import fill_order_id
+from models import TradeData, MovementData, IngestResult
+
+logger = logging.getLogger(__name__)
+
+# Ошибки записи, при которых курсор не сдвигается (данные будут запрошены снова)
+RETRYABLE_MESSAGES = {trade_logger.JOURNAL_NOT_APPLIED_MESSAGE, trade_logger.WRITE_FAILED_MESSAGE}
+# Статусы движений, после которых запись больше не изменится
+FINAL_MOVEMENT_STATUSES = {'ok', 'failed', 'canceled'}
+# Ключ курсора сделок, запрошенных без символа (биржи, где символ не обязателен)
+ALL_SYMBOLS = '*'
+
+_TARGET_TZ = timezone(timedelta(hours=config.TZ_OFFSET_HOURS))
+
+ExchangeFactory = Callable[[str], Awaitable[Any]]
+IngestFunc = Callable[[List[Any]], List[IngestResult]]
+
+
+@dataclass
+class SyncReport:
+    """Итог синхронизации одной биржи."""
+    exchange: str
+    trades_fetched: int = 0
+    movements_fetched: int = 0
+    accepted: int = 0
+    duplicates: int = 0
+    rejected: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+# --- Курсоры ---
+
+
+class CursorStore:
+    """Курсоры синхронизации {биржа: {поток: метка времени, мс}} в STATE_DIR."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(config.STATE_DIR, 'sync_cursors.json')
+        self._cursors: Dict[str, Dict[str, int]] = self._load()
+
+    def _load(self) -> Dict[str, Dict[str, int]]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать курсоры синхронизации: {e}")
+            return {}
+
+    def get(self, exchange_id: str, stream: str) -> Optional[int]:
+        return self._cursors.get(exchange_id, {}).get(stream)
+
+    def streams(self, exchange_id: str) -> List[str]:
+        return list(self._cursors.get(exchange_id, {}))
+
+    def update(self, exchange_id: str, cursors: Dict[str, int]) -> None:
+        if not cursors:
+            return
+        self._cursors.setdefault(exchange_id, {}).update(cursors)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._cursors, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить курсоры синхронизации: {e}")
+
+
+# --- Преобразование записей CCXT в модели ---
+
+
+def _to_datetime(timestamp_ms: Optional[int]) -> datetime:
+    if not timestamp_ms:
+        return datetime.now(_TARGET_TZ)
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).astimezone(_TARGET_TZ)
+
+
+def _decimal(value: Any) -> Optional[Decimal]:
+    return Decimal(str(value)) if value is not None else None
+
+
+def trade_from_ccxt(exchange_id: str, raw: Dict[str, Any]) -> Optional[TradeData]:
+    """Сделка (fill) CCXT -> TradeData. Не-спотовые пары (BTC/USDT:USDT) пропускаются."""
+    symbol = raw.get('symbol') or ''
+    if symbol.count('/') != 1 or ':' in symbol:
+        return None
+    amount, price = _decimal(raw.get('amount')), _decimal(raw.get('price'))
+    if not amount or price is None:
+        return None
+    fee = raw.get('fee') or {}
+    # order_id содержит и ордер, и fill: у одного ордера может быть несколько исполнений
+    order_id = fill_order_id(raw.get('order'), raw.get('id'))
+    return TradeData(
+        timestamp=_to_datetime(raw.get('timestamp')), exchange=exchange_id, symbol=symbol,
+        trade_type=str(raw.get('side', '')).upper(), amount=amount, price=price, trade_id='',
+        order_id=order_id,
+        commission=_decimal(fee.get('cost')) or None,
+        commission_asset=fee.get('currency') if fee.get('cost') else None,
+        source='exchange_sync',
+    )
+
+
+def movement_from_ccxt(exchange_id: str, raw: Dict[str, Any], movement_type: str) -> Optional[MovementData]:
+    """Депозит/вывод CCXT -> MovementData. Учитываются только завершенные (status 'ok')."""
+    if raw.get('status') != 'ok':
+        return None
+    amount = _decimal(raw.get('amount'))
+    if not amount or not raw.get('currency'):
+        return None
+    fee = raw.get('fee') or {}
+    is_deposit = movement_type == 'DEPOSIT'
+    return MovementData(
+        timestamp=_to_datetime(raw.get('timestamp')), movement_type=movement_type,
+        asset=raw['currency'], amount=abs(amount),
+        source_name=None if is_deposit else exchange_id,
+        destination_name=exchange_id if is_deposit else None,
+        fee_amount=_decimal(fee.get('cost')) or None,
+        fee_asset=fee.get('currency') if fee.get('cost') else None,
+        # Внутренние переводы биржи идут без txid - тогда ключом служит id записи биржи
+        transaction_id_blockchain=raw.get('txid') or f"{exchange_id}:{raw.get('id')}",
+        notes='exchange_sync',
+    )
+
+
+# --- Загрузка с бирж ---
+
+
+async def create_exchange(exchange_id: str):
+    """Экземпляр CCXT с ключами API из окружения (<ID>_API_KEY, <ID>_API_SECRET)."""
+    api_key = os.getenv(f"{exchange_id.upper()}_API_KEY")
+    secret = os.getenv(f"{exchange_id.upper()}_API_SECRET")
+    if not api_key or not secret:
+        raise ValueError(f"Не заданы {exchange_id.upper()}_API_KEY/{exchange_id.upper()}_API_SECRET.")
+    exchange_class = getattr(ccxt_async, exchange_id)
+    exchange = exchange_class({'apiKey': api_key, 'secret': secret, 'enableRateLimit': True})
+    await market_cache.ensure_markets_async(exchange)
+    return exchange
+
+
+def _raw_key(raw: Dict[str, Any]) -> str:
+    if raw.get('id') is not None:
+        return str(raw['id'])
+    return json.dumps(raw, sort_keys=True, default=str)
+
+
+async def paginate(fetch: Callable[[Optional[int], int], Awaitable[List[Dict[str, Any]]]],
+                   since: Optional[int], limit: int) -> List[Dict[str, Any]]:
+    """
+    Загружает записи страницами по limit. Следующая страница запрашивается с
+    since = время последней полученной записи включительно: исполнения той же
+    миллисекунды, не поместившиеся в страницу, не теряются, а повторы на стыке
+    страниц отбрасываются по id. Если вся полная страница пришлась на одну
+    миллисекунду, она запрашивается снова с удвоенным limit.
+    """
+    items: List[Dict[str, Any]] = []
+    seen: set = set()
+    cursor, page_limit = since, limit
+    while True:
+        page = await fetch(cursor, page_limit)
+        if not page:
+            break
+        new_items = [p for p in page if _raw_key(p) not in seen]
+        seen.update(_raw_key(p) for p in new_items)
+        items.extend(new_items)
+        last_ts = max((p.get('timestamp') or 0 for p in page), default=0)
+        if len(page) < page_limit or not last_ts or (cursor is not None and last_ts < cursor):
+            break
+        if last_ts == cursor:
+            page_limit *= 2
+            continue
+        if not new_items:
+            break
+        cursor, page_limit = last_ts, limit
+    return items
+
+
+def _next_cursor(items: List[Dict[str, Any]], since: Optional[int], final_only: bool = False) -> Optional[int]:
+    """
+    Курсор для следующего запуска: время последней полученной записи (включительно,
+    повторы отсечет индекс дубликатов). Для движений курсор не проходит дальше
+    первой незавершенной записи, чтобы забрать ее позже.
+    """
+    if final_only:
+        pending = [i['timestamp'] for i in items
+                   if i.get('timestamp') and i.get('status') not in FINAL_MOVEMENT_STATUSES]
+        if pending:
+            return min(pending)
+    timestamps = [i['timestamp'] for i in items if i.get('timestamp')]
+    return max(timestamps) if timestamps else since
+
+
+def _describe(item: Any) -> str:
+    """Краткое описание записи для отчета об отказе."""
+    if isinstance(item, TradeData):
+        return f"{item.timestamp:%Y-%m-%d %H:%M:%S} {item.trade_type} {item.amount} {item.symbol} ({item.order_id})"
+    return (f"{item.timestamp:%Y-%m-%d %H:%M:%S} {item.movement_type} {item.amount} {item.asset} "
+            f"({item.transaction_id_blockchain})")
+
+
+class ExchangeSyncer:
+    """Синхронизирует биржи параллельно с ограничением числа одновременных бирж."""
+
+    def __init__(
+        self,
+        exchange_ids: Optional[List[str]] = None,
+        exchange_factory: Optional[ExchangeFactory] = None,
+        cursor_store: Optional[CursorStore] = None,
+        max_concurrency: Optional[int] = None,
+        page_limit: Optional[int] = None,
+        ingest_trades: Optional[IngestFunc] = None,
+        ingest_movements: Optional[IngestFunc] = None,
+    ):
+        self.exchange_ids = [e.lower() for e in (exchange_ids or config.SYNC_EXCHANGES)]
+        self.exchange_factory = exchange_factory or create_exchange
+        self.cursors = cursor_store or CursorStore()
+        self.max_concurrency = max(1, max_concurrency or config.SYNC_MAX_CONCURRENCY)
+        self.page_limit = page_limit or config.SYNC_PAGE_LIMIT
+        self.ingest_trades = ingest_trades or trade_logger.log_trades
+        self.ingest_movements = ingest_movements or trade_logger.log_fund_movements
+
+    def _initial_since(self) -> int:
+        return int((time.time() - config.SYNC_INITIAL_LOOKBACK_DAYS * 86400) * 1000)
+
+    async def sync_all(self) -> List[SyncReport]:
+        positions = await asyncio.to_thread(sheets_service.get_all_open_positions)
+        position_symbols: Dict[str, set] = {}
+        for p in positions:
+            if p.exchange and p.symbol:
+                position_symbols.setdefault(p.exchange.lower(), set()).add(p.symbol.upper())
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(exchange_id: str) -> SyncReport:
+            async with semaphore:
+                return await self.sync_exchange(exchange_id, position_symbols.get(exchange_id, set()))
+
+        return list(await asyncio.gather(*(run(e) for e in self.exchange_ids)))
+
+    async def sync_exchange(self, exchange_id: str, extra_symbols: Optional[set] = None) -> SyncReport:
+        report = SyncReport(exchange=exchange_id)
+        exchange = None
+        try:
+            exchange = await self.exchange_factory(exchange_id)
+            movements, movement_cursors = await self._fetch_movements(exchange, exchange_id)
+            report.movements_fetched = len(movements)
+            # Сначала движения: сделки проверяются по балансам, которые они пополняют
+            if not await self._ingest(self.ingest_movements, movements, report):
+                return report
+            self.cursors.update(exchange_id, movement_cursors)
+
+            trades, trade_cursors = await self._fetch_trades(exchange, exchange_id, extra_symbols or set())
+            report.trades_fetched = len(trades)
+            if not await self._ingest(self.ingest_trades, trades, report):
+                return report
+            self.cursors.update(exchange_id, trade_cursors)
+        except ccxt_async.BaseError as e:
+            report.error = f"Ошибка CCXT: {e}"
+        except ValueError as e:
+            report.error = str(e)
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации {exchange_id}: {e}", exc_info=True)
+            report.error = f"Ошибка: {e}"
+        finally:
+            if exchange is not None and hasattr(exchange, 'close'):
+                await exchange.close()
+        if report.error:
+            logger.error(f"Синхронизация {exchange_id}: {report.error}")
+        else:
+            logger.info(
+                f"Синхронизация {exchange_id}: движений {report.movements_fetched}, сделок {report.trades_fetched}, "
+                f"записано {report.accepted}, дубликатов {report.duplicates}, отклонено {len(report.rejected)}.")
+        return report
+
+    async def _fetch_movements(self, exchange, exchange_id: str) -> Tuple[List[MovementData], Dict[str, int]]:
+        """Движения по времени и новые курсоры потоков."""
+        fetched: List[MovementData] = []
+        cursors: Dict[str, int] = {}
+        for stream, capability, method, movement_type in (
+                ('deposits', 'fetchDeposits', 'fetch_deposits', 'DEPOSIT'),
+                ('withdrawals', 'fetchWithdrawals', 'fetch_withdrawals', 'WITHDRAWAL')):
+            if not exchange.has.get(capability):
+                continue
+            since = self.cursors.get(exchange_id, stream) or self._initial_since()
+            fetch = getattr(exchange, method)
+            raw = await paginate(lambda s, limit: fetch(None, s, limit), since, self.page_limit)
+            for r in raw:
+                movement = movement_from_ccxt(exchange_id, r, movement_type)
+                if movement:
+                    fetched.append(movement)
+            cursors[stream] = _next_cursor(raw, since, final_only=True)
+        return sorted(fetched, key=lambda m: m.timestamp), cursors
+
+    async def _fetch_trades(self, exchange, exchange_id: str, extra_symbols: set
+                            ) -> Tuple[List[TradeData], Dict[str, int]]:
+        """Сделки по времени и новые курсоры потоков."""
+        if not exchange.has.get('fetchMyTrades'):
+            return [], {}
+        symbols = set(config.SYNC_SYMBOLS) | extra_symbols | {
+            s[len('trades:'):] for s in self.cursors.streams(exchange_id) if s.startswith('trades:')}
+        if getattr(exchange, 'markets', None):
+            symbols = {s for s in symbols if s == ALL_SYMBOLS or s in exchange.markets}
+        if not symbols:
+            # Без списка пар пробуем запрос по всем парам (поддерживается не всеми биржами)
+            symbols = {ALL_SYMBOLS}
+        fetched: List[TradeData] = []
+        cursors: Dict[str, int] = {}
+        for symbol in sorted(symbols):
+            stream = f"trades:{symbol}"
+            since = self.cursors.get(exchange_id, stream) or self._initial_since()
+            query_symbol = None if symbol == ALL_SYMBOLS else symbol
+            try:
+                raw = await paginate(
+                    lambda s, limit: exchange.fetch_my_trades(query_symbol, s, limit), since, self.page_limit)
+            except ccxt_async.ArgumentsRequired:
+                raise ValueError(f"{exchange_id} требует символ для fetch_my_trades: задайте SYNC_SYMBOLS.")
+            for r in raw:
+                trade = trade_from_ccxt(exchange_id, r)
+                if trade:
+                    fetched.append(trade)
+            cursors[stream] = _next_cursor(raw, since)
+        return sorted(fetched, key=lambda t: t.timestamp), cursors
+
+    async def _ingest(self, ingest: IngestFunc, items: List[Any], report: SyncReport) -> bool:
+        """
+        Пакетная запись в отдельном потоке. False - запись не удалась по временной
+        причине (таблица, журнал), курсоры не сдвигаются. Окончательно отклоненные
+        записи только попадают в отчет.
+        """
+        if not items:
+            return True
+        results = await asyncio.to_thread(ingest, items)
+        retry = False
+        for result in results:
+            if result.success:
+                report.accepted += 1
+            elif result.duplicate:
+                report.duplicates += 1
+            elif result.message in RETRYABLE_MESSAGES:
+                retry = True
+            else:
+                rejected = f"{_describe(items[result.index])}: {result.message}"
+                logger.warning(f"Синхронизация {report.exchange}: запись отклонена и пропущена: {rejected}")
+                report.rejected.append(rejected)
+        if retry:
+            report.error = "Таблица недоступна, записи будут запрошены повторно."
+        return not retry
+
+
+async def run_forever(syncer: ExchangeSyncer, interval_seconds: Optional[int] = None) -> None:
+    interval = interval_seconds or config.SYNC_INTERVAL_SECONDS
+    while True:
+        await syncer.sync_all()
+        await asyncio.sleep(interval)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Синхронизация сделок и движений с бирж.")
+    parser.add_argument('--exchanges', help="Биржи через запятую (по умолчанию SYNC_EXCHANGES)")
+    parser.add_argument('--once', action='store_true', help="Один проход вместо периодического запуска")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=config.LOG_LEVEL,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    exchange_ids = [e.strip() for e in args.exchanges.split(',')] if args.exchanges else None
+    syncer = ExchangeSyncer(exchange_ids=exchange_ids)
+    if not syncer.exchange_ids:
+        parser.error("Не заданы биржи: SYNC_EXCHANGES или --exchanges.")
+    if args.once:
+        for report in asyncio.run(syncer.sync_all()):
+            print(report)
+    else:
+        asyncio.run(run_forever(syncer))
+
+
+if __name__ == '__main__':
+    main()
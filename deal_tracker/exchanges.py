@@ -1,7 +1,42 @@
 # exchanges.py
-import ccxt
+"""
+Ленивый реестр синхронных клиентов CCXT.
+Экземпляры создаются при первом обращении и стартуют с рынками из дискового кэша,
+поэтому импорт модуля не инициализирует ни одной биржи.
+"""
+import logging
+from collections.abc import Mapping
+from typing import Dict, Iterator, List
 
-supported_exchanges = {
-    "binance": ccxt.binance(),
-    "bybit": ccxt.bybit(),
-}
+import market_cache
+
+logger = logging.getLogger(__name__)
+
+
+class LazyExchangeRegistry(Mapping):
+    """Отображение имя биржи -> клиент CCXT, создаваемый по требованию."""
+
+    def __init__(self, names: List[str]):
+        self._names = [n.lower() for n in names]
+        self._instances: Dict[str, object] = {}
+
+    def __getitem__(self, name: str):
+        key = name.lower()
+        if key not in self._names:
+            raise KeyError(name)
+        if key not in self._instances:
+            import ccxt
+            exchange = getattr(ccxt, key)()
+            market_cache.ensure_markets(exchange)
+            self._instances[key] = exchange
+            logger.info(f"Инициализирован клиент CCXT для {key}")
+        return self._instances[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
+supported_exchanges = LazyExchangeRegistry(["binance", "bybit"])
@@ -0,0 +1,292 @@
+# deal_tracker/ledger_locks.py
+"""
+Блокировки учета, работающие между потоками и процессами (бот, дашборд, скрипты).
+
+- Блокировки по ключу (счет, актив): операции над несвязанными счетами идут
+  параллельно, над одним и тем же счетом - строго по очереди. Ключи всегда
+  захватываются в отсортированном порядке, поэтому взаимоблокировки невозможны.
+  Файл блокировки ключа хранит метку версии: ее меняет каждый, кто записал
+  этот ключ, и по ней процесс понимает, что его копия баланса устарела.
+- Короткие именованные блокировки (выделение строк, журнал записи).
+- Разделяемая/исключительная блокировка состояния внутри процесса: полная
+  перезагрузка состояния не должна идти одновременно с операциями.
+
+Между процессами используется fcntl.flock; где его нет (Windows), блокировки
+действуют только между потоками одного процесса.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from contextlib import ExitStack, contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+import config
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BalanceKey = Tuple[str, str]  # (account_name.lower(), ASSET)
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+if fcntl is None:
+    logger.warning("fcntl недоступен: блокировки учета действуют только внутри процесса.")
+
+
+def _locks_dir() -> str:
+    return os.path.join(config.STATE_DIR, 'locks')
+
+
+def _thread_lock(name: str) -> threading.Lock:
+    with _thread_locks_guard:
+        if name not in _thread_locks:
+            _thread_locks[name] = threading.Lock()
+        return _thread_locks[name]
+
+
+@contextmanager
+def _locked_file(name: str, shared: bool = False) -> Iterator[TextIO]:
+    """Файл блокировки name (r+) под flock процесса: разделяемым или исключительным."""
+    os.makedirs(_locks_dir(), exist_ok=True)
+    path = os.path.join(_locks_dir(), f"{name}.lock")
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+', encoding='utf-8') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(name: str) -> Iterator[TextIO]:
+    """
+    Именованная блокировка: сначала между потоками, затем между процессами.
+    Возвращает открытый файл блокировки (r+) для чтения/записи его содержимого.
+    """
+    with _thread_lock(name):
+        with _locked_file(name) as f:
+            yield f
+
+
+def _read_content(f: TextIO) -> Dict:
+    f.seek(0)
+    raw = f.read()
+    if not raw.strip():
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return {}
+
+
+def _write_content(f: TextIO, content: Dict) -> None:
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(content, ensure_ascii=False))
+    f.flush()
+
+
+# --- Блокировки по ключу (счет, актив) ---
+
+
+def _key_lock_name(key: BalanceKey) -> str:
+    return 'key__' + re.sub(r'[^A-Za-z0-9_.-]', '_', f"{key[0]}__{key[1]}")
+
+
+def _new_version(key: BalanceKey) -> Dict[str, str]:
+    return {'account': key[0], 'asset': key[1], 'version': uuid.uuid4().hex}
+
+
+class LockedKeys:
+    """Захваченные ключи и их метки версий."""
+
+    def __init__(self):
+        self.versions: Dict[BalanceKey, str] = {}
+        self._files: Dict[BalanceKey, TextIO] = {}
+
+    def reload_versions(self) -> Dict[BalanceKey, str]:
+        """Перечитывает метки (их мог сменить процесс, повторно применивший журнал)."""
+        for key, f in self._files.items():
+            self.versions[key] = str(_read_content(f).get('version', ''))
+        return self.versions
+
+    def bump(self) -> Dict[BalanceKey, str]:
+        """Выдает ключам новые метки версий после записи. Возвращает новые метки."""
+        for key, f in self._files.items():
+            content = _new_version(key)
+            _write_content(f, content)
+            self.versions[key] = content['version']
+        return dict(self.versions)
+
+
+@contextmanager
+def account_locks(keys: Iterable[BalanceKey]) -> Iterator[LockedKeys]:
+    """Захватывает блокировки ключей (счет, актив) в отсортированном порядке."""
+    locked = LockedKeys()
+    with ExitStack() as stack:
+        for key in sorted(set(keys)):
+            locked._files[key] = stack.enter_context(file_lock(_key_lock_name(key)))
+        locked.reload_versions()
+        yield locked
+
+
+def touch_keys(keys: Iterable[BalanceKey]) -> None:
+    """
+    Меняет метки версий ключей без захвата их блокировок. Используется при повторном
+    применении журнала: держатели этих ключей перечитывают метки после replay.
+    """
+    os.makedirs(_locks_dir(), exist_ok=True)
+    for key in set(keys):
+        path = os.path.join(_locks_dir(), f"{_key_lock_name(key)}.lock")
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(_new_version(key), ensure_ascii=False))
+        except OSError as e:
+            logger.warning(f"Не удалось обновить версию ключа {key}: {e}")
+
+
+def read_all_versions() -> Dict[BalanceKey, str]:
+    """Метки версий всех известных ключей (без блокировок; используется при полной загрузке)."""
+    versions: Dict[BalanceKey, str] = {}
+    try:
+        names = os.listdir(_locks_dir())
+    except FileNotFoundError:
+        return versions
+    for name in names:
+        if not name.startswith('key__'):
+            continue
+        try:
+            with open(os.path.join(_locks_dir(), name), 'r', encoding='utf-8') as f:
+                content = json.loads(f.read() or '{}')
+        except (OSError, ValueError):
+            continue
+        if content.get('account') and content.get('asset'):
+            versions[(content['account'], content['asset'])] = str(content.get('version', ''))
+    return versions
+
+
+# --- Выделение номеров строк ---
+
+
+def allocate_rows(sheet_name: str, count: int, local_next_row: int) -> int:
+    """
+    Резервирует count строк листа подряд и возвращает номер первой. Учитываются
+    и строки, зарезервированные другими процессами, и известные этому процессу.
+    """
+    with file_lock('row_counters') as f:
+        counters = _read_content(f)
+        first_row = max(int(counters.get(sheet_name, 0)), local_next_row)
+        counters[sheet_name] = first_row + count
+        _write_content(f, counters)
+    return first_row
+
+
+def reset_row_counters(sheet_names: Iterable[str]) -> None:
+    """Сбрасывает счетчики строк листов (после перестройки или сжатия листа)."""
+    with file_lock('row_counters') as f:
+        counters = _read_content(f)
+        for name in sheet_names:
+            counters.pop(name, None)
+        _write_content(f, counters)
+
+
+_layout_locks: Dict[str, '_SharedExclusiveLock'] = {}
+
+
+@contextmanager
+def sheet_layout(sheet_name: str, change: bool = False) -> Iterator[str]:
+    """
+    Блокировка расположения строк листа. Те, кто пишет строки по известным
+    номерам (запись учета, price_updater) или только читает метку, держат ее
+    разделяемой; те, кто сдвигает строки (сжатие, перестройка; change=True),
+    - исключительной, и метка расположения меняется. Возвращает метку,
+    действующую на момент захвата.
+    """
+    name = 'layout__' + re.sub(r'[^A-Za-z0-9_.-]', '_', sheet_name)
+    with _thread_locks_guard:
+        thread_lock = _layout_locks.setdefault(name, _SharedExclusiveLock())
+    with thread_lock.exclusive() if change else thread_lock.shared():
+        with _locked_file(name, shared=not change) as f:
+            yield str(_read_content(f).get('version', ''))
+            if change:
+                _write_content(f, {'version': uuid.uuid4().hex})
+
+
+# --- Метки изменения данных ---
+
+# Меняется price_updater после каждой записи цен в Open_Positions
+PRICES_MARKER = 'prices'
+
+
+def _marker_name(name: str) -> str:
+    return 'marker__' + re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+
+def read_marker(name: str) -> str:
+    """Текущая метка данных name (пустая строка, если ее еще не меняли)."""
+    with file_lock(_marker_name(name)) as f:
+        return str(_read_content(f).get('version', ''))
+
+
+def bump_marker(name: str) -> None:
+    """Выдает данным name новую метку: читатели по ней сбрасывают свои кэши."""
+    with file_lock(_marker_name(name)) as f:
+        _write_content(f, {'version': uuid.uuid4().hex})
+
+
+# --- Разделяемая/исключительная блокировка состояния процесса ---
+
+
+class _SharedExclusiveLock:
+    """Много операций одновременно либо одна полная перезагрузка состояния."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._cond:
+            while self._exclusive or self._shared:
+                self._cond.wait()
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+state_lock = _SharedExclusiveLock()
+
+
+def balance_keys_for(pairs: Iterable[Tuple[Optional[str], Optional[str]]]) -> List[BalanceKey]:
+    """Нормализует пары (счет, актив) в ключи, пропуская неполные."""
+    return sorted({(account.strip().lower(), asset.strip().upper())
+                   for account, asset in pairs if account and asset})
@@ -0,0 +1,386 @@
+# deal_tracker/ledger_rebuild.py
+"""
+Полная перестройка Account_Balances и Open_Positions из первичных листов.
+
+Балансы и позиции - производные данные: trade_logger поддерживает их
+инкрементально, и после ручных правок таблицы или частичных сбоев они
+расходятся с историей. Перестройка читает Core_Trades и Fund_Movements
+(по одному чтению листа), сливает их в порядке времени (heapq.merge) и за один
+линейный проход пересчитывает балансы, объемы позиций и средние цены входа
+по тем же правилам, что и trade_logger. Результат записывается обоими листами
+одним запросом values_batch_update. Если какой-либо лист не прочитался или
+история пуста при непустых балансах, перестройка отменяется без записи.
+
+Здесь же сжатие Open_Positions: закрытые позиции остаются строками-метками
+(is_closed), а compact_positions периодически удаляет их одним запросом.
+
+Запуск (например, по ночам из cron):
+    python ledger_rebuild.py [--dry-run]
+    python ledger_rebuild.py --compact
+"""
+import argparse
+import heapq
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import config
+import ledger_locks
+import sheets_service
+import utils
+from ledger_state import (BalanceKey, PositionKey, balance_key, exclusive_ledger, position_key, position_lock_key,
+                          replay_journal)
+from models import TradeData, MovementData, PositionData, BalanceData
+
+logger = logging.getLogger(__name__)
+
+# Порог "нулевого" остатка позиции, как в trade_logger._sync_open_position
+ZERO_THRESHOLD = Decimal('1e-8')
+# Сколько раз повторить, если во время захвата блокировок появились новые счета
+MAX_LOCK_ATTEMPTS = 3
+JOURNAL_PENDING_MESSAGE = "В журнале есть неприменённые записи, таблица недоступна."
+
+
+@dataclass
+class RebuildResult:
+    """Пересчитанные балансы и позиции и статистика прохода."""
+    balances: Dict[BalanceKey, Decimal] = field(default_factory=dict)
+    positions: Dict[PositionKey, Tuple[Decimal, Decimal]] = field(default_factory=dict)
+    trades: int = 0
+    movements: int = 0
+    skipped: int = 0
+
+
+def _sort_key(timestamp: Optional[datetime]) -> datetime:
+    if timestamp is None:
+        return datetime.min
+    return timestamp.replace(tzinfo=None)
+
+
+def merge_by_time(trades: List[TradeData],
+                  movements: List[MovementData]) -> Iterator[Union[TradeData, MovementData]]:
+    """
+    Поток записей обоих листов в порядке времени. Листы почти упорядочены,
+    поэтому сортировка каждого из них близка к линейной. При равном времени
+    движение идет раньше сделки (пополнение до покупки).
+    """
+    movement_stream = ((_sort_key(m.timestamp), 0, i, m) for i, m in
+                       enumerate(sorted(movements, key=lambda m: _sort_key(m.timestamp))))
+    trade_stream = ((_sort_key(t.timestamp), 1, i, t) for i, t in
+                    enumerate(sorted(trades, key=lambda t: _sort_key(t.timestamp))))
+    for _, _, _, record in heapq.merge(movement_stream, trade_stream):
+        yield record
+
+
+def _apply_movement(movement: MovementData, result: RebuildResult) -> bool:
+    if not movement.asset or not movement.amount or movement.amount <= 0:
+        return False
+    asset = movement.asset.strip().upper()
+    if movement.source_name:
+        key = balance_key(movement.source_name, asset)
+        result.balances[key] = result.balances.get(key, Decimal('0')) - movement.amount
+    if movement.destination_name:
+        key = balance_key(movement.destination_name, asset)
+        result.balances[key] = result.balances.get(key, Decimal('0')) + movement.amount
+    return True
+
+
+def _apply_trade(trade: TradeData, result: RebuildResult) -> bool:
+    symbol = (trade.symbol or '').strip().upper()
+    trade_type = (trade.trade_type or '').strip().upper()
+    if symbol.count('/') != 1 or trade_type not in ('BUY', 'SELL') or not trade.exchange \
+            or not trade.amount or trade.amount <= 0 or trade.price is None:
+        return False
+    base_asset, quote_asset = symbol.split('/')
+    exchange = trade.exchange.strip().lower()
+    total_quote = trade.total_quote_amount if trade.total_quote_amount is not None else trade.amount * trade.price
+    commission_asset = (trade.commission_asset or '').strip().upper()
+
+    changes: List[Tuple[str, Decimal]] = []
+    if trade_type == 'BUY':
+        quote_change = -total_quote
+        if trade.commission and commission_asset == quote_asset:
+            quote_change -= trade.commission
+        changes += [(quote_asset, quote_change), (base_asset, trade.amount)]
+        if trade.commission and commission_asset and commission_asset != quote_asset:
+            changes.append((commission_asset, -trade.commission))
+    else:
+        changes += [(base_asset, -trade.amount), (quote_asset, total_quote)]
+    for asset, change in changes:
+        key = balance_key(exchange, asset)
+        result.balances[key] = result.balances.get(key, Decimal('0')) + change
+
+    # Позиция следует за балансом базового актива, средняя меняется только покупками
+    pos_key = position_key(symbol, exchange)
+    net_amount = result.balances.get(balance_key(exchange, base_asset), Decimal('0'))
+    existing = result.positions.get(pos_key)
+    if net_amount <= ZERO_THRESHOLD:
+        result.positions.pop(pos_key, None)
+    elif trade_type == 'BUY':
+        avg_price = trade.price
+        if existing and existing[0] > 0:
+            avg_price = (existing[0] * existing[1] + trade.amount * trade.price) / net_amount
+        result.positions[pos_key] = (net_amount, avg_price)
+    elif existing:
+        result.positions[pos_key] = (net_amount, existing[1])
+    return True
+
+
+def replay(records: Iterable[Union[TradeData, MovementData]]) -> RebuildResult:
+    """Пересчитывает балансы и позиции за один проход по записям в порядке времени."""
+    result = RebuildResult()
+    for record in records:
+        if isinstance(record, TradeData):
+            applied = _apply_trade(record, result)
+            result.trades += applied
+        else:
+            applied = _apply_movement(record, result)
+            result.movements += applied
+        result.skipped += not applied
+    return result
+
+
+@dataclass
+class _LedgerInputs:
+    trades: List[TradeData]
+    movements: List[MovementData]
+    old_balances: List[BalanceData]
+    old_positions: List[PositionData]
+
+
+def _read_inputs() -> Tuple[Optional[_LedgerInputs], str]:
+    """
+    История и текущие листы учета. Любая ошибка чтения прерывает перестройку:
+    пустая история вместо недочитанной обнулила бы все балансы и позиции.
+    """
+    sheets = {
+        'trades': (config.CORE_TRADES_SHEET_NAME, TradeData),
+        'movements': (config.FUND_MOVEMENTS_SHEET_NAME, MovementData),
+        'old_balances': (config.ACCOUNT_BALANCES_SHEET_NAME, BalanceData),
+        'old_positions': (config.OPEN_POSITIONS_SHEET_NAME, PositionData),
+    }
+    values = {}
+    for name, (sheet_name, model_cls) in sheets.items():
+        records = sheets_service.read_all_records(sheet_name, model_cls)
+        if records is None:
+            return None, f"Не удалось прочитать лист '{sheet_name}', перестройка отменена."
+        values[name] = records
+    values['old_positions'] = [p for p in values['old_positions'] if not p.is_closed]
+    inputs = _LedgerInputs(**values)
+    if not inputs.trades and not inputs.movements and (inputs.old_balances or inputs.old_positions):
+        return None, ("История операций пуста, а балансы и позиции - нет: перестройка отменена, "
+                      "чтобы не обнулить учет. Проверьте листы Core_Trades и Fund_Movements.")
+    return inputs, ""
+
+
+def _keys_of(result: RebuildResult, balances: List[BalanceData], positions: List[PositionData]) -> Set[BalanceKey]:
+    keys = set(result.balances)
+    keys.update(position_lock_key(k) for k in result.positions)
+    keys.update(balance_key(b.account_name, b.asset) for b in balances if b.account_name and b.asset)
+    keys.update(position_lock_key(position_key(p.symbol, p.exchange)) for p in positions if p.symbol and p.exchange)
+    return keys
+
+
+def _build_rows(result: RebuildResult, old_positions: List[PositionData]) -> Tuple[List[BalanceData], List[PositionData]]:
+    now = datetime.now()
+    balances = [BalanceData(account_name=account, asset=asset, balance=value,
+                            entity_type=utils.determine_entity_type(account), last_updated=now)
+                for (account, asset), value in sorted(result.balances.items())]
+    # Текущая цена поддерживается price_updater; сохраняем ее и пересчитываем PNL
+    prices = {position_key(p.symbol, p.exchange): p.current_price
+              for p in old_positions if p.symbol and p.exchange}
+    positions = []
+    for (symbol, exchange), (net_amount, avg_price) in sorted(result.positions.items()):
+        current_price = prices.get((symbol, exchange))
+        positions.append(PositionData(
+            symbol=symbol, exchange=exchange, net_amount=net_amount, avg_entry_price=avg_price,
+            current_price=current_price,
+            unrealized_pnl=(current_price - avg_price) * net_amount if current_price is not None else None,
+            last_updated=now))
+    return balances, positions
+
+
+def _replace_sheet_batch(sheet_name: str, records: List, old_last_row: int) -> Tuple[List[Dict], int]:
+    """Элементы пакета, заменяющие строки листа начиная со второй; лишние старые строки очищаются."""
+    for offset, record in enumerate(records):
+        record.row_number = 2 + offset
+    last_row = 1 + len(records)
+    data = []
+    if records:
+        data.append(sheets_service.build_rows_update(sheet_name, records))
+    if old_last_row > last_row:
+        data.append(sheets_service.build_blank_rows_update(sheet_name, last_row + 1, old_last_row))
+    return data, max(last_row, old_last_row)
+
+
+def _summarize(old_balances: List[BalanceData], old_positions: List[PositionData],
+               balances: List[BalanceData], positions: List[PositionData]) -> str:
+    old_b = {balance_key(b.account_name, b.asset): b.balance or Decimal('0')
+             for b in old_balances if b.account_name and b.asset}
+    new_b = {balance_key(b.account_name, b.asset): b.balance for b in balances}
+    changed_b = sum(1 for k in set(old_b) | set(new_b)
+                    if old_b.get(k, Decimal('0')) != new_b.get(k, Decimal('0')))
+    old_p = {position_key(p.symbol, p.exchange): (p.net_amount, p.avg_entry_price)
+             for p in old_positions if p.symbol and p.exchange and p.net_amount}
+    new_p = {position_key(p.symbol, p.exchange): (p.net_amount, p.avg_entry_price) for p in positions}
+    changed_p = sum(1 for k in set(old_p) | set(new_p) if old_p.get(k) != new_p.get(k))
+    return (f"балансов {len(balances)} (изменится {changed_b}), "
+            f"позиций {len(positions)} (изменится {changed_p})")
+
+
+def rebuild_ledger(dry_run: bool = False) -> Tuple[bool, str]:
+    """
+    Пересчитывает Account_Balances и Open_Positions из истории и перезаписывает их.
+    Блокирует все затронутые ключи (счет, актив): операции над ними ждут перестройки.
+    """
+    started = time.monotonic()
+    inputs, error = _read_inputs()
+    if inputs is None:
+        logger.error(error)
+        return False, error
+    result = replay(merge_by_time(inputs.trades, inputs.movements))
+    keys = _keys_of(result, inputs.old_balances, inputs.old_positions)
+
+    if dry_run:
+        balances, positions = _build_rows(result, inputs.old_positions)
+        message = (f"Проверка без записи: сделок {result.trades}, движений {result.movements}, "
+                   f"пропущено {result.skipped}; "
+                   f"{_summarize(inputs.old_balances, inputs.old_positions, balances, positions)}. "
+                   f"Время {time.monotonic() - started:.1f} с.")
+        logger.info(message)
+        return True, message
+
+    snapshot = {}
+
+    def locked_keys() -> Set[BalanceKey]:
+        # Перечитываем под блокировками: операции, начатые до захвата, уже записаны
+        snapshot['inputs'], snapshot['error'] = _read_inputs()
+        if snapshot['inputs'] is None:
+            return set()
+        locked = snapshot['inputs']
+        snapshot['result'] = replay(merge_by_time(locked.trades, locked.movements))
+        return _keys_of(snapshot['result'], locked.old_balances, locked.old_positions)
+
+    def write() -> Tuple[bool, str]:
+        if snapshot['inputs'] is None:
+            logger.error(snapshot['error'])
+            return False, snapshot['error']
+        return _write(snapshot['result'], snapshot['inputs'].old_balances,
+                      snapshot['inputs'].old_positions, started)
+
+    return _run_exclusive(keys, locked_keys, write)
+
+
+def _run_exclusive(keys: Set[BalanceKey], locked_keys: Callable[[], Set[BalanceKey]],
+                   action: Callable[[], Tuple[bool, str]]) -> Tuple[bool, str]:
+    """
+    Выполняет action под exclusive_ledger(keys). locked_keys() вызывается уже под
+    блокировками; если он вернул ключи вне захваченных (появились новые счета или
+    позиции), блокировки захватываются заново с расширенным набором.
+    """
+    for _ in range(MAX_LOCK_ATTEMPTS):
+        try:
+            with exclusive_ledger(keys):
+                missing = locked_keys() - keys
+                if missing:
+                    keys |= missing
+                    continue
+                return action()
+        except RuntimeError as e:
+            logger.error(f"Операция над учетом не выполнена: {e}")
+            return False, str(e)
+    return False, "Во время операции постоянно появляются новые счета, повторите позже."
+
+
+def _write(result: RebuildResult, old_balances: List[BalanceData], old_positions: List[PositionData],
+           started: float) -> Tuple[bool, str]:
+    balances, positions = _build_rows(result, old_positions)
+    summary = _summarize(old_balances, old_positions, balances, positions)
+    data, capacity = [], {}
+    for sheet_name, records, old_records in (
+            (config.ACCOUNT_BALANCES_SHEET_NAME, balances, old_balances),
+            (config.OPEN_POSITIONS_SHEET_NAME, positions, old_positions)):
+        old_last_row = sheets_service.get_last_row_number(sheet_name)
+        if old_last_row is None:
+            return False, f"Не удалось определить размер листа '{sheet_name}'."
+        old_last_row = max([old_last_row] + [r.row_number or 1 for r in old_records])
+        sheet_data, capacity[sheet_name] = _replace_sheet_batch(sheet_name, records, old_last_row)
+        data += sheet_data
+    if None in data:
+        return False, "Не удалось прочитать заголовки листов балансов и позиций."
+    for sheet_name, last_row in capacity.items():
+        if not sheets_service.ensure_row_capacity(sheet_name, last_row):
+            return False, f"Не удалось расширить лист '{sheet_name}'."
+    # Строки позиций переставляются: price_updater и запись учета не должны писать по старым номерам
+    with ledger_locks.sheet_layout(config.OPEN_POSITIONS_SHEET_NAME, change=True):
+        if not replay_journal(layout_locked=True):
+            return False, JOURNAL_PENDING_MESSAGE
+        if not sheets_service.values_batch_update(data):
+            return False, "Ошибка записи пересчитанных балансов и позиций."
+    ledger_locks.reset_row_counters([config.ACCOUNT_BALANCES_SHEET_NAME, config.OPEN_POSITIONS_SHEET_NAME])
+    message = (f"Учет перестроен: сделок {result.trades}, движений {result.movements}, "
+               f"пропущено {result.skipped}; {summary}. Время {time.monotonic() - started:.1f} с.")
+    logger.info(message)
+    return True, message
+
+
+def _open_position_keys() -> Set[BalanceKey]:
+    return {position_lock_key(position_key(p.symbol, p.exchange))
+            for p in sheets_service.get_all_open_positions() if p.symbol and p.exchange}
+
+
+def compact_positions(min_rows: Optional[int] = None) -> Tuple[bool, str]:
+    """
+    Физически удаляет из Open_Positions строки закрытых позиций и пустые строки
+    одним запросом. Удаление сдвигает строки, поэтому выполняется под блокировками
+    всех открытых позиций и исключительной блокировкой расположения листа: запись
+    учета по любым ключам держит ее разделяемой и после сжатия перечитывает номера
+    строк позиций по новой метке расположения. Пакеты журнала, отпущенные, пока
+    сжатие ждало блокировку, применяются до сдвига строк.
+    """
+    sheet_name = config.OPEN_POSITIONS_SHEET_NAME
+    threshold = config.POSITIONS_COMPACTION_MIN_ROWS if min_rows is None else min_rows
+    rows = sheets_service.find_compactable_position_rows()
+    if rows is None:
+        return False, "Не удалось прочитать лист позиций."
+    if not rows or len(rows) < threshold:
+        return True, f"Сжатие листа позиций не требуется: строк к удалению {len(rows)}."
+
+    def compact() -> Tuple[bool, str]:
+        with ledger_locks.sheet_layout(sheet_name, change=True):
+            if not replay_journal(layout_locked=True):
+                return False, JOURNAL_PENDING_MESSAGE
+            locked_rows = sheets_service.find_compactable_position_rows()
+            if locked_rows is None:
+                return False, "Не удалось прочитать лист позиций."
+            if not sheets_service.delete_rows_batch(sheet_name, locked_rows):
+                return False, "Ошибка удаления строк закрытых позиций."
+        ledger_locks.reset_row_counters([sheet_name])
+        message = f"Лист позиций сжат: удалено строк {len(locked_rows)}."
+        logger.info(message)
+        return True, message
+
+    return _run_exclusive(_open_position_keys(), _open_position_keys, compact)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Перестройка балансов и позиций из истории операций.")
+    parser.add_argument('--dry-run', action='store_true', help="Только посчитать и показать изменения")
+    parser.add_argument('--compact', action='store_true',
+                        help="Только удалить строки закрытых позиций из Open_Positions")
+    args = parser.parse_args()
+    logging.basicConfig(level=config.LOG_LEVEL,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.compact:
+        success, message = compact_positions(min_rows=1)
+    else:
+        success, message = rebuild_ledger(dry_run=args.dry_run)
+    print(message)
+    raise SystemExit(0 if success else 1)
+
+
+if __name__ == '__main__':
+    main()
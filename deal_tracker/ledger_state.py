@@ -0,0 +1,545 @@
+# deal_tracker/ledger_state.py
+"""
+In-memory состояние учета: балансы и открытые позиции.
+Загружается из Account_Balances и Open_Positions один раз, затем изменяется
+на месте по мере логирования операций и записывается обратно только дельтами
+(измененные, новые и закрытые строки). Пока состояние "теплое", операции
+trade_logger не читают таблицу вообще.
+
+Все изменения одной операции (новые строки Core_Trades/Fund_Movements, балансы,
+позиции) уходят одним запросом values_batch_update. Номера новых строк
+назначаются здесь же, а пакет предварительно сохраняется в write_journal,
+чтобы при сбое его можно было применить повторно: перед следующей операцией
+или в фоне (schedule_journal_replay), если операций долго нет.
+
+Номера новых строк выдает счетчик ledger_locks, а не чтение листа: строки,
+добавленные в Core_Trades, Fund_Movements, Account_Balances или Open_Positions
+вручную, до перезагрузки состояния (LEDGER_STATE_TTL_SECONDS) не видны и могут
+быть перезаписаны. Поэтому эти листы вручную не дополняются: операции вносятся
+командами бота, /batch или csv_import.
+
+Состояние общее для потоков процесса, а несохраненные изменения у каждого
+потока свои. Согласованность между процессами обеспечивают ledger_locks:
+операция держит блокировки своих ключей (счет, актив), а перед проверкой
+балансов sync_keys перечитывает из таблицы ключи, чья метка версии сменилась.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import config
+import ledger_locks
+import sheets_service
+import write_journal
+from models import BalanceData, PositionData
+
+logger = logging.getLogger(__name__)
+
+BalanceKey = Tuple[str, str]   # (account_name.lower(), ASSET)
+PositionKey = Tuple[str, str]  # (SYMBOL, exchange.lower())
+
+
+def balance_key(account_name: str, asset: str) -> BalanceKey:
+    return account_name.strip().lower(), asset.strip().upper()
+
+
+def position_key(symbol: str, exchange: str) -> PositionKey:
+    return symbol.strip().upper(), exchange.strip().lower()
+
+
+def position_lock_key(key: PositionKey) -> BalanceKey:
+    """Позиция защищена блокировкой баланса базового актива на своей бирже."""
+    return key[1], key[0].split('/')[0]
+
+
+class LedgerState:
+    """Балансы и позиции в словарях с отслеживанием несохраненных изменений."""
+
+    def __init__(self):
+        self.balances: Dict[BalanceKey, BalanceData] = {}
+        self.positions: Dict[PositionKey, PositionData] = {}
+        self.loaded_at: Optional[float] = None
+        # Метки версий ключей, которым соответствуют значения в памяти. Ключ без метки
+        # (его еще никто не записывал под блокировкой) достоверен, пока _trust_unversioned
+        self.versions: Dict[BalanceKey, Optional[str]] = {}
+        self._trust_unversioned = False
+        self._next_rows: Dict[str, int] = {}
+        self._rows_lock = threading.Lock()
+        # Метка расположения строк Open_Positions, которой соответствуют номера строк позиций
+        self.layout_version: Optional[str] = None
+        # Закрытые, но еще не записанные позиции (всех потоков): их номера строк
+        # тоже обновляются, если лист позиций сжали
+        self._closing: Dict[PositionKey, PositionData] = {}
+        self._local = threading.local()
+
+    # --- Несохраненные изменения текущего потока ---
+
+    def _pending(self) -> threading.local:
+        local = self._local
+        if not hasattr(local, 'dirty_balances'):
+            local.dirty_balances = set()
+            local.dirty_positions = set()
+            local.closed_positions = []
+            local.records = []
+            local.last_flush_journaled = False
+        return local
+
+    @property
+    def _dirty_balances(self) -> Set[BalanceKey]:
+        return self._pending().dirty_balances
+
+    @property
+    def _dirty_positions(self) -> Set[PositionKey]:
+        return self._pending().dirty_positions
+
+    @property
+    def _closed_positions(self) -> List[PositionData]:
+        return self._pending().closed_positions
+
+    @property
+    def _pending_records(self) -> List[Tuple[str, Any]]:
+        return self._pending().records
+
+    # --- Загрузка и актуальность ---
+
+    def load(self) -> None:
+        """Полностью перечитывает балансы и позиции из таблицы."""
+        # Метки читаются до данных: запись между ними приведет лишь к лишнему sync_keys
+        self.versions = ledger_locks.read_all_versions()
+        with ledger_locks.sheet_layout(config.OPEN_POSITIONS_SHEET_NAME) as layout_version:
+            self.layout_version = layout_version
+        self._trust_unversioned = True
+        self._local = threading.local()
+        self._closing = {}
+        self.balances = {balance_key(b.account_name, b.asset): b
+                         for b in sheets_service.get_all_balances()
+                         if b.account_name and b.asset}
+        self.positions = {position_key(p.symbol, p.exchange): p
+                          for p in sheets_service.get_all_open_positions()
+                          if p.symbol and p.exchange}
+        self._next_rows = {
+            config.ACCOUNT_BALANCES_SHEET_NAME: max(
+                (b.row_number or 1 for b in self.balances.values()), default=1) + 1,
+        }
+        # Строки закрытых позиций остаются занятыми до сжатия листа
+        for sheet_name in (config.OPEN_POSITIONS_SHEET_NAME, config.CORE_TRADES_SHEET_NAME,
+                           config.FUND_MOVEMENTS_SHEET_NAME):
+            last_row = sheets_service.get_last_row_number(sheet_name)
+            if last_row is None:
+                raise RuntimeError(f"Не удалось определить размер листа '{sheet_name}'.")
+            self._next_rows[sheet_name] = last_row + 1
+        self.loaded_at = time.monotonic()
+        logger.info(
+            f"Состояние учета загружено: {len(self.balances)} балансов, {len(self.positions)} позиций.")
+
+    def is_stale(self) -> bool:
+        if self.loaded_at is None:
+            return True
+        return time.monotonic() - self.loaded_at > config.LEDGER_STATE_TTL_SECONDS
+
+    def invalidate(self) -> None:
+        """Сбрасывает состояние; следующее обращение перечитает таблицу."""
+        self.loaded_at = None
+
+    def sync_keys(self, versions: Dict[BalanceKey, str]) -> int:
+        """
+        Перечитывает из таблицы балансы и позиции захваченных ключей, чьи метки
+        версий отличаются от известных (их записал другой процесс). Вызывается
+        под блокировками этих ключей. Возвращает число обновленных ключей.
+        """
+        default = '' if self._trust_unversioned else None
+        stale = {key for key, version in versions.items() if self.versions.get(key, default) != version}
+        if not stale:
+            return 0
+        fresh_balances = {balance_key(b.account_name, b.asset): b
+                          for b in sheets_service.get_all_balances() if b.account_name and b.asset}
+        fresh_positions = {position_key(p.symbol, p.exchange): p
+                           for p in sheets_service.get_all_open_positions() if p.symbol and p.exchange}
+        for key in stale:
+            if key in fresh_balances:
+                self.balances[key] = fresh_balances[key]
+            else:
+                self.balances.pop(key, None)
+        for key in [k for k in list(self.positions) if position_lock_key(k) in stale]:
+            if key not in fresh_positions:
+                del self.positions[key]
+        for key, position in fresh_positions.items():
+            if position_lock_key(key) in stale:
+                self.positions[key] = position
+        with self._rows_lock:
+            for sheet_name, records in ((config.ACCOUNT_BALANCES_SHEET_NAME, fresh_balances.values()),
+                                        (config.OPEN_POSITIONS_SHEET_NAME, fresh_positions.values())):
+                last_row = max((r.row_number or 1 for r in records), default=1)
+                self._next_rows[sheet_name] = max(self._next_rows.get(sheet_name, 2), last_row + 1)
+        for key in stale:
+            self.versions[key] = versions[key]
+        logger.info(f"Обновлены из таблицы ключи, измененные другим процессом: {sorted(stale)}")
+        return len(stale)
+
+    def record_versions(self, versions: Dict[BalanceKey, str]) -> None:
+        """Запоминает метки ключей, записанных этим процессом."""
+        self.versions.update(versions)
+
+    def forget_versions(self, keys: Optional[Iterable[BalanceKey]] = None) -> None:
+        """Помечает значения ключей (или всех) недостоверными: sync_keys перечитает их."""
+        if keys is None:
+            self.versions.clear()
+            self._trust_unversioned = False
+            return
+        for key in keys:
+            self.versions[key] = None
+
+    # --- Чтение ---
+
+    def get_balance(self, account_name: str, asset: str) -> Decimal:
+        balance = self.balances.get(balance_key(account_name, asset))
+        if balance is None or balance.balance is None:
+            return Decimal('0')
+        return balance.balance
+
+    def get_position(self, symbol: str, exchange: str) -> Optional[PositionData]:
+        return self.positions.get(position_key(symbol, exchange))
+
+    # --- Изменения ---
+
+    def apply_balance_change(self, account_name: str, asset: str, change: Decimal) -> BalanceData:
+        key = balance_key(account_name, asset)
+        balance = self.balances.get(key)
+        if balance is None:
+            balance = BalanceData(account_name=key[0], asset=key[1], balance=Decimal('0'))
+            self.balances[key] = balance
+        balance.balance = (balance.balance or Decimal('0')) + change
+        balance.last_updated = datetime.now()
+        self._dirty_balances.add(key)
+        return balance
+
+    def upsert_position(self, position: PositionData) -> None:
+        key = position_key(position.symbol, position.exchange)
+        existing = self.positions.get(key)
+        if existing is not None and position.row_number is None:
+            position.row_number = existing.row_number
+        self.positions[key] = position
+        self._dirty_positions.add(key)
+
+    def close_position(self, symbol: str, exchange: str) -> Optional[PositionData]:
+        key = position_key(symbol, exchange)
+        position = self.positions.pop(key, None)
+        self._dirty_positions.discard(key)
+        if position is not None and position.row_number:
+            position.is_closed = True
+            position.closed_at = datetime.now()
+            position.last_updated = position.closed_at
+            self._closed_positions.append(position)
+            self._closing[key] = position
+        return position
+
+    def add_record(self, sheet_name: str, record: Any) -> None:
+        """Ставит новую запись (сделку, движение) в очередь на добавление в лист."""
+        self._pending_records.append((sheet_name, record))
+
+    def last_row_numbers(self, sheet_names) -> Dict[str, int]:
+        """Номера последних занятых строк листов с учетом уже записанных пакетов."""
+        return {name: self._next_rows[name] - 1 for name in sheet_names if name in self._next_rows}
+
+    def has_pending_changes(self) -> bool:
+        return bool(self._dirty_balances or self._dirty_positions or self._closed_positions
+                    or self._pending_records)
+
+    # --- Запись дельт ---
+
+    def _allocate_rows(self, sheet_name: str, count: int = 1) -> int:
+        """Резервирует строки через общий для процессов счетчик. Возвращает первую."""
+        with self._rows_lock:
+            first_row = ledger_locks.allocate_rows(sheet_name, count, self._next_rows[sheet_name])
+            self._next_rows[sheet_name] = first_row + count
+        return first_row
+
+    def _build_write_batch(self) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+        """Собирает все изменения в один пакет диапазонов и требуемые размеры листов."""
+        data: List[Dict[str, Any]] = []
+        capacity: Dict[str, int] = {}
+
+        def add(sheet_name: str, item: Optional[Dict[str, Any]], row_number: int) -> None:
+            if item:
+                data.append(item)
+                capacity[sheet_name] = max(capacity.get(sheet_name, 0), row_number)
+
+        # Новые строки одного листа идут подряд и пишутся одним диапазоном
+        new_rows: Dict[str, List[Any]] = {}
+        for sheet_name, record in self._pending_records:
+            new_rows.setdefault(sheet_name, []).append(record)
+        for sheet_name, records in new_rows.items():
+            first_row = self._allocate_rows(sheet_name, len(records))
+            for offset, record in enumerate(records):
+                record.row_number = first_row + offset
+            add(sheet_name, sheets_service.build_rows_update(sheet_name, records), records[-1].row_number)
+        sheet_name = config.ACCOUNT_BALANCES_SHEET_NAME
+        for key in sorted(self._dirty_balances):
+            balance = self.balances[key]
+            if not balance.row_number:
+                balance.row_number = self._allocate_rows(sheet_name)
+            add(sheet_name, sheets_service.build_row_update(sheet_name, balance), balance.row_number)
+        sheet_name = config.OPEN_POSITIONS_SHEET_NAME
+        for key in sorted(self._dirty_positions):
+            position = self.positions.get(key)
+            if position is None:
+                continue
+            if not position.row_number:
+                position.row_number = self._allocate_rows(sheet_name)
+            add(sheet_name, sheets_service.build_row_update(sheet_name, position), position.row_number)
+        # Закрытая позиция помечается, а не удаляется: номера остальных строк не сдвигаются
+        tombstones = sheets_service.has_field(sheet_name, 'is_closed')
+        for position in self._closed_positions:
+            if not position.row_number:
+                continue
+            if tombstones:
+                item = sheets_service.build_row_update(sheet_name, position)
+            else:
+                item = sheets_service.build_blank_row_update(sheet_name, position.row_number)
+            add(sheet_name, item, position.row_number)
+        return data, capacity
+
+    def _pending_keys(self) -> Set[BalanceKey]:
+        keys = set(self._dirty_balances)
+        keys.update(position_lock_key(k) for k in self._dirty_positions)
+        keys.update(position_lock_key(position_key(p.symbol, p.exchange)) for p in self._closed_positions)
+        return keys
+
+    def _clear_pending(self) -> None:
+        for position in self._closed_positions:
+            self._closing.pop(position_key(position.symbol, position.exchange), None)
+        self._dirty_balances.clear()
+        self._dirty_positions.clear()
+        self._closed_positions.clear()
+        self._pending_records.clear()
+
+    def discard_pending(self) -> None:
+        """
+        Отбрасывает несохраненные изменения потока. Значения в памяти уже изменены,
+        поэтому затронутые ключи помечаются недостоверными и перечитаются из таблицы.
+        """
+        keys = self._pending_keys()
+        self._clear_pending()
+        self.forget_versions(keys)
+
+    def last_flush_journaled(self) -> bool:
+        """Попал ли последний пакет этого потока в журнал (даже если запись не удалась)."""
+        return self._pending().last_flush_journaled
+
+    def _refresh_position_rows(self, layout_version: str) -> bool:
+        """
+        Строки Open_Positions сдвинуты сжатием или перестройкой: номера строк позиций
+        в памяти (и закрытых, еще не записанных) берутся из листа заново.
+        Вызывается под блокировкой расположения листа. False при ошибке чтения.
+        """
+        sheet_name = config.OPEN_POSITIONS_SHEET_NAME
+        fresh = sheets_service.read_all_records(sheet_name, PositionData)
+        last_row = sheets_service.get_last_row_number(sheet_name)
+        if fresh is None or last_row is None:
+            logger.error("Не удалось перечитать номера строк позиций после сдвига строк листа.")
+            return False
+        rows = {position_key(p.symbol, p.exchange): p.row_number
+                for p in fresh if p.symbol and p.exchange and not p.is_closed}
+        for key, position in list(self.positions.items()) + list(self._closing.items()):
+            position.row_number = rows.get(key)
+        with self._rows_lock:
+            self._next_rows[sheet_name] = last_row + 1
+        self.layout_version = layout_version
+        logger.info("Номера строк позиций обновлены после сдвига строк листа.")
+        return True
+
+    @contextmanager
+    def _positions_layout(self) -> Iterator[bool]:
+        """
+        Если пакет пишет строки Open_Positions, держит блокировку расположения листа
+        (разделяемую), чтобы сжатие не сдвинуло строки между выбором номеров и записью.
+        Возвращает False, если номера строк устарели и перечитать их не удалось.
+        """
+        if not (self._dirty_positions or self._closed_positions):
+            yield True
+            return
+        with ledger_locks.sheet_layout(config.OPEN_POSITIONS_SHEET_NAME) as layout_version:
+            yield layout_version == self.layout_version or self._refresh_position_rows(layout_version)
+
+    def flush(self, description: str = "") -> bool:
+        """
+        Записывает изменения текущего потока одним запросом values_batch_update.
+        Пакет сначала сохраняется в журнал. Если запись не удалась, пакет остается
+        в журнале для повторного применения. Если не удалось даже записать журнал,
+        значения затронутых ключей в памяти помечаются недостоверными.
+        """
+        local = self._pending()
+        local.last_flush_journaled = False
+        if not self.has_pending_changes():
+            return True
+        with self._positions_layout() as rows_ok:
+            if not rows_ok:
+                self.discard_pending()
+                return False
+            return self._write_pending(description)
+
+    def _write_pending(self, description: str) -> bool:
+        local = self._pending()
+        keys = self._pending_keys()
+        data, capacity = self._build_write_batch()
+        batch_id = write_journal.record_pending(data, capacity, description, keys)
+        if batch_id is None:
+            self._clear_pending()
+            self.forget_versions(keys)
+            return False
+        local.last_flush_journaled = True
+        self._clear_pending()
+        if not _apply_batch(data, capacity):
+            logger.error(
+                f"Пакет {batch_id} не записан в таблицу и оставлен в журнале для повторного применения.")
+            write_journal.release(batch_id)
+            schedule_journal_replay()
+            return False
+        write_journal.mark_committed(batch_id)
+        return True
+
+
+def _apply_batch(data: List[Dict[str, Any]], capacity: Dict[str, int]) -> bool:
+    for sheet_name, last_row in capacity.items():
+        if not sheets_service.ensure_row_capacity(sheet_name, last_row):
+            return False
+    return sheets_service.values_batch_update(data)
+
+
+def replay_journal(layout_locked: bool = False) -> bool:
+    """
+    Применяет пакеты из журнала, не подтвержденные после сбоя, в исходном порядке.
+    Пакеты пишут строки по номерам, поэтому применяются под блокировкой расположения
+    Open_Positions; layout_locked=True - ее уже держит вызывающий (сжатие листа).
+    Возвращает False, если хотя бы один пакет применить не удалось.
+    """
+    if not write_journal.has_pending():
+        return True
+    if layout_locked:
+        replayed = write_journal.replay_pending(_apply_batch)
+    else:
+        with ledger_locks.sheet_layout(config.OPEN_POSITIONS_SHEET_NAME):
+            replayed = write_journal.replay_pending(_apply_batch)
+    if replayed is None:
+        return False
+    if replayed:
+        # Таблица изменилась в обход текущего состояния
+        _ledger_state.forget_versions()
+    return True
+
+
+_replay_lock = threading.Lock()
+_replay_timer: Optional[threading.Timer] = None
+
+
+def schedule_journal_replay(delay: Optional[float] = None) -> None:
+    """
+    Запускает повторное применение журнала в фоне. Без этого пакет, не записанный
+    из-за сбоя таблицы, ждал бы следующей операции учета, которой у простаивающего
+    бота может не быть. Попытки повторяются с удвоением паузы, пока журнал не опустеет.
+    """
+    global _replay_timer
+    delay = delay or config.JOURNAL_REPLAY_RETRY_SECONDS
+    with _replay_lock:
+        if _replay_timer is not None:
+            return
+        _replay_timer = threading.Timer(delay, _background_replay, args=(delay,))
+        _replay_timer.daemon = True
+        _replay_timer.start()
+
+
+def _background_replay(delay: float) -> None:
+    global _replay_timer
+    with _replay_lock:
+        _replay_timer = None
+    try:
+        pending = write_journal.get_pending()
+        if not pending:
+            return
+        # Ключи пакетов блокируются, как в locked_operation: их не пишет никто другой
+        keys = [tuple(k) for entry in pending for k in entry.get('keys', [])]
+        with ledger_locks.state_lock.shared():
+            with ledger_locks.account_locks(keys):
+                replayed = replay_journal()
+    except Exception as e:
+        logger.error(f"Ошибка фонового применения журнала: {e}", exc_info=True)
+        replayed = False
+    if replayed:
+        logger.info("Фоновое применение журнала завершено.")
+    else:
+        schedule_journal_replay(min(delay * 2, config.JOURNAL_REPLAY_MAX_DELAY_SECONDS))
+
+
+_ledger_state = LedgerState()
+
+
+def get_ledger_state() -> LedgerState:
+    """
+    Возвращает общее состояние учета, перечитывая его при первом обращении или по TTL.
+    Не вызывать внутри locked_operation: перезагрузка ждет завершения операций.
+    """
+    if _ledger_state.is_stale():
+        with ledger_locks.state_lock.exclusive():
+            if _ledger_state.is_stale():
+                _ledger_state.load()
+    return _ledger_state
+
+
+class LockedOperation:
+    """Операция над учетом под блокировками своих ключей (см. locked_operation)."""
+
+    def __init__(self, state: LedgerState, locked: ledger_locks.LockedKeys):
+        self.state = state
+        self.locked = locked
+        self.journal_ok = True
+
+    def flush(self, description: str = "") -> bool:
+        """Записывает изменения и выдает ключам новые метки версий, если пакет принят."""
+        success = self.state.flush(description)
+        if success or self.state.last_flush_journaled():
+            # Пакет записан или будет применен из журнала раньше, чем кто-то прочитает эти ключи
+            self.state.record_versions(self.locked.bump())
+        return success
+
+
+@contextmanager
+def locked_operation(keys: Iterable[BalanceKey]) -> Iterator[LockedOperation]:
+    """
+    Захватывает ключи (счет, актив) операции, применяет отложенные пакеты журнала
+    и обновляет из таблицы ключи, измененные другими процессами. Если журнал
+    применить не удалось, operation.journal_ok = False и изменять учет нельзя.
+    """
+    state = get_ledger_state()
+    with ledger_locks.state_lock.shared():
+        with ledger_locks.account_locks(keys) as locked:
+            operation = LockedOperation(state, locked)
+            operation.journal_ok = replay_journal()
+            if operation.journal_ok:
+                state.sync_keys(locked.reload_versions())
+            else:
+                schedule_journal_replay()
+            yield operation
+
+
+@contextmanager
+def exclusive_ledger(keys: Iterable[BalanceKey]) -> Iterator[ledger_locks.LockedKeys]:
+    """
+    Захватывает учет для массовой перезаписи листов балансов и позиций: операции
+    этого процесса ждут, ключи keys заблокированы для других процессов. После
+    выхода ключи получают новые метки версий (другие процессы перечитают их),
+    а состояние этого процесса будет загружено заново.
+    """
+    with ledger_locks.state_lock.exclusive():
+        with ledger_locks.account_locks(keys) as locked:
+            if not replay_journal():
+                raise RuntimeError("В журнале есть неприменённые записи, таблица недоступна.")
+            try:
+                yield locked
+            finally:
+                locked.bump()
+        _ledger_state.invalidate()
+        _ledger_state.forget_versions()
@@ -0,0 +1,252 @@
+# deal_tracker/local_sheets.py
+"""
+Локальный бэкенд таблицы с интерфейсом подмножества gspread (Spreadsheet/Worksheet),
+которое использует sheets_service. Нужен для нагрузочных и стресс-тестов без Google API.
+
+Данные хранятся в JSON-файле (доступ под межпроцессной блокировкой, каждый вызов
+читает и записывает файл целиком) или только в памяти, если путь не задан.
+latency_seconds добавляет задержку к каждому вызову, имитируя сетевой запрос.
+Включается настройкой SHEETS_BACKEND=local.
+"""
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import ledger_locks
+
+_A1_RE = re.compile(r'^([A-Z]*)(\d*)$')
+
+
+def _col_to_index(letters: str) -> int:
+    index = 0
+    for ch in letters:
+        index = index * 26 + (ord(ch) - ord('A') + 1)
+    return index
+
+
+def _index_to_col(index: int) -> str:
+    letters = ''
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+
+def split_sheet_range(range_str: str) -> Tuple[Optional[str], str]:
+    """"'Лист'!A1:B2" -> ('Лист', 'A1:B2'); 'A1:B2' -> (None, 'A1:B2')."""
+    if '!' not in range_str:
+        return None, range_str
+    sheet_part, cells = range_str.rsplit('!', 1)
+    if sheet_part.startswith("'") and sheet_part.endswith("'"):
+        sheet_part = sheet_part[1:-1].replace("''", "'")
+    return sheet_part, cells
+
+
+def parse_a1_range(cells: str) -> Tuple[int, int, Optional[int], Optional[int]]:
+    """'B2:D5' -> (2, 2, 5, 4): первая строка, первый столбец, последняя строка/столбец (или None)."""
+    start, _, end = cells.upper().partition(':')
+    start_match, end_match = _A1_RE.match(start), _A1_RE.match(end or start)
+    if not start_match or not end_match:
+        raise ValueError(f"Некорректный диапазон '{cells}'")
+    first_row = int(start_match.group(2) or 1)
+    first_col = _col_to_index(start_match.group(1) or 'A')
+    last_row = int(end_match.group(2)) if end_match.group(2) else None
+    last_col = _col_to_index(end_match.group(1)) if end_match.group(1) else None
+    return first_row, first_col, last_row, last_col
+
+
+class LocalWorksheet:
+    """Лист локальной таблицы."""
+
+    def __init__(self, spreadsheet: 'LocalSpreadsheet', title: str):
+        self.spreadsheet = spreadsheet
+        self.title = title
+
+    @property
+    def id(self) -> int:
+        with self.spreadsheet._data() as data:
+            return _sheet_id(data, self.title)
+
+    @property
+    def row_count(self) -> int:
+        with self.spreadsheet._data() as data:
+            return data[self.title]['row_count']
+
+    def add_rows(self, rows: int) -> None:
+        with self.spreadsheet._data(write=True) as data:
+            data[self.title]['row_count'] += rows
+
+    def get_all_values(self) -> List[List[str]]:
+        with self.spreadsheet._data() as data:
+            return [list(row) for row in data[self.title]['rows']]
+
+    def row_values(self, row: int) -> List[str]:
+        with self.spreadsheet._data() as data:
+            rows = data[self.title]['rows']
+            return list(rows[row - 1]) if row <= len(rows) else []
+
+    def col_values(self, col: int) -> List[str]:
+        with self.spreadsheet._data() as data:
+            values = [row[col - 1] if col <= len(row) else '' for row in data[self.title]['rows']]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def get(self, range_str: str) -> List[List[str]]:
+        with self.spreadsheet._data() as data:
+            return _read_range(data[self.title]['rows'], range_str)
+
+    def batch_get(self, ranges: Sequence[str]) -> List[Dict[str, Any]]:
+        with self.spreadsheet._data() as data:
+            return [{'range': r, 'values': _read_range(data[self.title]['rows'], r)} for r in ranges]
+
+    def batch_update(self, payload: List[Dict[str, Any]], value_input_option: str = 'RAW') -> Dict[str, Any]:
+        with self.spreadsheet._data(write=True) as data:
+            for item in payload:
+                _write_range(data[self.title], item['range'], item['values'])
+        return {'totalUpdatedRanges': len(payload)}
+
+    def update(self, range_str: str, values: List[List[Any]], **kwargs: Any) -> Dict[str, Any]:
+        return self.batch_update([{'range': range_str, 'values': values}])
+
+    def append_row(self, values: List[Any], value_input_option: str = 'RAW') -> Dict[str, Any]:
+        return self.append_rows([values], value_input_option)
+
+    def append_rows(self, values: List[List[Any]], value_input_option: str = 'RAW') -> Dict[str, Any]:
+        with self.spreadsheet._data(write=True) as data:
+            sheet = data[self.title]
+            rows = sheet['rows']
+            while rows and not any(rows[-1]):
+                rows.pop()
+            first_row = len(rows) + 1
+            rows.extend([[_to_cell(v) for v in row] for row in values])
+            sheet['row_count'] = max(sheet['row_count'], len(rows))
+            width = max((len(row) for row in values), default=1)
+        updated = f"'{self.title}'!A{first_row}:{_index_to_col(width)}{first_row + len(values) - 1}"
+        return {'updates': {'updatedRange': updated, 'updatedRows': len(values)}}
+
+    def delete_rows(self, start_index: int, end_index: Optional[int] = None) -> None:
+        end_index = end_index or start_index
+        with self.spreadsheet._data(write=True) as data:
+            sheet = data[self.title]
+            del sheet['rows'][start_index - 1:end_index]
+            sheet['row_count'] -= end_index - start_index + 1
+
+
+class LocalSpreadsheet:
+    """Локальная таблица: набор листов в JSON-файле или в памяти."""
+
+    def __init__(self, path: Optional[str] = None, latency_seconds: float = 0.0):
+        self.path = path
+        self.latency_seconds = latency_seconds
+        self._memory: Dict[str, Dict[str, Any]] = {}
+        self._memory_lock = threading.RLock()
+
+    @contextmanager
+    def _data(self, write: bool = False) -> Iterator[Dict[str, Dict[str, Any]]]:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if not self.path:
+            with self._memory_lock:
+                yield self._memory
+            return
+        with ledger_locks.file_lock('local_sheets'):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = {}
+            yield data
+            if write:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+
+    def worksheet(self, title: str) -> LocalWorksheet:
+        with self._data() as data:
+            if title not in data:
+                raise KeyError(f"Лист '{title}' не найден")
+        return LocalWorksheet(self, title)
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26) -> LocalWorksheet:
+        with self._data(write=True) as data:
+            data.setdefault(title, {'rows': [], 'row_count': rows})
+        return LocalWorksheet(self, title)
+
+    def values_batch_update(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Запись диапазонов нескольких листов одним атомарным вызовом."""
+        with self._data(write=True) as data:
+            for item in body.get('data', []):
+                sheet_name, cells = split_sheet_range(item['range'])
+                if sheet_name not in data:
+                    raise KeyError(f"Лист '{sheet_name}' не найден")
+                _write_range(data[sheet_name], cells, item['values'])
+        return {'totalUpdatedRanges': len(body.get('data', []))}
+
+    def batch_update(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Структурные запросы batchUpdate: поддерживаются deleteDimension и appendDimension по строкам."""
+        with self._data(write=True) as data:
+            titles = {_sheet_id(data, title): title for title in data}
+            for request in body.get('requests', []):
+                if 'deleteDimension' in request:
+                    target = request['deleteDimension']['range']
+                    sheet = data[titles[target['sheetId']]]
+                    start, end = target['startIndex'], target['endIndex']
+                    del sheet['rows'][start:end]
+                    sheet['row_count'] -= end - start
+                elif 'appendDimension' in request:
+                    target = request['appendDimension']
+                    data[titles[target['sheetId']]]['row_count'] += target['length']
+                else:
+                    raise ValueError(f"Неподдерживаемый запрос batchUpdate: {list(request)}")
+        return {'replies': [{} for _ in body.get('requests', [])]}
+
+    def seed(self, headers_by_sheet: Dict[str, List[str]], rows: int = 1000) -> None:
+        """Создает листы с заголовками (только для локального бэкенда)."""
+        with self._data(write=True) as data:
+            for title, headers in headers_by_sheet.items():
+                data[title] = {'rows': [list(headers)], 'row_count': rows}
+
+
+def _sheet_id(data: Dict[str, Dict[str, Any]], title: str) -> int:
+    return list(data).index(title)
+
+
+def _to_cell(value: Any) -> str:
+    return '' if value is None else str(value)
+
+
+def _read_range(rows: List[List[str]], range_str: str) -> List[List[str]]:
+    _, cells = split_sheet_range(range_str)
+    first_row, first_col, last_row, last_col = parse_a1_range(cells)
+    result = []
+    for row in rows[first_row - 1:last_row]:
+        values = row[first_col - 1:last_col]
+        while values and values[-1] == '':
+            values.pop()
+        result.append(values)
+    while result and not result[-1]:
+        result.pop()
+    return result
+
+
+def _write_range(sheet: Dict[str, Any], cells: str, values: List[List[Any]]) -> None:
+    first_row, first_col, _, _ = parse_a1_range(split_sheet_range(cells)[1])
+    last_row = first_row + len(values) - 1
+    if last_row > sheet['row_count']:
+        raise ValueError(f"Диапазон {cells} выходит за пределы сетки листа ({sheet['row_count']} строк)")
+    rows = sheet['rows']
+    while len(rows) < last_row:
+        rows.append([])
+    for offset, row_values in enumerate(values):
+        row = rows[first_row - 1 + offset]
+        needed = first_col - 1 + len(row_values)
+        if len(row) < needed:
+            row.extend([''] * (needed - len(row)))
+        for i, value in enumerate(row_values):
+            row[first_col - 1 + i] = _to_cell(value)
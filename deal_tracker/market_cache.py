@@ -0,0 +1,97 @@
+# deal_tracker/market_cache.py
+"""
+Дисковый кэш метаданных рынков CCXT (markets/currencies).
+Позволяет экземплярам бирж стартовать с готовыми рынками и не выполнять
+тяжелый load_markets при каждом перезапуске updater'а или бота.
+"""
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_path(exchange_id: str) -> str:
+    return os.path.join(config.STATE_DIR, 'markets', f"{exchange_id.lower()}.json")
+
+
+def load_cached_markets(exchange_id: str) -> Optional[Dict[str, Any]]:
+    """Возвращает закэшированные рынки биржи или None, если кэша нет или он устарел."""
+    path = _cache_path(exchange_id)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Поврежден кэш рынков {exchange_id}: {e}")
+        return None
+    age = time.time() - cached.get('saved_at', 0)
+    if age > config.MARKET_CACHE_TTL_SECONDS or not cached.get('markets'):
+        logger.info(
+            f"Кэш рынков {exchange_id} устарел ({age:.0f} с), требуется перезагрузка.")
+        return None
+    return cached
+
+
+def save_markets(exchange) -> bool:
+    """Сохраняет загруженные рынки экземпляра CCXT на диск (атомарно)."""
+    if not getattr(exchange, 'markets', None):
+        return False
+    path = _cache_path(exchange.id)
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'saved_at': time.time(), 'markets': exchange.markets,
+                       'currencies': exchange.currencies}, f, default=str)
+        os.replace(tmp_path, path)
+        logger.info(
+            f"Кэш рынков {exchange.id} сохранен ({len(exchange.markets)} рынков).")
+        return True
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"Не удалось сохранить кэш рынков {exchange.id}: {e}")
+        return False
+
+
+def apply_cached_markets(exchange) -> bool:
+    """Заполняет экземпляр CCXT рынками из кэша. После этого load_markets не ходит в сеть."""
+    cached = load_cached_markets(exchange.id)
+    if not cached:
+        return False
+    try:
+        exchange.set_markets(cached['markets'], cached.get('currencies'))
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось применить кэш рынков {exchange.id}: {e}")
+        return False
+
+
+async def ensure_markets_async(exchange) -> bool:
+    """Рынки из кэша, а при его отсутствии - load_markets с последующим сохранением."""
+    if apply_cached_markets(exchange):
+        return True
+    try:
+        await exchange.load_markets()
+    except Exception as e:
+        logger.error(f"Ошибка загрузки рынков {exchange.id}: {e}")
+        return False
+    save_markets(exchange)
+    return True
+
+
+def ensure_markets(exchange) -> bool:
+    """Синхронный вариант ensure_markets_async для обычных (не async) клиентов CCXT."""
+    if apply_cached_markets(exchange):
+        return True
+    try:
+        exchange.load_markets()
+    except Exception as e:
+        logger.error(f"Ошибка загрузки рынков {exchange.id}: {e}")
+        return False
+    save_markets(exchange)
+    return True
@@ -74,6 +74,9 @@ class PositionData:
     current_price: Optional[Decimal] = None
     unrealized_pnl: Optional[Decimal] = None
     last_updated: Optional[datetime] = None
+    # Закрытая позиция остается строкой-меткой до сжатия листа
+    is_closed: Optional[bool] = None
+    closed_at: Optional[datetime] = None
 
 
 @dataclass
@@ -125,3 +128,13 @@ class AnalyticsData:
     portfolio_current_value: Decimal
     total_equity: Decimal
     notes: Optional[str] = None
+
+
+@dataclass
+class IngestResult:
+    """Результат обработки одного элемента при пакетном логировании."""
+    index: int
+    success: bool
+    message: str
+    record_id: Optional[str] = None
+    duplicate: bool = False
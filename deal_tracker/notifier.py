@@ -1,7 +1,12 @@
 # deal_tracker/notifier.py
 import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, List, Optional, Union
+
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 import asyncio  # Может понадобиться для запуска из синхронного кода, если такой будет
 
 import config  # Для TELEGRAM_TOKEN и TELEGRAM_CHAT_ID
@@ -65,6 +70,209 @@ async def send_telegram_alert(message: str, bot_instance: Bot = None) -> bool:
             f"Notifier: Непредвиденная ошибка при отправке уведомления: {e}", exc_info=True)
         return False
 
+# Предел длины сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+# Вызывается после попытки отправки: True - сообщение доставлено в Telegram
+DeliveryCallback = Callable[[bool], None]
+
+
+@dataclass
+class _QueuedMessage:
+    text: str
+    queued_at: float
+    on_result: Optional[DeliveryCallback] = None
+
+
+class NotificationOutbox:
+    """
+    Очередь исходящих уведомлений с ограничением частоты по чатам.
+
+    enqueue() не ждет сети: сообщение кладется в очередь чата, а отправляет его
+    фоновая задача этого чата. Сообщения, поставленные в течение
+    NOTIFIER_COALESCE_WINDOW_SECONDS после первого в очереди, объединяются в одну
+    сводку (в пределах длины сообщения Telegram). Между отправками в один чат
+    выдерживается NOTIFIER_MIN_INTERVAL_SECONDS; на RetryAfter задача ждет
+    указанное Telegram время, на сетевые ошибки - с экспоненциальной паузой.
+
+    Очередь ограничена NOTIFIER_MAX_QUEUE сообщениями на чат. При переполнении
+    enqueue() возвращает False (вызывающий код может повторить позже), а число
+    отклоненных сообщений пишется в лог и добавляется к следующей сводке.
+
+    True от enqueue() означает только постановку в очередь. Кому важна доставка,
+    передает on_result: он вызывается с True после отправки и с False, если
+    отправить не удалось или очередь остановлена close() до отправки.
+    """
+
+    def __init__(self, bot_instance: Optional[Bot] = None, max_queue: Optional[int] = None,
+                 min_interval: Optional[float] = None, coalesce_window: Optional[float] = None,
+                 max_retries: Optional[int] = None):
+        self._bot = bot_instance
+        self.max_queue = max_queue or config.NOTIFIER_MAX_QUEUE
+        self.min_interval = config.NOTIFIER_MIN_INTERVAL_SECONDS if min_interval is None else min_interval
+        self.coalesce_window = (config.NOTIFIER_COALESCE_WINDOW_SECONDS
+                                if coalesce_window is None else coalesce_window)
+        self.max_retries = config.NOTIFIER_MAX_RETRIES if max_retries is None else max_retries
+        self._queues: Dict[Union[int, str], Deque[_QueuedMessage]] = {}
+        self._workers: Dict[Union[int, str], asyncio.Task] = {}
+        self._last_sent: Dict[Union[int, str], float] = {}
+        self._rejected: Dict[Union[int, str], int] = {}
+        self._counters = {'queued': 0, 'sent_messages': 0, 'sent_alerts': 0,
+                          'rejected': 0, 'retries': 0, 'failed_alerts': 0}
+
+    def enqueue(self, message: str, chat_id: Union[int, str, None] = None,
+                on_result: Optional[DeliveryCallback] = None) -> bool:
+        """
+        Ставит сообщение в очередь чата (по умолчанию TELEGRAM_CHAT_ID), не блокируя.
+        Должен вызываться из потока event loop. False - очередь переполнена или
+        не настроен чат (on_result тогда не вызывается).
+        """
+        chat_id = chat_id or config.TELEGRAM_CHAT_ID
+        if not chat_id:
+            logger.error("Notifier: TELEGRAM_CHAT_ID не настроен. Уведомление не поставлено в очередь.")
+            return False
+        queue = self._queues.setdefault(chat_id, deque())
+        if len(queue) >= self.max_queue:
+            self._rejected[chat_id] = self._rejected.get(chat_id, 0) + 1
+            self._counters['rejected'] += 1
+            logger.warning(
+                f"Notifier: очередь чата {chat_id} заполнена ({self.max_queue}), уведомление отклонено: "
+                f"\"{message[:50]}...\"")
+            return False
+        queue.append(_QueuedMessage(message, time.monotonic(), on_result))
+        self._counters['queued'] += 1
+        if chat_id not in self._workers:
+            task = asyncio.get_running_loop().create_task(self._worker(chat_id))
+            self._workers[chat_id] = task
+        return True
+
+    async def send(self, message: str, on_result: Optional[DeliveryCallback] = None) -> bool:
+        """Совместим с send_telegram_alert: True означает, что уведомление принято в очередь."""
+        return self.enqueue(message, on_result=on_result)
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self._counters, pending=self.pending())
+
+    async def flush(self, timeout: Optional[float] = None) -> bool:
+        """Ждет отправки всех поставленных сообщений. False - не успели за timeout."""
+        workers = list(self._workers.values())
+        if not workers:
+            return True
+        done, _ = await asyncio.wait(workers, timeout=timeout)
+        return len(done) == len(workers) and not self._workers
+
+    async def close(self, timeout: Optional[float] = None) -> None:
+        """Дожидается очереди (не дольше timeout) и останавливает фоновые задачи."""
+        if not await self.flush(timeout):
+            logger.warning(f"Notifier: при остановке не отправлено {self.pending()} уведомлений.")
+        for task in list(self._workers.values()):
+            task.cancel()
+        for queue in self._queues.values():
+            while queue:
+                self._report(queue.popleft(), False)
+
+    @staticmethod
+    def _report(item: _QueuedMessage, delivered: bool) -> None:
+        if item.on_result is None:
+            return
+        try:
+            item.on_result(delivered)
+        except Exception as e:
+            logger.error(f"Notifier: ошибка в обработчике результата отправки: {e}", exc_info=True)
+
+    def _take_batch(self, chat_id: Union[int, str]) -> List[_QueuedMessage]:
+        """Снимает из очереди сообщения, помещающиеся в одну сводку."""
+        queue = self._queues[chat_id]
+        batch = [queue.popleft()]
+        length = len(batch[0].text)
+        while queue and length + len(queue[0].text) + 2 <= TELEGRAM_MESSAGE_LIMIT - 100:
+            length += len(queue[0].text) + 2
+            batch.append(queue.popleft())
+        return batch
+
+    def _format_batch(self, chat_id: Union[int, str], batch: List[_QueuedMessage]) -> str:
+        texts = [item.text for item in batch]
+        if len(texts) == 1:
+            text = texts[0]
+        else:
+            text = f"🔔 Уведомлений: {len(texts)}\n\n" + "\n\n".join(texts)
+        rejected = self._rejected.pop(chat_id, 0)
+        if rejected:
+            text += f"\n\n⚠️ Очередь уведомлений переполнялась, отклонено сообщений: {rejected}."
+        return text[:TELEGRAM_MESSAGE_LIMIT]
+
+    async def _worker(self, chat_id: Union[int, str]) -> None:
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                now = time.monotonic()
+                delay = max(self._last_sent.get(chat_id, float('-inf')) + self.min_interval - now,
+                            queue[0].queued_at + self.coalesce_window - now)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                batch = self._take_batch(chat_id)
+                text = self._format_batch(chat_id, batch)
+                delivered = await self._send_with_retry(chat_id, text)
+                if delivered:
+                    self._counters['sent_messages'] += 1
+                    self._counters['sent_alerts'] += len(batch)
+                else:
+                    self._counters['failed_alerts'] += len(batch)
+                self._last_sent[chat_id] = time.monotonic()
+                for item in batch:
+                    self._report(item, delivered)
+        finally:
+            if self._workers.get(chat_id) is asyncio.current_task():
+                del self._workers[chat_id]
+
+    async def _send_with_retry(self, chat_id: Union[int, str], text: str) -> bool:
+        bot = self._bot or get_bot_instance()
+        if not bot:
+            logger.error("Notifier: Экземпляр бота недоступен. Уведомление не отправлено.")
+            return False
+        attempt = 0
+        while True:
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                logger.info(f"Уведомление отправлено в чат {chat_id}: \"{text[:50]}...\"")
+                return True
+            except RetryAfter as e:
+                # В новых версиях PTB retry_after - timedelta
+                wait = getattr(e.retry_after, 'total_seconds', lambda: e.retry_after)()
+                logger.warning(f"Notifier: лимит Telegram для чата {chat_id}, повтор через {wait} с.")
+            except (BadRequest, Forbidden) as e:
+                logger.error(f"Notifier: Telegram отклонил уведомление для чата {chat_id}: {e}")
+                return False
+            except TelegramError as e:
+                wait = min(2 ** attempt, 60)
+                logger.warning(f"Notifier: ошибка отправки в чат {chat_id}: {e}. Повтор через {wait} с.")
+            except Exception as e:
+                logger.error(f"Notifier: Непредвиденная ошибка при отправке уведомления: {e}", exc_info=True)
+                return False
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error(f"Notifier: уведомление для чата {chat_id} не отправлено после "
+                             f"{self.max_retries} повторов: \"{text[:200]}\"")
+                return False
+            self._counters['retries'] += 1
+            await asyncio.sleep(float(wait))
+
+
+_outbox: Optional[NotificationOutbox] = None
+
+
+def get_outbox() -> NotificationOutbox:
+    """Общая очередь уведомлений процесса (создается при первом обращении)."""
+    global _outbox
+    if _outbox is None:
+        _outbox = NotificationOutbox()
+    return _outbox
+
+
 # Если вам когда-нибудь понадобится отправлять уведомление из СИНХРОННОГО кода,
 # можно использовать такую обертку. Но старайтесь избегать этого и использовать async вызовы.
 # def send_telegram_alert_sync(message: str):
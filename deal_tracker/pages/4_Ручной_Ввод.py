@@ -11,6 +11,7 @@ import sys
 try:
     import config
     from trade_logger import log_trade, log_fund_movement
+    import csv_import
     import utils
     from locales import t
 except ImportError:
@@ -20,6 +21,7 @@ except ImportError:
         sys.path.append(project_root)
     import config
     from trade_logger import log_trade, log_fund_movement
+    import csv_import
     import utils
     from locales import t
 
@@ -286,15 +288,55 @@ def display_fund_movement_forms():
                     "TRANSFER", asset, amount, source_name, dest_name, fee_amount, fee_asset, tx_id, date_str, notes)
 
 
+def display_csv_import_form():
+    """Загрузка CSV-выгрузки биржи с потоковым импортом и отображением скорости."""
+    st.subheader("Импорт выгрузки биржи")
+    col1, col2 = st.columns(2)
+    layout_name = col1.selectbox("Формат выгрузки", sorted(csv_import.LAYOUTS))
+    exchange = col2.text_input(
+        "Счет/биржа", placeholder="Пусто = из формата выгрузки")
+    uploaded = st.file_uploader("CSV-файл", type=["csv"])
+    if uploaded is None or not st.button("Импортировать"):
+        return
+
+    progress_text = st.empty()
+
+    def show_progress(stats):
+        progress_text.text(
+            f"Обработано строк: {stats.rows} | принято: {stats.accepted} | "
+            f"отклонено: {stats.rejected} | {stats.rows_per_sec:.0f} строк/с")
+
+    with st.spinner("Импорт..."):
+        try:
+            stats = csv_import.import_csv(
+                uploaded, layout_name, exchange=exchange.strip() or None, progress=show_progress)
+        except (ValueError, KeyError) as e:
+            st.error(f"Ошибка импорта: {e}")
+            return
+    show_progress(stats)
+    if stats.accepted:
+        st.success(
+            f"Импортировано {stats.accepted} записей за {stats.elapsed:.1f} с.")
+    if stats.skipped:
+        st.info(f"Пропущено (дубликаты и незавершенные операции): {stats.skipped}")
+    if stats.errors:
+        st.warning(f"Отклонено записей: {stats.rejected}")
+        st.dataframe({"Ошибка": stats.errors}, use_container_width=True)
+
+
 # --- ГЛАВНАЯ ЧАСТЬ СТРАНИЦЫ ---
 st.title("📝 Ручной Ввод Данных")
 st.caption(
     "Эта страница предназначена для ручного добавления сделок и финансовых операций в систему.")
 
-tab_trade, tab_movement = st.tabs(["📈 Сделки", "💸 Движения Средств"])
+tab_trade, tab_movement, tab_import = st.tabs(
+    ["📈 Сделки", "💸 Движения Средств", "📥 Импорт CSV"])
 
 with tab_trade:
     display_manual_trade_entry_form()
 
 with tab_movement:
     display_fund_movement_forms()
+
+with tab_import:
+    display_csv_import_form()
@@ -0,0 +1,188 @@
+# deal_tracker/portfolio_view.py
+"""
+Снимок портфеля для /portfolio и его график.
+
+Снимок (позиции и готовый текст ответа) кэшируется вместе с меткой источников:
+версиями ключей учета (их меняет каждая запись сделки или движения),
+расположением строк Open_Positions (сжатие, перестройка) и меткой цен, которую
+price_updater меняет после каждой записи цен. Пока метка та же, /portfolio
+отвечает без чтения таблицы. TTL PORTFOLIO_CACHE_TTL_SECONDS ловит ручные
+правки таблицы, которые меток не меняют.
+
+График рисуется matplotlib в пуле процессов и кэшируется по хэшу содержимого
+снимка (не по метке: запись, не изменившая позиций, график не сбрасывает).
+После первой отправки Telegram возвращает file_id, и повторные запросы
+отправляют картинку по нему без загрузки.
+"""
+import hashlib
+import io
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import config
+import ledger_locks
+import sheets_service
+from models import PositionData
+
+logger = logging.getLogger(__name__)
+
+# (символ, биржа, стоимость позиции, нереализованный PnL) - данные для графика
+ChartRow = Tuple[str, str, float, float]
+
+
+@dataclass
+class PortfolioSnapshot:
+    token: str
+    digest: str
+    positions: List[PositionData]
+    text: str
+    chart_rows: List[ChartRow]
+
+
+def _source_token() -> str:
+    """Метка источников снимка: меняется при любой записи учета, сдвиге строк или записи цен."""
+    versions = sorted(f"{account}|{asset}|{version}"
+                      for (account, asset), version in ledger_locks.read_all_versions().items())
+    with ledger_locks.sheet_layout(config.OPEN_POSITIONS_SHEET_NAME) as layout_version:
+        pass
+    payload = [versions, layout_version, ledger_locks.read_marker(ledger_locks.PRICES_MARKER)]
+    return hashlib.sha1(json.dumps(payload).encode('utf-8')).hexdigest()
+
+
+def format_portfolio(positions: List[PositionData]) -> str:
+    if not positions:
+        return "Нет открытых позиций."
+    reply_text = "<u><b>💼 Открытые Позиции:</b></u>\n\n"
+    for pos in positions:
+        pnl_str = f"{pos.unrealized_pnl:+.2f}" if pos.unrealized_pnl is not None else "N/A"
+        reply_text += (f"<b>{pos.symbol}</b> ({pos.exchange})\n"
+                       f"  Кол-во: {pos.net_amount:.4f}\n"
+                       f"  Ср.вход: {pos.avg_entry_price:.4f}\n"
+                       f"  Нереал.PNL: {pnl_str}\n\n")
+    return reply_text
+
+
+def _chart_rows(positions: List[PositionData]) -> List[ChartRow]:
+    rows = []
+    for pos in positions:
+        price = pos.current_price if pos.current_price is not None else pos.avg_entry_price
+        value = float(abs(pos.net_amount * price)) if price is not None else 0.0
+        pnl = float(pos.unrealized_pnl) if pos.unrealized_pnl is not None else 0.0
+        rows.append((pos.symbol, pos.exchange, value, pnl))
+    return sorted(rows, key=lambda row: row[2])
+
+
+def _build_snapshot(token: str) -> PortfolioSnapshot:
+    positions = sheets_service.get_all_open_positions()
+    text = format_portfolio(positions)
+    rows = _chart_rows(positions)
+    digest = hashlib.sha1(json.dumps([text, rows], ensure_ascii=False).encode('utf-8')).hexdigest()
+    return PortfolioSnapshot(token, digest, positions, text, rows)
+
+
+def render_chart(rows: List[ChartRow]) -> Optional[bytes]:
+    """
+    PNG со стоимостью позиций (цвет - знак нереализованного PnL). Выполняется
+    в дочернем процессе; None, если matplotlib не установлен.
+    """
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        logger.error("matplotlib не установлен: график портфеля недоступен.")
+        return None
+
+    labels = [f"{symbol} ({exchange})" for symbol, exchange, _, _ in rows]
+    values = [value for _, _, value, _ in rows]
+    colors = ['#2e7d32' if pnl >= 0 else '#c62828' for _, _, _, pnl in rows]
+    fig, ax = plt.subplots(figsize=(8, max(2.5, 0.45 * len(rows) + 1.2)), dpi=110)
+    try:
+        ax.barh(labels, values, color=colors)
+        for y, (_, _, value, pnl) in enumerate(rows):
+            ax.annotate(f" {value:,.0f} ({pnl:+,.2f})", (value, y), va='center', fontsize=8)
+        ax.set_xlabel(f"Стоимость, {config.BASE_CURRENCY}")
+        ax.set_title("Открытые позиции (зеленые - в плюсе, красные - в минусе)")
+        ax.margins(x=0.25)
+        fig.tight_layout()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+class _PortfolioCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot: Optional[PortfolioSnapshot] = None
+        self._loaded_at = 0.0
+        self._charts: "OrderedDict[str, bytes]" = OrderedDict()
+        self._file_ids: Dict[str, str] = {}
+
+    def snapshot(self) -> PortfolioSnapshot:
+        with self._lock:
+            token = _source_token()
+            expired = time.monotonic() - self._loaded_at > config.PORTFOLIO_CACHE_TTL_SECONDS
+            if self._snapshot is None or expired or self._snapshot.token != token:
+                started = time.monotonic()
+                self._snapshot = _build_snapshot(token)
+                self._loaded_at = time.monotonic()
+                logger.info(f"Снимок портфеля перестроен: {len(self._snapshot.positions)} позиций "
+                            f"за {self._loaded_at - started:.2f} с.")
+            return self._snapshot
+
+    def chart(self, digest: str) -> Tuple[Optional[str], Optional[bytes]]:
+        """(file_id, png) графика снимка: file_id, если картинка уже была отправлена."""
+        with self._lock:
+            if digest in self._charts:
+                self._charts.move_to_end(digest)
+            return self._file_ids.get(digest), self._charts.get(digest)
+
+    def store_chart(self, digest: str, png: bytes) -> None:
+        with self._lock:
+            self._charts[digest] = png
+            self._charts.move_to_end(digest)
+            while len(self._charts) > config.PORTFOLIO_CHART_CACHE_SIZE:
+                oldest, _ = self._charts.popitem(last=False)
+                self._file_ids.pop(oldest, None)
+
+    def store_file_id(self, digest: str, file_id: Optional[str]) -> None:
+        with self._lock:
+            if file_id is None:
+                self._file_ids.pop(digest, None)
+            elif digest in self._charts:
+                self._file_ids[digest] = file_id
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshot = None
+
+
+_cache = _PortfolioCache()
+
+
+def get_snapshot() -> PortfolioSnapshot:
+    return _cache.snapshot()
+
+
+def cached_chart(digest: str) -> Tuple[Optional[str], Optional[bytes]]:
+    return _cache.chart(digest)
+
+
+def store_chart(digest: str, png: bytes) -> None:
+    _cache.store_chart(digest, png)
+
+
+def store_file_id(digest: str, file_id: Optional[str]) -> None:
+    """Запоминает file_id отправленного графика; None - забыть (Telegram его не принял)."""
+    _cache.store_file_id(digest, file_id)
+
+
+def invalidate() -> None:
+    _cache.invalidate()
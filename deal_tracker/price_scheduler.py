@@ -0,0 +1,155 @@
+# deal_tracker/price_scheduler.py
+"""
+Адаптивный планировщик опроса цен для price_updater.
+Каждая позиция получает собственный интервал обновления: крупные и волатильные
+позиции опрашиваются чаще, "пыль" - реже. Очередь построена на куче (heapq),
+упорядоченной по времени следующего опроса, а общий темп запросов
+ограничивается бюджетом запросов в минуту.
+"""
+import heapq
+import math
+import time
+from collections import deque
+from decimal import Decimal
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+PollKey = Hashable
+
+
+class AdaptivePollScheduler:
+    """Очередь приоритетов по времени следующего опроса с бюджетом запросов."""
+
+    def __init__(
+        self,
+        base_interval: float,
+        min_interval: float,
+        max_interval: float,
+        max_requests_per_minute: float,
+        reference_value: Decimal,
+        reference_volatility: float,
+        volatility_window: int = 20,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.reference_value = reference_value
+        self.reference_volatility = reference_volatility
+        self.volatility_window = volatility_window
+        self._clock = clock
+        # Минимальный зазор между двумя запросами, вытекающий из бюджета
+        self._min_gap = 60.0 / max_requests_per_minute if max_requests_per_minute > 0 else 0.0
+        self._max_rate = max_requests_per_minute / 60.0 if max_requests_per_minute > 0 else math.inf
+
+        self._heap: List[Tuple[float, int, PollKey]] = []
+        self._due: Dict[PollKey, float] = {}
+        self._rates: Dict[PollKey, float] = {}
+        self._history: Dict[PollKey, Deque[Tuple[float, float]]] = {}
+        self._seq = 0
+        self._next_slot = 0.0
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def _push(self, key: PollKey, due_at: float) -> None:
+        self._seq += 1
+        self._due[key] = due_at
+        heapq.heappush(self._heap, (due_at, self._seq, key))
+
+    def sync(self, keys: List[PollKey]) -> None:
+        """
+        Приводит набор отслеживаемых ключей к актуальному списку позиций.
+        Новые ключи распределяются по времени с шагом бюджета, чтобы старт
+        не превращался во всплеск запросов. Исчезнувшие ключи удаляются.
+        """
+        now = self._clock()
+        current = set(keys)
+        for key in list(self._due):
+            if key not in current:
+                del self._due[key]
+                self._rates.pop(key, None)
+                self._history.pop(key, None)
+        offset = 0.0
+        for key in keys:
+            if key not in self._due:
+                self._push(key, now + offset)
+                self._rates[key] = 1.0 / self.base_interval
+                offset += self._min_gap
+
+    def pop_due(self) -> List[PollKey]:
+        """Возвращает ключи, которым пора обновиться, не выходя за бюджет запросов."""
+        now = self._clock()
+        ready = []
+        while self._heap and self._heap[0][0] <= now and self._next_slot <= now:
+            due_at, _, key = heapq.heappop(self._heap)
+            # Ленивая очистка: запись устарела после sync() или перепланирования
+            if self._due.get(key) != due_at:
+                continue
+            del self._due[key]
+            ready.append(key)
+            self._next_slot = max(self._next_slot, now) + self._min_gap
+        return ready
+
+    def seconds_until_next(self) -> Optional[float]:
+        """Сколько ждать до ближайшего опроса; None, если очередь пуста."""
+        while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        next_at = max(self._heap[0][0], self._next_slot)
+        return max(0.0, next_at - self._clock())
+
+    def _volatility(self, key: PollKey) -> float:
+        """Стандартное отклонение относительных изменений цены, приведенное к минуте."""
+        history = self._history.get(key)
+        if not history or len(history) < 3:
+            return 0.0
+        returns = []
+        points = list(history)
+        for (t0, p0), (t1, p1) in zip(points, points[1:]):
+            dt = t1 - t0
+            if dt <= 0 or p0 <= 0:
+                continue
+            returns.append((p1 - p0) / p0 / math.sqrt(dt / 60.0))
+        if len(returns) < 2:
+            return 0.0
+        mean = sum(returns) / len(returns)
+        return math.sqrt(sum((r - mean) ** 2 for r in returns) / (len(returns) - 1))
+
+    def compute_interval(self, position_value: Decimal, volatility: float) -> float:
+        """
+        Интервал = базовый / вес, где вес растет со стоимостью позиции
+        и волатильностью. Результат ограничен [min_interval, max_interval].
+        """
+        if position_value is None or position_value <= 0 or self.reference_value <= 0:
+            return self.max_interval
+        weight = float(position_value / self.reference_value)
+        if self.reference_volatility > 0:
+            weight *= 1.0 + volatility / self.reference_volatility
+        if weight <= 0:
+            return self.max_interval
+        return min(self.max_interval, max(self.min_interval, self.base_interval / weight))
+
+    def _budget_scale(self) -> float:
+        """Во сколько раз растянуть интервалы, чтобы суммарный темп уложился в бюджет."""
+        total_rate = sum(self._rates.values())
+        if total_rate <= self._max_rate:
+            return 1.0
+        return total_rate / self._max_rate
+
+    def record_price(self, key: PollKey, price: Decimal, position_value: Decimal) -> float:
+        """Учитывает новую цену и планирует следующий опрос. Возвращает интервал."""
+        now = self._clock()
+        history = self._history.setdefault(
+            key, deque(maxlen=self.volatility_window))
+        history.append((now, float(price)))
+        interval = self.compute_interval(position_value, self._volatility(key))
+        self._rates[key] = 1.0 / interval
+        interval *= self._budget_scale()
+        self._push(key, now + interval)
+        return interval
+
+    def record_failure(self, key: PollKey, retry_after: Optional[float] = None) -> None:
+        """Перепланирует ключ после неудачного запроса (без учета цены)."""
+        delay = retry_after if retry_after is not None else self.base_interval
+        self._push(key, self._clock() + min(self.max_interval, max(self.min_interval, delay)))
@@ -3,23 +3,41 @@ import asyncio
 import logging
 import os
 import datetime
+import time
 from decimal import Decimal
-from typing import List
+from typing import Dict, Optional, Tuple
 
 import ccxt.async_support as ccxt_async
 
 # Импортируем наши новые, чистые модули
 import sheets_service
 import config
+import ledger_locks
+import ledger_rebuild
+import market_cache
+import notifier
 from models import PositionData
+from price_scheduler import AdaptivePollScheduler
+from circuit_breaker import CircuitBreaker, CircuitBreakerRegistry
+from alert_engine import PriceAlertEngine
 
 # --- Настройка логгера ---
 # (Код настройки логгера остается без изменений, можно скопировать из вашей версии)
 logger = logging.getLogger(__name__)
 
 
+# Поля, которые updater пишет в Open_Positions. Количество и средняя цена
+# принадлежат trade_logger, поэтому updater их не перезаписывает.
+PRICE_UPDATE_FIELDS = ('current_price', 'unrealized_pnl', 'last_updated')
+
+
 # --- Логика работы с CCXT ---
 ccxt_exchange_cache = {}
+circuit_breakers = CircuitBreakerRegistry(
+    failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+    cooldown_seconds=config.CIRCUIT_COOLDOWN_SECONDS,
+    max_cooldown_seconds=config.CIRCUIT_MAX_COOLDOWN_SECONDS,
+)
 
 
 async def get_ccxt_exchange(exchange_name: str):
@@ -29,12 +47,14 @@ async def get_ccxt_exchange(exchange_name: str):
     try:
         exchange_class = getattr(ccxt_async, exchange_name.lower())
         exchange = exchange_class()
-        ccxt_exchange_cache[exchange_name] = exchange
-        logger.info(f"Инициализирован экземпляр CCXT для {exchange_name}")
-        return exchange
     except AttributeError:
         logger.error(f"Биржа {exchange_name} не найдена в CCXT.")
         return None
+    # Рынки берутся из дискового кэша; load_markets выполняется только при его отсутствии
+    await market_cache.ensure_markets_async(exchange)
+    ccxt_exchange_cache[exchange_name] = exchange
+    logger.info(f"Инициализирован экземпляр CCXT для {exchange_name}")
+    return exchange
 
 
 async def close_all_ccxt_exchanges():
@@ -46,99 +66,238 @@ async def close_all_ccxt_exchanges():
     ccxt_exchange_cache.clear()
 
 
-async def fetch_current_price(exchange_instance, symbol: str) -> Decimal | None:
-    """Получает текущую цену для символа с указанной биржи."""
+async def fetch_current_price(exchange_instance, symbol: str, breaker: Optional[CircuitBreaker] = None) -> Decimal | None:
+    """
+    Получает текущую цену для символа с указанной биржи.
+    Сетевые ошибки и недоступность биржи учитываются в breaker; ошибки конкретного
+    символа (например, неизвестная пара) говорят о том, что биржа отвечает.
+    """
     if not exchange_instance:
         return None
     try:
         ticker = await exchange_instance.fetch_ticker(symbol)
-        if ticker and 'last' in ticker and ticker['last'] is not None:
-            return Decimal(str(ticker['last']))
-        logger.warning(
-            f"Не удалось получить цену для {symbol} на {exchange_instance.id}.")
+    except ccxt_async.NetworkError as e:
+        logger.error(
+            f"Сетевая ошибка CCXT для {symbol} на {exchange_instance.id}: {e}")
+        if breaker:
+            breaker.record_failure(str(e))
+        return None
     except Exception as e:
         logger.error(
             f"Ошибка CCXT для {symbol} на {exchange_instance.id}: {e}")
+        if breaker:
+            breaker.record_success()
+        return None
+    if breaker:
+        breaker.record_success()
+    if ticker and 'last' in ticker and ticker['last'] is not None:
+        return Decimal(str(ticker['last']))
+    logger.warning(
+        f"Не удалось получить цену для {symbol} на {exchange_instance.id}.")
     return None
 
 
-async def update_prices_and_pnl():
-    """Главная функция: получает позиции, запрашивает цены и обновляет PNL."""
-    logger.info("Запуск цикла обновления цен...")
-    update_successful = True
+def _publish_health() -> None:
+    """Публикует состояние circuit breaker'ов бирж в System_Status."""
+    snapshot = circuit_breakers.snapshot()
+    if snapshot:
+        sheets_service.update_exchange_health(snapshot, _status_timestamp())
 
-    try:
-        # 1. Получаем список объектов PositionData
-        open_positions: List[PositionData] = sheets_service.get_all_open_positions(
-        )
-        if not open_positions:
-            logger.info("Нет открытых позиций для обновления.")
-            # Важно вернуть True, т.к. ошибки не было, просто нет работы
-            update_successful = True
-            return
 
-        updated_positions: List[PositionData] = []
+def _apply_price(position: PositionData, current_price: Decimal) -> None:
+    """Записывает в модель новую цену и пересчитанный нереализованный PNL."""
+    position.current_price = current_price
+    position.unrealized_pnl = (
+        current_price - position.avg_entry_price) * position.net_amount
+    position.last_updated = datetime.datetime.now()
 
-        for position in open_positions:
-            # 2. Работаем с чистыми данными из моделей
-            if not all([position.symbol, position.exchange, position.net_amount, position.avg_entry_price]):
-                logger.warning(
-                    f"Пропуск позиции с неполными данными: {position}")
-                continue
 
-            exchange_instance = await get_ccxt_exchange(position.exchange)
-            current_price = await fetch_current_price(exchange_instance, position.symbol)
+def _is_updatable(position: PositionData) -> bool:
+    return all([position.symbol, position.exchange, position.net_amount, position.avg_entry_price])
 
-            if current_price is None:
-                continue
 
-            # 3. Рассчитываем PNL напрямую, без парсинга строк
-            unrealized_pnl = (
-                current_price - position.avg_entry_price) * position.net_amount
+def _status_timestamp() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).astimezone(
+        datetime.timezone(datetime.timedelta(hours=config.TZ_OFFSET_HOURS))
+    )
 
-            # 4. Обновляем сам объект модели
-            position.current_price = current_price
-            position.unrealized_pnl = unrealized_pnl
-            position.last_updated = datetime.datetime.now()
 
-            updated_positions.append(position)
+def _build_scheduler() -> AdaptivePollScheduler:
+    return AdaptivePollScheduler(
+        base_interval=config.PRICE_UPDATE_INTERVAL_SECONDS,
+        min_interval=config.PRICE_POLL_MIN_INTERVAL_SECONDS,
+        max_interval=config.PRICE_POLL_MAX_INTERVAL_SECONDS,
+        max_requests_per_minute=config.PRICE_POLL_MAX_REQUESTS_PER_MINUTE,
+        reference_value=Decimal(config.PRICE_POLL_REFERENCE_VALUE),
+        reference_volatility=config.PRICE_POLL_REFERENCE_VOLATILITY,
+    )
 
-        # 5. Отправляем все обновленные объекты на пакетную запись
-        if updated_positions:
-            if not sheets_service.batch_update_positions(updated_positions):
-                update_successful = False
-                logger.error("Ошибка во время пакетного обновления позиций.")
 
-    except Exception as e:
-        logger.error(
-            f"Критическая ошибка в цикле обновления цен: {e}", exc_info=True)
-        update_successful = False
-    finally:
-        # 6. Обновляем статус с помощью новой, безопасной функции
-        timestamp = datetime.datetime.now(datetime.timezone.utc).astimezone(
-            datetime.timezone(datetime.timedelta(hours=config.TZ_OFFSET_HOURS))
-        )
-        status = "OK" if update_successful else "ERROR"
+def _load_positions() -> Dict[Tuple[str, str], PositionData]:
+    """Читает открытые позиции и индексирует их по (символ, биржа)."""
+    positions = {}
+    for position in sheets_service.get_all_open_positions():
+        if not _is_updatable(position):
+            logger.warning(f"Пропуск позиции с неполными данными: {position}")
+            continue
+        positions[(position.symbol.upper(), position.exchange.lower())] = position
+    return positions
+
+
+def _read_layout_version() -> str:
+    with ledger_locks.sheet_layout(config.OPEN_POSITIONS_SHEET_NAME) as version:
+        return version
+
+
+def _refresh_row_numbers(positions: Dict[Tuple[str, str], PositionData],
+                         pending: Dict[Tuple[str, str], PositionData]) -> None:
+    """Строки листа сдвинуты сжатием или перестройкой: берем актуальные номера строк."""
+    fresh = _load_positions()
+    for key in list(positions):
+        if key in fresh:
+            positions[key].row_number = fresh[key].row_number
+        else:
+            del positions[key]
+            pending.pop(key, None)
+
 
-        # --- ВОТ ЭТА СТРОКА БЫЛА ПРОПУЩЕНА ---
-        sheets_service.update_system_status(status, timestamp)
-        # ------------------------------------
+def _flush_price_updates(positions: Dict[Tuple[str, str], PositionData],
+                         pending: Dict[Tuple[str, str], PositionData], layout_version: str) -> str:
+    """
+    Сбрасывает накопленные цены в таблицу одним пакетом и обновляет статус. Запись
+    идет по номерам строк под блокировкой расположения листа: если строки успели
+    сдвинуть, номера сначала перечитываются. Возвращает актуальную метку расположения.
+    """
+    success = True
+    if pending:
+        with ledger_locks.sheet_layout(config.OPEN_POSITIONS_SHEET_NAME) as current_layout:
+            if current_layout != layout_version:
+                _refresh_row_numbers(positions, pending)
+                layout_version = current_layout
+            success = sheets_service.batch_update_position_fields(
+                list(pending.values()), PRICE_UPDATE_FIELDS)
+        if success:
+            logger.info(f"Записаны цены для {len(pending)} позиций.")
+            pending.clear()
+            ledger_locks.bump_marker(ledger_locks.PRICES_MARKER)
+        else:
+            logger.error("Ошибка во время пакетного обновления позиций.")
+    sheets_service.update_system_status(
+        "OK" if success else "ERROR", _status_timestamp())
+    _publish_health()
+    return layout_version
+
+
+def _build_alert_engine() -> Optional[PriceAlertEngine]:
+    if not config.PRICE_ALERTS_ENABLED:
+        return None
+    return PriceAlertEngine(fired_store_path=os.path.join(config.STATE_DIR, 'fired_alerts.json'))
+
+
+def _reload_alert_levels(engine: PriceAlertEngine, positions: Dict[Tuple[str, str], PositionData]) -> None:
+    try:
+        engine.load_levels(
+            sheets_service.get_all_core_trades(), positions.values())
+    except Exception as e:
+        logger.error(f"Ошибка загрузки уровней SL/TP: {e}", exc_info=True)
 
 
 async def main_loop():
-    """Главный цикл, запускающий обновление цен с заданным интервалом."""
-    update_interval = config.PRICE_UPDATE_INTERVAL_SECONDS
-    logger.info(f"Price updater запущен. Интервал: {update_interval} секунд.")
+    """
+    Главный цикл: позиции опрашиваются по адаптивному расписанию,
+    полученные цены копятся и сбрасываются в таблицу пакетами.
+    """
+    scheduler = _build_scheduler()
+    alert_engine = _build_alert_engine()
+    logger.info(
+        f"Price updater запущен. Интервалы опроса: {config.PRICE_POLL_MIN_INTERVAL_SECONDS}-"
+        f"{config.PRICE_POLL_MAX_INTERVAL_SECONDS} с, бюджет "
+        f"{config.PRICE_POLL_MAX_REQUESTS_PER_MINUTE} запросов/мин.")
+
+    positions: Dict[Tuple[str, str], PositionData] = {}
+    pending: Dict[Tuple[str, str], PositionData] = {}
+    layout_version = ''
+    last_refresh = last_flush = last_levels_refresh = last_compaction = float('-inf')
 
     while True:
-        await update_prices_and_pnl()
-        logger.info(
-            f"Ожидание следующего обновления через {update_interval} секунд...")
-        await asyncio.sleep(update_interval)
+        now = time.monotonic()
+        try:
+            if config.POSITIONS_COMPACTION_INTERVAL_SECONDS and \
+                    now - last_compaction >= config.POSITIONS_COMPACTION_INTERVAL_SECONDS:
+                # Удаление строк закрытых позиций; сдвиг строк заметит следующий сброс цен
+                success, message = await asyncio.to_thread(ledger_rebuild.compact_positions)
+                if not success:
+                    logger.error(f"Сжатие листа позиций не выполнено: {message}")
+                last_compaction = now
+            if now - last_refresh >= config.PRICE_POSITIONS_REFRESH_SECONDS:
+                layout_version = _read_layout_version()
+                positions = _load_positions()
+                scheduler.sync(list(positions))
+                # Накопленные цены для исчезнувших позиций больше не актуальны
+                for key in list(pending):
+                    if key not in positions:
+                        del pending[key]
+                last_refresh = now
+                if not positions:
+                    logger.info("Нет открытых позиций для обновления.")
+                if alert_engine and now - last_levels_refresh >= config.ALERT_LEVELS_REFRESH_SECONDS:
+                    _reload_alert_levels(alert_engine, positions)
+                    last_levels_refresh = now
+
+            for key in scheduler.pop_due():
+                position = positions.get(key)
+                if position is None:
+                    continue
+                breaker = circuit_breakers.get(position.exchange)
+                if not breaker.allow_request():
+                    # Биржа недоступна: не тратим время цикла, ждем окончания паузы
+                    scheduler.record_failure(
+                        key, retry_after=breaker.seconds_until_retry())
+                    continue
+                exchange_instance = await get_ccxt_exchange(position.exchange)
+                current_price = await fetch_current_price(exchange_instance, position.symbol, breaker)
+                if current_price is None:
+                    scheduler.record_failure(
+                        key, retry_after=breaker.seconds_until_retry() or None)
+                    continue
+                _apply_price(position, current_price)
+                pending[key] = position
+                if alert_engine:
+                    await alert_engine.on_price(position.symbol, position.exchange, current_price)
+                interval = scheduler.record_price(
+                    key, current_price, abs(position.net_amount * current_price))
+                logger.debug(
+                    f"{position.symbol} ({position.exchange}): {current_price}, следующий опрос через {interval:.0f} с.")
+
+            if time.monotonic() - last_flush >= config.PRICE_WRITE_FLUSH_SECONDS:
+                layout_version = _flush_price_updates(positions, pending, layout_version)
+                last_flush = time.monotonic()
+        except Exception as e:
+            logger.error(
+                f"Критическая ошибка в цикле обновления цен: {e}", exc_info=True)
+            sheets_service.update_system_status("ERROR", _status_timestamp())
+
+        now = time.monotonic()
+        wait = min(
+            config.PRICE_POSITIONS_REFRESH_SECONDS - (now - last_refresh),
+            config.PRICE_WRITE_FLUSH_SECONDS - (now - last_flush),
+        )
+        next_poll = scheduler.seconds_until_next()
+        if next_poll is not None:
+            wait = min(wait, next_poll)
+        await asyncio.sleep(max(0.5, wait))
+
+async def run_until_stopped():
+    try:
+        await main_loop()
+    finally:
+        # Алерты, оставшиеся в очереди notifier, отправляются до закрытия цикла событий
+        await notifier.get_outbox().close(config.NOTIFIER_SHUTDOWN_TIMEOUT_SECONDS)
+
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main_loop())
+        asyncio.run(run_until_stopped())
     except KeyboardInterrupt:
         logger.info("Price updater остановлен вручную.")
     finally:
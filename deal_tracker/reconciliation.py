@@ -0,0 +1,234 @@
+# deal_tracker/reconciliation.py
+"""
+Сверка Account_Balances с реальными балансами бирж.
+
+Балансы всех бирж запрашиваются параллельно, по одному fetch_balance на биржу,
+локальные балансы читаются из Account_Balances одним чтением листа. Расхождения
+выше порога (RECONCILE_ABS_THRESHOLD и RECONCILE_REL_THRESHOLD_PCT) попадают
+в отчет; по запросу они исправляются корректирующими движениями (DEPOSIT или
+WITHDRAWAL на разницу), записанными одним пакетом через log_balance_adjustments:
+разница пересчитывается под блокировками по текущему балансу, а не по снимку.
+Если Account_Balances не прочитался, сверка не выполняется.
+
+Запуск:
+    python reconciliation.py [--exchanges binance,bybit] [--apply]
+"""
+import argparse
+import asyncio
+import html
+import logging
+import re
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import ccxt.async_support as ccxt_async
+
+import config
+import exchange_sync
+import sheets_service
+import trade_logger
+from models import BalanceData, MovementData
+
+logger = logging.getLogger(__name__)
+
+CORRECTION_NOTE = 'Корректировка по сверке с биржей'
+LEDGER_ERROR_KEY = 'учет'
+
+
+@dataclass
+class BalanceMismatch:
+    exchange: str
+    asset: str
+    local: Decimal
+    remote: Decimal
+
+    @property
+    def difference(self) -> Decimal:
+        return self.remote - self.local
+
+
+@dataclass
+class ReconciliationReport:
+    """Итог сверки: расхождения, ошибки запросов к биржам и результат корректировок."""
+    mismatches: List[BalanceMismatch] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)
+    checked: Dict[str, int] = field(default_factory=dict)
+    corrections_applied: int = 0
+    corrections_failed: List[str] = field(default_factory=list)
+
+
+async def _fetch_balance(exchange_id: str, exchange_factory: exchange_sync.ExchangeFactory,
+                         semaphore: asyncio.Semaphore) -> Dict[str, Decimal]:
+    async with semaphore:
+        exchange = await exchange_factory(exchange_id)
+        try:
+            balance = await exchange.fetch_balance()
+        finally:
+            if hasattr(exchange, 'close'):
+                await exchange.close()
+    return {asset.upper(): Decimal(str(total))
+            for asset, total in (balance.get('total') or {}).items() if total is not None}
+
+
+async def fetch_exchange_balances(
+    exchange_ids: List[str],
+    exchange_factory: Optional[exchange_sync.ExchangeFactory] = None,
+    max_concurrency: Optional[int] = None,
+) -> Tuple[Dict[str, Dict[str, Decimal]], Dict[str, str]]:
+    """Балансы бирж {биржа: {актив: total}} и ошибки {биржа: текст}."""
+    factory = exchange_factory or exchange_sync.create_exchange
+    semaphore = asyncio.Semaphore(max(1, max_concurrency or config.SYNC_MAX_CONCURRENCY))
+    results = await asyncio.gather(
+        *(_fetch_balance(e, factory, semaphore) for e in exchange_ids), return_exceptions=True)
+    balances, errors = {}, {}
+    for exchange_id, result in zip(exchange_ids, results):
+        if isinstance(result, ccxt_async.BaseError):
+            errors[exchange_id] = f"Ошибка CCXT: {result}"
+        elif isinstance(result, Exception):
+            errors[exchange_id] = str(result)
+        else:
+            balances[exchange_id] = result
+    return balances, errors
+
+
+def _is_significant(local: Decimal, remote: Decimal) -> bool:
+    diff = abs(remote - local)
+    if diff <= Decimal(config.RECONCILE_ABS_THRESHOLD):
+        return False
+    base = max(abs(local), abs(remote))
+    return diff * 100 > base * Decimal(config.RECONCILE_REL_THRESHOLD_PCT)
+
+
+def diff_balances(local: Dict[Tuple[str, str], Decimal],
+                  remote: Dict[str, Dict[str, Decimal]]) -> Tuple[List[BalanceMismatch], Dict[str, int]]:
+    """Сравнивает локальные балансы (счет, актив) с балансами бирж за один проход."""
+    local_by_exchange: Dict[str, Dict[str, Decimal]] = {}
+    for (account, asset), value in local.items():
+        if account in remote:
+            local_by_exchange.setdefault(account, {})[asset] = value
+    mismatches, checked = [], {}
+    for exchange_id, remote_assets in remote.items():
+        local_assets = local_by_exchange.get(exchange_id, {})
+        assets = set(local_assets) | set(remote_assets)
+        checked[exchange_id] = len(assets)
+        for asset in sorted(assets):
+            local_value = local_assets.get(asset, Decimal('0'))
+            remote_value = remote_assets.get(asset, Decimal('0'))
+            if _is_significant(local_value, remote_value):
+                mismatches.append(BalanceMismatch(exchange_id, asset, local_value, remote_value))
+    return mismatches, checked
+
+
+def _local_balances() -> Optional[Dict[Tuple[str, str], Decimal]]:
+    """Балансы из Account_Balances или None, если лист не прочитался."""
+    records = sheets_service.read_all_records(config.ACCOUNT_BALANCES_SHEET_NAME, BalanceData)
+    if records is None:
+        return None
+    balances: Dict[Tuple[str, str], Decimal] = {}
+    for b in records:
+        if b.account_name and b.asset:
+            key = (b.account_name.strip().lower(), b.asset.strip().upper())
+            balances[key] = balances.get(key, Decimal('0')) + (b.balance or Decimal('0'))
+    return balances
+
+
+def build_corrections(mismatches: List[BalanceMismatch]) -> List[MovementData]:
+    """Движения, приводящие локальные балансы к биржевым."""
+    run_id = uuid.uuid4().hex[:8]
+    now = datetime.now(timezone(timedelta(hours=config.TZ_OFFSET_HOURS)))
+    corrections = []
+    for m in mismatches:
+        is_deposit = m.difference > 0
+        corrections.append(MovementData(
+            timestamp=now,
+            movement_type='DEPOSIT' if is_deposit else 'WITHDRAWAL',
+            asset=m.asset, amount=abs(m.difference),
+            source_name=None if is_deposit else m.exchange,
+            destination_name=m.exchange if is_deposit else None,
+            # Ключ дедупликации: повтор того же пакета не применит корректировку дважды
+            transaction_id_blockchain=f"reconcile:{run_id}:{m.exchange}:{m.asset}",
+            notes=CORRECTION_NOTE,
+        ))
+    return corrections
+
+
+async def reconcile(
+    exchange_ids: Optional[List[str]] = None,
+    apply: bool = False,
+    exchange_factory: Optional[exchange_sync.ExchangeFactory] = None,
+) -> ReconciliationReport:
+    """Сверяет балансы бирж с Account_Balances; при apply=True записывает корректировки."""
+    exchange_ids = [e.lower() for e in (exchange_ids or config.RECONCILE_EXCHANGES)]
+    report = ReconciliationReport()
+    (remote, report.errors), local = await asyncio.gather(
+        fetch_exchange_balances(exchange_ids, exchange_factory),
+        asyncio.to_thread(_local_balances))
+    if local is None:
+        # Без локальных балансов каждый биржевой баланс выглядел бы расхождением
+        report.errors[LEDGER_ERROR_KEY] = "Не удалось прочитать Account_Balances, сверка не выполнена."
+        logger.error(report.errors[LEDGER_ERROR_KEY])
+        return report
+    report.mismatches, report.checked = diff_balances(local, remote)
+    logger.info(f"Сверка балансов: бирж {len(remote)}, расхождений {len(report.mismatches)}, "
+                f"ошибок {len(report.errors)}.")
+
+    if apply and report.mismatches:
+        # Разница пересчитывается под блокировками ключей: снимок выше мог устареть
+        results = await asyncio.to_thread(
+            trade_logger.log_balance_adjustments, build_corrections(report.mismatches),
+            [m.remote for m in report.mismatches], _is_significant)
+        for mismatch, result in zip(report.mismatches, results):
+            if result.success or result.duplicate:
+                report.corrections_applied += 1
+            else:
+                report.corrections_failed.append(f"{mismatch.exchange} {mismatch.asset}: {result.message}")
+        logger.info(f"Сверка балансов: применено корректировок {report.corrections_applied}, "
+                    f"ошибок {len(report.corrections_failed)}.")
+    return report
+
+
+def _fmt(value: Decimal) -> str:
+    return format(value.normalize(), 'f')
+
+
+def format_report(report: ReconciliationReport) -> str:
+    """Отчет сверки в HTML для Telegram."""
+    lines = ["<u><b>⚖️ Сверка балансов с биржами</b></u>"]
+    for exchange_id, count in sorted(report.checked.items()):
+        lines.append(f"{exchange_id}: проверено активов {count}")
+    for exchange_id, error in sorted(report.errors.items()):
+        lines.append(f"❌ {exchange_id}: {html.escape(error)}")
+    if not report.mismatches:
+        lines.append("✅ Расхождений нет." if report.checked else "Нет данных для сверки.")
+    else:
+        lines.append(f"\n<b>Расхождения ({len(report.mismatches)}):</b>")
+        for m in report.mismatches:
+            lines.append(f"<code>{m.exchange} {m.asset}: учет {_fmt(m.local)}, "
+                         f"биржа {_fmt(m.remote)}, разница {'+' if m.difference > 0 else ''}{_fmt(m.difference)}</code>")
+    if report.corrections_applied or report.corrections_failed:
+        lines.append(f"\nКорректировок записано: {report.corrections_applied}")
+        for failure in report.corrections_failed:
+            lines.append(f"❌ {html.escape(failure)}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Сверка Account_Balances с балансами бирж.")
+    parser.add_argument('--exchanges', help="Биржи через запятую (по умолчанию RECONCILE_EXCHANGES)")
+    parser.add_argument('--apply', action='store_true', help="Записать корректирующие движения")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=config.LOG_LEVEL,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    exchange_ids = [e.strip() for e in args.exchanges.split(',')] if args.exchanges else None
+    if not (exchange_ids or config.RECONCILE_EXCHANGES):
+        parser.error("Не заданы биржи: RECONCILE_EXCHANGES/SYNC_EXCHANGES или --exchanges.")
+    report = asyncio.run(reconcile(exchange_ids, apply=args.apply))
+    print(html.unescape(re.sub(r'<[^>]+>', '', format_report(report))))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,18 @@
 # deal_tracker/sheets_service.py
 import gspread
+import hashlib
+import json
 import logging
+import re
 from decimal import Decimal, InvalidOperation
 from datetime import datetime
-from typing import TypeVar, Type, Optional, List, Dict, Any, get_type_hints
+from typing import TypeVar, Type, Optional, List, Dict, Any, Sequence, Tuple, Union, get_args, get_origin, get_type_hints
 
 from dateutil.parser import parse as parse_datetime
 from oauth2client.service_account import ServiceAccountCredentials
 
 import config
+import ledger_locks
 from models import TradeData, MovementData, PositionData, BalanceData, FifoLogData, AnalyticsData
 
 logger = logging.getLogger(__name__)
@@ -16,6 +20,8 @@ logger = logging.getLogger(__name__)
 # --- Определение Generic Type и кэшей ---
 T = TypeVar('T')
 _gspread_client: Optional[gspread.Client] = None
+_spreadsheet: Optional[gspread.Spreadsheet] = None
+_worksheet_cache: Dict[str, gspread.Worksheet] = {}
 _header_cache: Dict[str, List[str]] = {}
 
 # --- ИСПРАВЛЕННАЯ Карта сопоставления полей и названий столбцов ---
@@ -38,6 +44,8 @@ FIELD_TO_SHEET_NAMES_MAP: Dict[str, List[str]] = {
     'trade_id': ['Trade_ID', 'ID Сделки'], 'order_id': ['Order_ID', 'ID ордера'],
     'total_quote_amount': ['Total_Quote_Amount', 'Объем в валюте котировки'], 'trade_pnl': ['Trade_PNL', 'PNL по сделке'],
     'fifo_consumed_qty': ['Fifo_Consumed_Qty', 'FIFO Потреблено'], 'fifo_sell_processed': ['Fifo_Sell_Processed', 'FIFO Продажа Обработана'],
+    'sl': ['SL', 'Stop_Loss'], 'tp1': ['TP1', 'Take_Profit_1'], 'tp2': ['TP2', 'Take_Profit_2'], 'tp3': ['TP3', 'Take_Profit_3'],
+    'risk_usd': ['Risk_USD', 'Риск'],
 
     # MovementData
     'movement_id': ['Movement_ID', 'ID Движения'], 'asset': ['Asset', 'Актив', 'Валюта'],
@@ -50,6 +58,7 @@ FIELD_TO_SHEET_NAMES_MAP: Dict[str, List[str]] = {
     'avg_entry_price': ['Avg_Entry_Price', 'Avg Price', 'Средняя цена входа'],
     'current_price': ['Current_Price', 'Текущая цена'], 'unrealized_pnl': ['Unrealized_PNL', 'Unreal PNL', 'Нереализованный PNL'],
     'last_updated': ['Last_Updated', 'Последнее обновление'],
+    'is_closed': ['Is_Closed', 'Закрыта'], 'closed_at': ['Closed_At', 'Дата закрытия'],
 
     # BalanceData
     'account_name': ['Account_Name', 'Счет'], 'balance': ['Balance', 'Баланс'], 'entity_type': ['Entity_Type', 'Тип счета'],
@@ -106,11 +115,26 @@ def _get_client() -> gspread.Client:
     return _gspread_client
 
 
+def _get_spreadsheet() -> gspread.Spreadsheet:
+    global _spreadsheet
+    if _spreadsheet is None:
+        if config.SHEETS_BACKEND == 'local':
+            import local_sheets
+            _spreadsheet = local_sheets.LocalSpreadsheet(
+                config.LOCAL_SHEETS_PATH or None, config.LOCAL_SHEETS_LATENCY_MS / 1000)
+        else:
+            _spreadsheet = _get_client().open_by_key(config.SPREADSHEET_ID)
+    return _spreadsheet
+
+
 def _get_sheet_by_name(sheet_name: str) -> Optional[gspread.Worksheet]:
+    # Объекты листов кэшируются: каждое открытие - это отдельный запрос метаданных
+    if sheet_name in _worksheet_cache:
+        return _worksheet_cache[sheet_name]
     try:
-        client = _get_client()
-        spreadsheet = client.open_by_key(config.SPREADSHEET_ID)
-        return spreadsheet.worksheet(sheet_name)
+        worksheet = _get_spreadsheet().worksheet(sheet_name)
+        _worksheet_cache[sheet_name] = worksheet
+        return worksheet
     except Exception as e:
         logger.error(f"Ошибка доступа к листу '{sheet_name}': {e}")
         return None
@@ -145,6 +169,9 @@ def _build_model_from_row(row: List[str], headers: List[str], model_cls: Type[T]
         raw_value = row[col_idx] if col_idx < len(row) else None
         try:
             origin_type = getattr(field_type, '__origin__', field_type)
+            if get_origin(field_type) is Union:
+                # Optional[X] -> X
+                origin_type = next(a for a in get_args(field_type) if a is not type(None))
             if origin_type is Decimal:
                 kwargs[field_name] = _parse_decimal(raw_value)
             elif origin_type is datetime:
@@ -175,6 +202,18 @@ def _build_model_from_row(row: List[str], headers: List[str], model_cls: Type[T]
         return None
 
 
+def _format_value(value: Any) -> str:
+    if isinstance(value, Decimal):
+        return _format_decimal(value)
+    if isinstance(value, datetime):
+        return _format_datetime(value)
+    if isinstance(value, bool):
+        return _format_bool(value)
+    if value is not None:
+        return str(value)
+    return ""
+
+
 def _model_to_row(record: Any, headers: List[str]) -> List[str]:
     row_to_append = []
     record_dict = record.__dict__
@@ -186,29 +225,72 @@ def _model_to_row(record: Any, headers: List[str]) -> List[str]:
             if header.lower() in [p.lower() for p in possible_names]:
                 field_name_found = f_name
                 break
+        # Как и в _find_column_index: заголовок может совпадать с именем поля
+        if not field_name_found and header.lower() in record_dict:
+            field_name_found = header.lower()
         if field_name_found and field_name_found in record_dict:
-            value = record_dict[field_name_found]
-            if isinstance(value, Decimal):
-                formatted_value = _format_decimal(value)
-            elif isinstance(value, datetime):
-                formatted_value = _format_datetime(value)
-            elif isinstance(value, bool):
-                formatted_value = _format_bool(value)
-            elif value is not None:
-                formatted_value = str(value)
+            formatted_value = _format_value(record_dict[field_name_found])
         row_to_append.append(formatted_value)
     return row_to_append
 
+
+def _find_column_index(headers: List[str], field_name: str) -> int:
+    """Возвращает номер столбца (с 1) для поля модели или -1, если столбца нет."""
+    headers_lower = [h.lower() for h in headers]
+    for name in FIELD_TO_SHEET_NAMES_MAP.get(field_name, [field_name]):
+        if name.lower() in headers_lower:
+            return headers_lower.index(name.lower()) + 1
+    return -1
+
+
+def _merge_contiguous_cells(cells: List[Tuple[int, int, str]]) -> List[Dict[str, Any]]:
+    """
+    Склеивает отдельные ячейки (row, col, value) в минимальный набор диапазонов.
+    Сначала соседние столбцы одной строки объединяются в отрезки, затем отрезки
+    с одинаковыми столбцами в идущих подряд строках - в прямоугольные блоки.
+    """
+    # 1. Горизонтальная склейка в отрезки (row, first_col, last_col, values)
+    segments: List[Tuple[int, int, int, List[str]]] = []
+    for row, col, value in sorted(cells, key=lambda c: (c[0], c[1])):
+        if segments and segments[-1][0] == row and segments[-1][2] + 1 == col:
+            r, c0, _, values = segments[-1]
+            values.append(value)
+            segments[-1] = (r, c0, col, values)
+        else:
+            segments.append((row, col, col, [value]))
+
+    # 2. Вертикальная склейка отрезков с одинаковыми границами столбцов
+    blocks: List[Tuple[int, int, int, int, List[List[str]]]] = []
+    for row, c0, c1, values in sorted(segments, key=lambda s: (s[1], s[2], s[0])):
+        if blocks:
+            first_row, last_row, b_c0, b_c1, rows = blocks[-1]
+            if (b_c0, b_c1) == (c0, c1) and last_row + 1 == row:
+                rows.append(values)
+                blocks[-1] = (first_row, row, c0, c1, rows)
+                continue
+        blocks.append((row, row, c0, c1, [values]))
+
+    payload = []
+    for first_row, last_row, c0, c1, rows in blocks:
+        range_str = f"{gspread.utils.rowcol_to_a1(first_row, c0)}:{gspread.utils.rowcol_to_a1(last_row, c1)}"
+        payload.append({'range': range_str, 'values': rows})
+    return payload
+
 # --- Универсальные функции для работы с записями ---
 
 
-def get_all_records(sheet_name: str, model_cls: Type[T]) -> List[T]:
+def read_all_records(sheet_name: str, model_cls: Type[T]) -> Optional[List[T]]:
+    """
+    Все записи листа или None, если лист или его заголовки не прочитались.
+    Нужен там, где пустой результат нельзя путать с ошибкой чтения
+    (перестройка учета, сверка балансов).
+    """
     sheet = _get_sheet_by_name(sheet_name)
     if not sheet:
-        return []
+        return None
     headers = _get_headers(sheet_name)
     if not headers:
-        return []
+        return None
     try:
         all_values = sheet.get_all_values()[1:]
         records = []
@@ -225,7 +307,13 @@ def get_all_records(sheet_name: str, model_cls: Type[T]) -> List[T]:
     except Exception as e:
         logger.error(
             f"Ошибка при чтении данных с листа '{sheet_name}': {e}", exc_info=True)
-        return []
+        return None
+
+
+def get_all_records(sheet_name: str, model_cls: Type[T]) -> List[T]:
+    """Все записи листа; при ошибке чтения - пустой список (ошибка пишется в лог)."""
+    records = read_all_records(sheet_name, model_cls)
+    return records if records is not None else []
 
 
 def append_record(sheet_name: str, record: Any) -> bool:
@@ -245,6 +333,128 @@ def append_record(sheet_name: str, record: Any) -> bool:
         return False
 
 
+def _parse_appended_first_row(response: Any) -> Optional[int]:
+    """Извлекает номер первой добавленной строки из ответа append (updatedRange вида 'Лист'!A5:G7)."""
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (KeyError, TypeError):
+        return None
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    return int(match.group(1)) if match else None
+
+
+def append_records(sheet_name: str, records: List[Any]) -> bool:
+    """Добавляет несколько записей одним запросом и проставляет им row_number."""
+    if not records:
+        return True
+    sheet = _get_sheet_by_name(sheet_name)
+    if not sheet:
+        return False
+    headers = _get_headers(sheet_name)
+    if not headers:
+        return False
+    try:
+        response = sheet.append_rows([_model_to_row(r, headers) for r in records],
+                                     value_input_option='USER_ENTERED')
+    except Exception as e:
+        logger.error(
+            f"Ошибка пакетного добавления в '{sheet_name}': {e}", exc_info=True)
+        return False
+    first_row = _parse_appended_first_row(response)
+    if first_row:
+        for i, record in enumerate(records):
+            if hasattr(record, 'row_number'):
+                record.row_number = first_row + i
+    return True
+
+
+def batch_update_records(sheet_name: str, records: List[Any]) -> bool:
+    """Перезаписывает строки записей целиком (по row_number) одним запросом."""
+    if not records:
+        return True
+    sheet = _get_sheet_by_name(sheet_name)
+    if not sheet:
+        return False
+    headers = _get_headers(sheet_name)
+    if not headers:
+        return False
+    last_col = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip('1')
+    payload = []
+    for record in records:
+        if record.row_number and record.row_number > 1:
+            payload.append({'range': f'A{record.row_number}:{last_col}{record.row_number}',
+                            'values': [_model_to_row(record, headers)]})
+    if not payload:
+        return True
+    try:
+        sheet.batch_update(payload, value_input_option='USER_ENTERED')
+        return True
+    except Exception as e:
+        logger.error(
+            f"Ошибка пакетного обновления строк на листе '{sheet_name}': {e}", exc_info=True)
+        return False
+
+
+def has_field(sheet_name: str, field_name: str) -> bool:
+    """Есть ли на листе столбец для поля модели."""
+    return _find_column_index(_get_headers(sheet_name), field_name) > 0
+
+
+def find_compactable_position_rows() -> Optional[List[int]]:
+    """Номера строк Open_Positions, которые можно удалить: закрытые позиции и пустые строки."""
+    sheet_name = config.OPEN_POSITIONS_SHEET_NAME
+    sheet = _get_sheet_by_name(sheet_name)
+    if not sheet:
+        return None
+    closed_col = _find_column_index(_get_headers(sheet_name), 'is_closed')
+    try:
+        values = sheet.get_all_values()
+    except Exception as e:
+        logger.error(f"Ошибка чтения листа '{sheet_name}': {e}", exc_info=True)
+        return None
+    # Пустой хвост листа удалять незачем: его строки никто не занимает
+    while values and not any(str(cell).strip() for cell in values[-1]):
+        values.pop()
+    rows = []
+    for row_number, row in enumerate(values[1:], start=2):
+        if not any(str(cell).strip() for cell in row):
+            rows.append(row_number)
+        elif 0 < closed_col <= len(row) and str(row[closed_col - 1]).strip().upper() == 'TRUE':
+            rows.append(row_number)
+    return rows
+
+
+def delete_rows_batch(sheet_name: str, row_numbers: List[int]) -> bool:
+    """
+    Удаляет строки одним запросом batchUpdate (диапазоны подряд идущих строк,
+    снизу вверх, чтобы удаление не сдвигало еще не удаленные). Столько же пустых
+    строк добавляется в конец: размер сетки не меняется, и процессы, знающие
+    прежний размер листа, не пишут за его пределы.
+    """
+    if not row_numbers:
+        return True
+    sheet = _get_sheet_by_name(sheet_name)
+    if not sheet:
+        return False
+    runs: List[List[int]] = []
+    for row in sorted(set(row_numbers)):
+        if runs and runs[-1][1] == row - 1:
+            runs[-1][1] = row
+        else:
+            runs.append([row, row])
+    requests = [{'deleteDimension': {'range': {'sheetId': sheet.id, 'dimension': 'ROWS',
+                                               'startIndex': first - 1, 'endIndex': last}}}
+                for first, last in reversed(runs)]
+    requests.append({'appendDimension': {'sheetId': sheet.id, 'dimension': 'ROWS',
+                                         'length': len(set(row_numbers))}})
+    try:
+        _get_spreadsheet().batch_update({'requests': requests})
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка удаления строк из '{sheet_name}': {e}", exc_info=True)
+        return False
+
+
 def delete_row(sheet_name: str, row_number: int) -> bool:
     try:
         sheet = _get_sheet_by_name(sheet_name)
@@ -269,7 +479,7 @@ def get_all_fund_movements() -> List[MovementData]:
 
 
 def get_all_open_positions() -> List[PositionData]:
-    return get_all_records(config.OPEN_POSITIONS_SHEET_NAME, PositionData)
+    return [p for p in get_all_records(config.OPEN_POSITIONS_SHEET_NAME, PositionData) if not p.is_closed]
 
 
 def get_all_balances() -> List[BalanceData]:
@@ -386,7 +596,62 @@ def batch_update_positions(positions: List[PositionData]) -> bool:
         return False
 
 
+def batch_update_fields(sheet_name: str, records: List[Any], fields: Sequence[str]) -> bool:
+    """
+    Частичное пакетное обновление: записывает только указанные поля записей.
+    Соседние ячейки склеиваются в диапазоны, остальные столбцы строки не трогаются.
+    """
+    if not records:
+        return True
+    sheet = _get_sheet_by_name(sheet_name)
+    if not sheet:
+        return False
+    headers = _get_headers(sheet_name)
+    if not headers:
+        return False
+    columns = {}
+    for field_name in fields:
+        col_idx = _find_column_index(headers, field_name)
+        if col_idx == -1:
+            logger.warning(
+                f"Поле '{field_name}' не найдено в заголовках листа '{sheet_name}'. Пропуск.")
+            continue
+        columns[field_name] = col_idx
+    cells = []
+    for record in records:
+        if not record.row_number or record.row_number < 2:
+            continue
+        for field_name, col_idx in columns.items():
+            cells.append((record.row_number, col_idx,
+                          _format_value(getattr(record, field_name, None))))
+    if not cells:
+        return True
+    payload = _merge_contiguous_cells(cells)
+    try:
+        sheet.batch_update(payload, value_input_option='USER_ENTERED')
+        return True
+    except Exception as e:
+        logger.error(
+            f"Ошибка частичного обновления полей {list(columns)} на листе '{sheet_name}': {e}", exc_info=True)
+        return False
+
+
+def batch_update_position_fields(positions: List[PositionData], fields: Sequence[str]) -> bool:
+    return batch_update_fields(config.OPEN_POSITIONS_SHEET_NAME, positions, fields)
+
+
 def batch_update_balances(changes: List[Dict[str, Any]]) -> bool:
+    # Чтение-изменение-запись под блокировками затронутых ключей (счет, актив)
+    keys = ledger_locks.balance_keys_for((c['account'], c['asset']) for c in changes)
+    with ledger_locks.account_locks(keys) as locked:
+        success = _batch_update_balances_unlocked(changes)
+        if success:
+            # Процессы с кэшем этих балансов перечитают их из таблицы
+            locked.bump()
+        return success
+
+
+def _batch_update_balances_unlocked(changes: List[Dict[str, Any]]) -> bool:
     sheet_name = config.ACCOUNT_BALANCES_SHEET_NAME
     sheet = _get_sheet_by_name(sheet_name)
     if not sheet:
@@ -442,12 +707,11 @@ def batch_update_trades_fifo_fields(updates: List[Dict[str, Any]]) -> bool:
     sheet = _get_sheet_by_name(sheet_name)
     if not sheet:
         return False
-    headers, headers_lower = _get_headers(
-        sheet_name), [h.lower() for h in _get_headers(sheet_name)]
-    try:
-        consumed_qty_col, processed_col = headers_lower.index(
-            'fifoconsumedqty') + 1, headers_lower.index('fifosellprocessed') + 1
-    except ValueError:
+    headers = _get_headers(sheet_name)
+    consumed_qty_col = _find_column_index(headers, 'fifo_consumed_qty')
+    processed_col = _find_column_index(headers, 'fifo_sell_processed')
+    if consumed_qty_col < 0 or processed_col < 0:
+        logger.error(f"На листе '{sheet_name}' нет столбцов FIFO (Fifo_Consumed_Qty, Fifo_Sell_Processed).")
         return False
     payload = []
     for update in updates:
@@ -489,3 +753,167 @@ def update_system_status(status: str, timestamp: datetime) -> bool:
     except Exception as e:
         logger.error(f"Ошибка обновления статуса системы: {e}", exc_info=True)
         return False
+
+
+EXCHANGE_HEALTH_HEADERS = ['Timestamp', 'Component',
+                           'Status', 'Last_Updated', 'Error_Message']
+
+
+def update_exchange_health(entries: List[Dict[str, Any]], timestamp: datetime) -> bool:
+    """
+    Записывает состояние бирж блоком в System_Status (начиная с EXCHANGE_HEALTH_START_ROW).
+    Блок всегда пишется целиком, с пустыми строками в конце, чтобы не оставалось устаревших записей.
+    """
+    sheet = _get_sheet_by_name(config.SYSTEM_STATUS_SHEET_NAME)
+    if not sheet:
+        return False
+    start_row = config.EXCHANGE_HEALTH_START_ROW
+    max_rows = config.EXCHANGE_HEALTH_MAX_ROWS
+    rows = [EXCHANGE_HEALTH_HEADERS]
+    for entry in entries[:max_rows]:
+        rows.append([_format_datetime(timestamp), str(entry.get('component', '')),
+                     str(entry.get('status', '')), _format_value(
+                         entry.get('last_success')),
+                     str(entry.get('error', ''))])
+    rows.extend([[''] * len(EXCHANGE_HEALTH_HEADERS)]
+                * (max_rows + 1 - len(rows)))
+    range_str = f"A{start_row}:{gspread.utils.rowcol_to_a1(start_row + max_rows, len(EXCHANGE_HEALTH_HEADERS))}"
+    try:
+        sheet.batch_update([{'range': range_str, 'values': rows}],
+                           value_input_option='USER_ENTERED')
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка записи состояния бирж: {e}", exc_info=True)
+        return False
+
+
+def get_exchange_health() -> List[Dict[str, str]]:
+    """Читает блок состояния бирж из System_Status."""
+    sheet = _get_sheet_by_name(config.SYSTEM_STATUS_SHEET_NAME)
+    if not sheet:
+        return []
+    first_row = config.EXCHANGE_HEALTH_START_ROW + 1
+    range_str = f"A{first_row}:{gspread.utils.rowcol_to_a1(first_row + config.EXCHANGE_HEALTH_MAX_ROWS - 1, len(EXCHANGE_HEALTH_HEADERS))}"
+    try:
+        values = sheet.get(range_str)
+    except Exception as e:
+        logger.error(f"Ошибка чтения состояния бирж: {e}")
+        return []
+    keys = ['timestamp', 'component', 'status', 'last_success', 'error']
+    return [dict(zip(keys, row + [''] * (len(keys) - len(row))))
+            for row in values if row and any(row)]
+
+
+# --- ПАКЕТНАЯ ЗАПИСЬ СРАЗУ В НЕСКОЛЬКО ЛИСТОВ ---
+
+
+def _a1_sheet_range(sheet_name: str, range_str: str) -> str:
+    return f"'{sheet_name.replace(chr(39), chr(39) * 2)}'!{range_str}"
+
+
+def get_last_row_number(sheet_name: str) -> Optional[int]:
+    """Номер последней заполненной строки листа (по столбцу A) или None при ошибке."""
+    sheet = _get_sheet_by_name(sheet_name)
+    if not sheet:
+        return None
+    try:
+        return max(1, len(sheet.col_values(1)))
+    except Exception as e:
+        logger.error(
+            f"Ошибка определения последней строки листа '{sheet_name}': {e}")
+        return None
+
+
+def get_sheets_fingerprint(sheet_names: Sequence[str], exclude_fields: Sequence[str] = ()) -> Optional[str]:
+    """
+    Отпечаток содержимого листов (SHA-1 всех значений) - по нему фоновые
+    задачи пропускают запуск, если данные не менялись. Столбцы exclude_fields
+    (например, FIFO-поля, которые пишет сама задача) в отпечаток не входят.
+    Каждый вызов читает листы целиком. None при ошибке чтения.
+    """
+    digest = hashlib.sha1()
+    for sheet_name in sheet_names:
+        sheet = _get_sheet_by_name(sheet_name)
+        if not sheet:
+            return None
+        try:
+            values = sheet.get_all_values()
+        except Exception as e:
+            logger.error(f"Ошибка чтения листа '{sheet_name}' для отпечатка: {e}")
+            return None
+        excluded = {_find_column_index(values[0], f) - 1 for f in exclude_fields} if values else set()
+        excluded.discard(-2)
+        if excluded:
+            values = [[cell for i, cell in enumerate(row) if i not in excluded] for row in values]
+        digest.update(json.dumps([sheet_name, values], ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def ensure_row_capacity(sheet_name: str, last_row: int) -> bool:
+    """
+    Гарантирует, что сетка листа вмещает строку last_row: запись значений по
+    явному диапазону за пределами сетки отклоняется API. Лист расширяется
+    с запасом SHEET_GROW_ROWS, поэтому дополнительный запрос нужен редко.
+    """
+    sheet = _get_sheet_by_name(sheet_name)
+    if not sheet:
+        return False
+    if last_row <= sheet.row_count:
+        return True
+    try:
+        sheet.add_rows(last_row - sheet.row_count + config.SHEET_GROW_ROWS)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка расширения листа '{sheet_name}': {e}", exc_info=True)
+        return False
+
+
+def build_row_update(sheet_name: str, record: Any) -> Optional[Dict[str, Any]]:
+    """Готовит элемент пакета values_batch_update: строка record.row_number целиком."""
+    headers = _get_headers(sheet_name)
+    if not headers or not record.row_number:
+        return None
+    last_col = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip('1')
+    return {'range': _a1_sheet_range(sheet_name, f"A{record.row_number}:{last_col}{record.row_number}"),
+            'values': [_model_to_row(record, headers)]}
+
+
+def build_rows_update(sheet_name: str, records: List[Any]) -> Optional[Dict[str, Any]]:
+    """Готовит один элемент пакета для записей, занимающих подряд идущие строки."""
+    headers = _get_headers(sheet_name)
+    if not headers or not records:
+        return None
+    first_row, last_row = records[0].row_number, records[-1].row_number
+    if not first_row or last_row - first_row + 1 != len(records):
+        return None
+    last_col = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip('1')
+    return {'range': _a1_sheet_range(sheet_name, f"A{first_row}:{last_col}{last_row}"),
+            'values': [_model_to_row(r, headers) for r in records]}
+
+
+def build_blank_row_update(sheet_name: str, row_number: int) -> Optional[Dict[str, Any]]:
+    """Готовит элемент пакета, очищающий значения строки (без сдвига остальных строк)."""
+    return build_blank_rows_update(sheet_name, row_number, row_number)
+
+
+def build_blank_rows_update(sheet_name: str, first_row: int, last_row: int) -> Optional[Dict[str, Any]]:
+    """Готовит элемент пакета, очищающий строки first_row..last_row."""
+    headers = _get_headers(sheet_name)
+    if not headers or last_row < first_row:
+        return None
+    last_col = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip('1')
+    return {'range': _a1_sheet_range(sheet_name, f"A{first_row}:{last_col}{last_row}"),
+            'values': [[''] * len(headers) for _ in range(last_row - first_row + 1)]}
+
+
+def values_batch_update(data: List[Dict[str, Any]]) -> bool:
+    """Записывает диапазоны из разных листов одним запросом к API (атомарно для таблицы)."""
+    if not data:
+        return True
+    try:
+        _get_spreadsheet().values_batch_update(
+            body={'valueInputOption': 'USER_ENTERED', 'data': data})
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка пакетной записи в таблицу: {e}", exc_info=True)
+        return False
@@ -0,0 +1,168 @@
+# deal_tracker/stress_ledger.py
+"""
+Стресс-тест блокировок учета: несколько процессов по несколько потоков
+одновременно логируют движения и сделки через trade_logger против локального
+бэкенда таблицы (local_sheets), после чего итоговые балансы и число строк
+сверяются с ожидаемыми. Потерянное обновление баланса или перезаписанная
+строка дают расхождение.
+
+Каждый поток работает со своим счетом (несвязанные ключи идут параллельно)
+и с общим счетом 'shared' (все операции над ним строго по очереди).
+
+Запуск:
+    python stress_ledger.py --processes 4 --threads 4 --ops 20 --latency-ms 10
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from decimal import Decimal
+
+SHARED_ACCOUNT = 'shared'
+DEPOSIT = Decimal('10')
+TRANSFER = Decimal('1')
+TRADE_AMOUNT = Decimal('0.01')
+TRADE_PRICE = Decimal('100')
+
+SHEET_HEADERS = {
+    'Core_Trades': ['Timestamp', 'Order_ID', 'Exchange', 'Symbol', 'Type', 'Amount', 'Price',
+                    'Total_Quote_Amount', 'Commission', 'Commission_Asset', 'Notes', 'Trade_ID', 'Trade_PNL'],
+    'Fund_Movements': ['Movement_ID', 'Timestamp', 'Type', 'Asset', 'Amount', 'Source_Name',
+                       'Destination_Name', 'Fee_Amount', 'Fee_Asset', 'Transaction_ID_Blockchain', 'Notes'],
+    'Open_Positions': ['Symbol', 'Exchange', 'Net_Amount', 'Avg_Entry_Price', 'Current_Price',
+                       'Unrealized_PNL', 'Last_Updated', 'Is_Closed', 'Closed_At'],
+    'Account_Balances': ['Account_Name', 'Asset', 'Balance', 'Entity_Type', 'Last_Updated'],
+}
+
+
+def _configure_env(work_dir: str, latency_ms: int) -> None:
+    """Переменные окружения читаются config при импорте, поэтому задаются до него."""
+    os.environ['STATE_DIR'] = os.path.join(work_dir, 'state')
+    os.environ['SHEETS_BACKEND'] = 'local'
+    os.environ['LOCAL_SHEETS_PATH'] = os.path.join(work_dir, 'sheets.json')
+    os.environ['LOCAL_SHEETS_LATENCY_MS'] = str(latency_ms)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+
+def _thread_worker(worker_name: str, ops: int, errors: list) -> None:
+    import trade_logger
+
+    own_account = f"acct_{worker_name}"
+    for i in range(ops):
+        now = datetime.now()
+        steps = [
+            lambda: trade_logger.log_fund_movement('DEPOSIT', 'USDT', DEPOSIT, now,
+                                                   destination_name=SHARED_ACCOUNT),
+            lambda: trade_logger.log_fund_movement('DEPOSIT', 'USDT', DEPOSIT, now,
+                                                   destination_name=own_account),
+            lambda: trade_logger.log_fund_movement('TRANSFER', 'USDT', TRANSFER, now,
+                                                   source_name=own_account, destination_name=SHARED_ACCOUNT),
+            lambda: trade_logger.log_trade('BUY', own_account, 'BTC/USDT', TRADE_AMOUNT, TRADE_PRICE, now),
+            lambda: trade_logger.log_trade('SELL', own_account, 'BTC/USDT', TRADE_AMOUNT, TRADE_PRICE, now),
+        ]
+        for step in steps:
+            success, message = step()
+            if not success:
+                errors.append(f"{worker_name} #{i}: {message}")
+
+
+def _process_worker(process_index: int, threads: int, ops: int, work_dir: str, latency_ms: int,
+                    result_queue: multiprocessing.Queue) -> None:
+    import threading
+
+    _configure_env(work_dir, latency_ms)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    errors: list = []
+    workers = [threading.Thread(target=_thread_worker, args=(f"{process_index}_{t}", ops, errors))
+               for t in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    result_queue.put(errors)
+
+
+def _verify(processes: int, threads: int, ops: int) -> list:
+    import sheets_service
+
+    problems = []
+    workers = processes * threads
+    balances = {}
+    for b in sheets_service.get_all_balances():
+        key = (b.account_name.lower(), b.asset.upper())
+        if key in balances:
+            problems.append(f"Дублирующаяся строка баланса {key}")
+        balances[key] = b.balance or Decimal('0')
+
+    expected = {(SHARED_ACCOUNT, 'USDT'): (DEPOSIT + TRANSFER) * ops * workers}
+    for p in range(processes):
+        for t in range(threads):
+            account = f"acct_{p}_{t}"
+            expected[(account, 'USDT')] = (DEPOSIT - TRANSFER) * ops
+            expected[(account, 'BTC')] = Decimal('0')
+    for key, value in expected.items():
+        actual = balances.get(key, Decimal('0'))
+        if actual != value:
+            problems.append(f"Баланс {key}: ожидалось {value}, в таблице {actual}")
+
+    movements = len(sheets_service.get_all_fund_movements())
+    trades = len(sheets_service.get_all_core_trades())
+    if movements != 3 * ops * workers:
+        problems.append(f"Движений: ожидалось {3 * ops * workers}, в таблице {movements}")
+    if trades != 2 * ops * workers:
+        problems.append(f"Сделок: ожидалось {2 * ops * workers}, в таблице {trades}")
+    open_positions = [p for p in sheets_service.get_all_open_positions() if p.net_amount]
+    if open_positions:
+        problems.append(f"Остались открытые позиции: {len(open_positions)}")
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Стресс-тест параллельной записи в учет.")
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--ops', type=int, default=10, help="Циклов операций на поток (5 операций в цикле)")
+    parser.add_argument('--latency-ms', type=int, default=10, help="Задержка вызова локальной таблицы")
+    parser.add_argument('--keep', action='store_true', help="Не удалять рабочий каталог")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='deal_tracker_stress_')
+    _configure_env(work_dir, args.latency_ms)
+    import sheets_service
+    sheets_service._get_spreadsheet().seed(SHEET_HEADERS)
+
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    started = time.monotonic()
+    procs = [ctx.Process(target=_process_worker,
+                         args=(p, args.threads, args.ops, work_dir, args.latency_ms, result_queue))
+             for p in range(args.processes)]
+    for proc in procs:
+        proc.start()
+    errors = []
+    for _ in procs:
+        errors.extend(result_queue.get())
+    for proc in procs:
+        proc.join()
+    elapsed = time.monotonic() - started
+
+    total_ops = 5 * args.ops * args.processes * args.threads
+    print(f"Операций: {total_ops} за {elapsed:.1f} с ({total_ops / elapsed:.1f} оп/с), "
+          f"процессов {args.processes} x потоков {args.threads}, задержка {args.latency_ms} мс")
+    problems = [f"Операция отклонена: {e}" for e in errors[:20]] + _verify(args.processes, args.threads, args.ops)
+    for problem in problems:
+        print(f"  ✗ {problem}")
+    print("Результат: OK" if not problems else f"Результат: ОШИБКИ ({len(problems)})")
+    if args.keep:
+        print(f"Рабочий каталог: {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0 if not problems else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
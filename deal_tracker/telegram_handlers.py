@@ -1,16 +1,25 @@
 # deal_tracker/telegram_handlers.py
+import html
 import logging
 from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
 from telegram import Update
 from telegram.ext import CallbackContext
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 
 import config
 import utils
 import sheets_service
 import analytics_service
-from trade_logger import log_trade, log_fund_movement
-from telegram_parser import parse_command_args_advanced
+import trade_query
+import portfolio_view
+import reconciliation
+from bot_executor import executor, per_user_limit, format_stats
+from bot_jobs import jobs
+from models import TradeData, MovementData
+from trade_logger import log_trade, log_fund_movement, log_operations, ATOMIC_ROLLBACK_MESSAGE
+from telegram_parser import MOVEMENT_SCHEMAS, TRADE_SCHEMA, parse_command_args_advanced, parse_batch_lines
 
 logger = logging.getLogger(__name__)
 
@@ -38,18 +47,23 @@ async def start_command(update: Update, context: CallbackContext) -> None:
         "--- <u>Торговля</u> ---\n"
         "<code>/buy SYMBOL QTY PRICE exch:NAME [ключи...]</code>\n"
         "<code>/sell SYMBOL QTY PRICE exch:NAME [ключи...]</code>\n"
-        "  <i>Опц. ключи: fee, fee_asset, notes, date, id</i>\n"
+        "  <i>Опц. ключи: fee, fee_asset, notes, date, id, sl, tp1, tp2, tp3, risk</i>\n"
         "--- <u>Финансы</u> ---\n"
         "<code>/deposit ASSET AMOUNT dest_name:NAME [ключи...]</code>\n"
         "<code>/withdraw ASSET AMOUNT source_name:NAME [ключи...]</code>\n"
         "<code>/transfer ASSET QTY FROM TO [ключи...]</code>\n"
         "  <i>Опц. ключи: date, notes, tx_id, fee, fee_asset</i>\n"
+        "<code>/batch</code> + по операции в строке (buy/sell/deposit/withdraw/transfer с теми же аргументами) "
+        "- записать все одним пакетом\n"
         "--- <u>Отчеты</u> ---\n"
-        "/portfolio - Открытые позиции\n"
-        "/history SYMBOL - История сделок по символу\n"
+        "/portfolio [chart] - Открытые позиции (chart - график)\n"
+        "<code>/history SYMBOL [exch:NAME] [page:N] [from:DATE] [to:DATE]</code> - История сделок\n"
         "/average SYMBOL - Средняя цена входа по символу\n"
         "/updater_status - Статус обновления цен\n"
-        "/update_analytics - Обновить аналитику и FIFO\n"
+        "/update_analytics - Обновить аналитику и FIFO (фоновая задача)\n"
+        "/cancel_job ID - Отменить фоновую задачу\n"
+        "/reconcile [apply] - Сверить балансы с биржами (apply - записать корректировки)\n"
+        "/bot_status - Загрузка пулов исполнения бота\n"
     )
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
 
@@ -58,37 +72,32 @@ async def help_command(update: Update, context: CallbackContext) -> None:
     await start_command(update, context)
 
 
-@admin_only
-async def trade_command(update: Update, context: CallbackContext, trade_type: str) -> None:
-    """Общий обработчик для команд /buy и /sell."""
-    command_name = update.message.text.split(' ')[0].lower()
-    pos_args, named_args = parse_command_args_advanced(list(context.args), 3)
+def _schema_error(errors: List[str], usage: str) -> str:
+    return f"Ошибка: {html.escape('; '.join(errors), quote=False)}.\n<code>{usage}</code>"
 
-    if len(pos_args) < 3:
-        await update.message.reply_text(f"Ошибка: <code>{command_name} SYMBOL QTY PRICE exch:NAME [ключи...]</code>", parse_mode=ParseMode.HTML)
-        return
 
-    symbol = pos_args[0]
-    amount_dec = utils.parse_decimal(pos_args[1])
-    price_dec = utils.parse_decimal(pos_args[2])
-    exchange = named_args.get('exch')
+def _trade_args(trade_type: str, args: List[str]) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Аргументы сделки для log_trade / TradeData или (None, текст ошибки)."""
+    parsed = TRADE_SCHEMA.parse(args)
+    if not parsed.ok:
+        return None, _schema_error(parsed.errors, f"/{trade_type.lower()} SYMBOL QTY PRICE exch:NAME [ключи...]")
+    return dict(parsed.values, trade_type=trade_type), ""
 
-    if not all([amount_dec, price_dec, exchange]):
-        await update.message.reply_text("Ошибка в данных. Проверьте кол-во, цену и `exch:ИМЯ`.", parse_mode=ParseMode.HTML)
+
+@admin_only
+@per_user_limit
+async def trade_command(update: Update, context: CallbackContext, trade_type: str) -> None:
+    """Общий обработчик для команд /buy и /sell."""
+    trade_args, error = _trade_args(trade_type, list(context.args))
+    if trade_args is None:
+        await update.message.reply_text(error, parse_mode=ParseMode.HTML)
         return
 
-    timestamp = utils.parse_datetime_from_args(named_args)
-    kwargs = {
-        'notes': named_args.get('notes'), 'order_id': named_args.get('id'),
-        'commission': utils.parse_decimal(named_args.get('fee')),
-        'commission_asset': named_args.get('fee_asset')
-    }
-    success, message = log_trade(
-        trade_type=trade_type, exchange=exchange, symbol=symbol,
-        amount=amount_dec, price=price_dec, timestamp=timestamp, **kwargs
-    )
+    success, message = await executor.run_io(log_trade, **trade_args)
     if success:
-        await update.message.reply_text(f"✅ {trade_type.capitalize()} {amount_dec} {symbol} @ {price_dec} залогирована.", parse_mode=ParseMode.HTML)
+        await update.message.reply_text(
+            f"✅ {trade_type.capitalize()} {trade_args['amount']} {trade_args['symbol']} @ {trade_args['price']} залогирована.",
+            parse_mode=ParseMode.HTML)
     else:
         await update.message.reply_text(f"❌ {message}", parse_mode=ParseMode.HTML)
 
@@ -101,52 +110,40 @@ async def sell_command(update: Update, context: CallbackContext) -> None:
     await trade_command(update, context, trade_type='SELL')
 
 
+_MOVEMENT_USAGE = {
+    'DEPOSIT': "/deposit ASSET AMOUNT dest_name:NAME [ключи...]",
+    'WITHDRAWAL': "/withdraw ASSET AMOUNT source_name:NAME [ключи...]",
+    'TRANSFER': "/transfer ASSET QTY FROM TO [ключи...]",
+}
+
+
+def _movement_args(move_type: str, args: List[str]) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Аргументы движения для log_fund_movement / MovementData или (None, текст ошибки)."""
+    parsed = MOVEMENT_SCHEMAS[move_type].parse(args)
+    if not parsed.ok:
+        return None, _schema_error(parsed.errors, _MOVEMENT_USAGE[move_type])
+    return dict(parsed.values, movement_type=move_type), ""
+
+
 @admin_only
+@per_user_limit
 async def movement_command(update: Update, context: CallbackContext, move_type: str) -> None:
     """Общий обработчик для /deposit, /withdraw, /transfer."""
     logger.info(
         f"[HANDLER] Получена команда /{move_type.lower()} с аргументами: {context.args}")
 
-    pos_args, named_args = parse_command_args_advanced(list(context.args), 4)
-    min_args = 2 if move_type != 'TRANSFER' else 3
-    if len(pos_args) < min_args:
-        await update.message.reply_text("Ошибка: недостаточно аргументов.", parse_mode=ParseMode.HTML)
-        return
-
-    asset = pos_args[0]
-    amount_dec = utils.parse_decimal(pos_args[1])
-    if not amount_dec or amount_dec <= Decimal('0'):
-        await update.message.reply_text("Ошибка: некорректная сумма.", parse_mode=ParseMode.HTML)
+    movement_args, error = _movement_args(move_type, list(context.args))
+    if movement_args is None:
+        await update.message.reply_text(error, parse_mode=ParseMode.HTML)
         return
 
-    kwargs = {}
-    if move_type == 'DEPOSIT':
-        kwargs['destination_name'] = named_args.get('dest_name')
-        if not kwargs['destination_name']:
-            await update.message.reply_text("Ошибка: для депозита укажите `dest_name:ИМЯ`.", parse_mode=ParseMode.HTML)
-            return
-    elif move_type == 'WITHDRAWAL':
-        kwargs['source_name'] = named_args.get('source_name')
-        if not kwargs['source_name']:
-            await update.message.reply_text("Ошибка: для снятия укажите `source_name:ИМЯ`.", parse_mode=ParseMode.HTML)
-            return
-    elif move_type == 'TRANSFER':
-        kwargs['source_name'] = pos_args[2]
-        kwargs['destination_name'] = pos_args[3]
-
-    timestamp_obj = utils.parse_datetime_from_args(named_args)
-    kwargs['fee_amount'] = utils.parse_decimal(named_args.get('fee'))
-    kwargs['fee_asset'] = named_args.get('fee_asset')
-    kwargs['notes'] = named_args.get('notes')
-    kwargs['transaction_id_blockchain'] = named_args.get('tx_id')
-
     logger.info(f"[HANDLER] Данные подготовлены. Вызываю log_fund_movement...")
-    success, message = log_fund_movement(
-        movement_type=move_type, asset=asset, amount=amount_dec, timestamp=timestamp_obj, **kwargs
-    )
+    success, message = await executor.run_io(log_fund_movement, **movement_args)
 
     if success:
-        await update.message.reply_text(f"✅ Операция {move_type.lower()} на {amount_dec} {asset} залогирована.", parse_mode=ParseMode.HTML)
+        await update.message.reply_text(
+            f"✅ Операция {move_type.lower()} на {movement_args['amount']} {movement_args['asset']} залогирована.",
+            parse_mode=ParseMode.HTML)
     else:
         await update.message.reply_text(f"❌ {message}", parse_mode=ParseMode.HTML)
 
@@ -163,78 +160,204 @@ async def transfer_command(update: Update, context: CallbackContext) -> None:
     await movement_command(update, context, move_type='TRANSFER')
 
 
+_BATCH_TRADE_COMMANDS = {'buy': 'BUY', 'sell': 'SELL'}
+_BATCH_MOVEMENT_COMMANDS = {'deposit': 'DEPOSIT', 'withdraw': 'WITHDRAWAL', 'transfer': 'TRANSFER'}
+
+
+@admin_only
+@per_user_limit
+async def batch_command(update: Update, context: CallbackContext) -> None:
+    """Несколько операций в одном сообщении: проверяются вместе и записываются одним пакетом."""
+    lines = parse_batch_lines(update.message.text or "")
+    if not lines:
+        await update.message.reply_text(
+            "Использование: <code>/batch</code>, далее по операции в строке, например:\n"
+            "<code>buy BTC/USDT 0.01 60000 exch:binance</code>", parse_mode=ParseMode.HTML)
+        return
+    if len(lines) > config.BATCH_MAX_OPERATIONS:
+        await update.message.reply_text(f"Ошибка: в пакете больше {config.BATCH_MAX_OPERATIONS} операций.")
+        return
+
+    operations, errors = [], []
+    for line_no, command, args in lines:
+        if command in _BATCH_TRADE_COMMANDS:
+            op_args, error = _trade_args(_BATCH_TRADE_COMMANDS[command], args)
+            if op_args is not None:
+                operations.append(TradeData(trade_id=None, **op_args))
+        elif command in _BATCH_MOVEMENT_COMMANDS:
+            op_args, error = _movement_args(_BATCH_MOVEMENT_COMMANDS[command], args)
+            if op_args is not None:
+                operations.append(MovementData(**op_args))
+        else:
+            error = f"неизвестная команда '{html.escape(command)}'."
+        if error:
+            errors.append(f"Строка {line_no}: {error}")
+    if errors:
+        await update.message.reply_text("❌ Пакет не записан:\n" + "\n".join(errors), parse_mode=ParseMode.HTML)
+        return
+
+    results = await executor.run_io(log_operations, operations, True)
+    failed = [(lines[r.index][0], r) for r in results if not r.success]
+    if not failed:
+        await update.message.reply_text(f"✅ Пакет записан: {len(results)} операций.")
+        return
+    reply = [f"❌ Пакет не записан ({len(failed)} из {len(results)} с ошибками):"]
+    for line_no, result in failed:
+        if result.message != ATOMIC_ROLLBACK_MESSAGE:
+            reply.append(f"Строка {line_no}: {html.escape(result.message)}")
+    await update.message.reply_text("\n".join(reply), parse_mode=ParseMode.HTML)
+
+
 @admin_only
+@per_user_limit
 async def portfolio_command(update: Update, context: CallbackContext) -> None:
-    positions = sheets_service.get_all_open_positions()
-    if not positions:
-        await update.message.reply_text("Нет открытых позиций.")
-        return
-    reply_text = "<u><b>💼 Открытые Позиции:</b></u>\n\n"
-    for pos in positions:
-        pnl_str = f"{pos.unrealized_pnl:+.2f}" if pos.unrealized_pnl is not None else "N/A"
-        reply_text += (f"<b>{pos.symbol}</b> ({pos.exchange})\n"
-                       f"  Кол-во: {pos.net_amount:.4f}\n"
-                       f"  Ср.вход: {pos.avg_entry_price:.4f}\n"
-                       f"  Нереал.PNL: {pnl_str}\n\n")
-    await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
+    snapshot = await executor.run_io(portfolio_view.get_snapshot)
+    if not context.args or context.args[0].lower() != 'chart':
+        await update.message.reply_text(snapshot.text, parse_mode=ParseMode.HTML)
+        return
+    if not snapshot.positions:
+        await update.message.reply_text(snapshot.text)
+        return
+
+    file_id, png = portfolio_view.cached_chart(snapshot.digest)
+    if file_id:
+        try:
+            await update.message.reply_photo(photo=file_id)
+            return
+        except BadRequest as e:
+            logger.warning(f"Telegram не принял file_id графика портфеля, отправляю заново: {e}")
+            portfolio_view.store_file_id(snapshot.digest, None)
+    if png is None:
+        png = await executor.run_cpu(portfolio_view.render_chart, snapshot.chart_rows)
+        if png is None:
+            await update.message.reply_text("График недоступен: на сервере не установлен matplotlib.")
+            return
+        portfolio_view.store_chart(snapshot.digest, png)
+    message = await update.message.reply_photo(photo=png, filename='portfolio.png')
+    if message.photo:
+        portfolio_view.store_file_id(snapshot.digest, message.photo[-1].file_id)
 
 
 @admin_only
+@per_user_limit
 async def history_command(update: Update, context: CallbackContext) -> None:
-    if not context.args:
-        await update.message.reply_text("Использование: <code>/history SYMBOL</code>", parse_mode=ParseMode.HTML)
+    pos_args, named_args = parse_command_args_advanced(list(context.args), 1)
+    if not pos_args:
+        await update.message.reply_text(
+            "Использование: <code>/history SYMBOL [exch:NAME] [page:N] [from:DATE] [to:DATE]</code>",
+            parse_mode=ParseMode.HTML)
         return
-    symbol_to_find = context.args[0].upper()
-    all_trades = sheets_service.get_all_core_trades()
-    trades = [t for t in all_trades if t.symbol and t.symbol.upper()
-              == symbol_to_find]
-    if not trades:
+    symbol_to_find = pos_args[0].upper()
+    page_str = named_args.get('page', '1')
+    if not page_str.isdigit() or int(page_str) < 1:
+        await update.message.reply_text("Ошибка: <code>page:</code> - номер страницы с 1.", parse_mode=ParseMode.HTML)
+        return
+    try:
+        since, until = utils.parse_date_range_from_args(named_args)
+    except (ValueError, OverflowError):
+        await update.message.reply_text("Ошибка: не удалось распознать дату в <code>from:</code>/<code>to:</code>.",
+                                        parse_mode=ParseMode.HTML)
+        return
+
+    result = await executor.run_io(
+        trade_query.query_trades, symbol_to_find, named_args.get('exch'), since, until,
+        int(page_str), config.HISTORY_PAGE_SIZE)
+    if not result.total:
         await update.message.reply_text(f"Нет истории сделок для {symbol_to_find}.")
         return
+    if not result.trades:
+        await update.message.reply_text(f"Страница {result.page} пуста: всего страниц {result.pages}.")
+        return
 
-    trades.sort(key=lambda t: t.timestamp, reverse=True)
-    reply_text = f"<u><b>📜 История сделок для {symbol_to_find} (макс. 10):</b></u>\n"
-    for trade in trades[:10]:
+    reply_text = (f"<u><b>📜 История сделок для {symbol_to_find}</b></u> "
+                  f"(стр. {result.page}/{result.pages}, всего {result.total}):\n")
+    for trade in result.trades:
         reply_text += (f"<pre>{trade.timestamp:%Y-%m-%d %H:%M} {trade.trade_type:<4} "
                        f"{trade.amount:<10.4f} {trade.symbol} @ {trade.price:<12.4f}</pre>\n")
+    if result.page < result.pages:
+        reply_text += f"Дальше: <code>page:{result.page + 1}</code>"
     await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
 
 
 @admin_only
+@per_user_limit
 async def average_command(update: Update, context: CallbackContext) -> None:
     if not context.args:
         await update.message.reply_text("Использование: <code>/average SYMBOL</code>", parse_mode=ParseMode.HTML)
         return
     symbol_to_find = context.args[0].upper()
-    all_positions = sheets_service.get_all_open_positions()
-    position = next(
-        (p for p in all_positions if p.symbol and p.symbol.upper() == symbol_to_find), None)
+    positions = await executor.run_io(trade_query.find_positions, symbol_to_find)
 
-    if not position:
+    if not positions:
         await update.message.reply_text(f"Нет открытой позиции для {symbol_to_find}.")
         return
 
-    reply_text = (f"<u><b>📊 Средняя цена для {position.symbol}:</b></u>\n"
-                  f"  Общее кол-во: <code>{position.net_amount:.4f}</code>\n"
-                  f"  Средняя цена входа: <code>{position.avg_entry_price:.4f}</code>\n")
+    total_amount = sum(p.net_amount for p in positions)
+    avg_price = sum(p.net_amount * p.avg_entry_price for p in positions) / total_amount if total_amount else Decimal('0')
+    reply_text = (f"<u><b>📊 Средняя цена для {positions[0].symbol}:</b></u>\n"
+                  f"  Общее кол-во: <code>{total_amount:.4f}</code>\n"
+                  f"  Средняя цена входа: <code>{avg_price:.4f}</code>\n")
+    if len(positions) > 1:
+        for p in positions:
+            reply_text += f"  {p.exchange}: <code>{p.net_amount:.4f} @ {p.avg_entry_price:.4f}</code>\n"
     await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
 
 
 @admin_only
+@per_user_limit
 async def updater_status_command(update: Update, context: CallbackContext) -> None:
-    status, timestamp = sheets_service.get_system_status()
+    status, timestamp = await executor.run_io(sheets_service.get_system_status)
     if status is None and timestamp is None:
         await update.message.reply_text("🟡 Price Updater: нет данных о статусе.")
         return
     reply_msg = f"🟢 Price Updater: посл. обновление в <b>{timestamp}</b>, статус: <b>{status}</b>."
+    exchange_health = await executor.run_io(sheets_service.get_exchange_health)
+    if exchange_health:
+        state_icons = {'CLOSED': '🟢', 'HALF_OPEN': '🟡', 'OPEN': '🔴'}
+        reply_msg += "\n\n<b>Биржи:</b>"
+        for entry in exchange_health:
+            name = entry['component'].split(':', 1)[-1]
+            icon = state_icons.get(entry['status'], '⚪️')
+            reply_msg += f"\n{icon} {name}: <b>{entry['status']}</b>"
+            if entry['last_success']:
+                reply_msg += f", посл. успех {entry['last_success']}"
+            if entry['error']:
+                reply_msg += f"\n   <i>{html.escape(entry['error'])}</i>"
     await update.message.reply_text(reply_msg, parse_mode=ParseMode.HTML)
 
 
 @admin_only
+@per_user_limit
 async def update_analytics_command(update: Update, context: CallbackContext) -> None:
-    await update.message.reply_text("⚙️ Запускаю полное обновление аналитики...", parse_mode=ParseMode.HTML)
-    success, message = analytics_service.calculate_and_update_analytics_sheet()
-    if success:
-        await update.message.reply_text(f"✅ Обновление аналитики завершено!\n{message}", parse_mode=ParseMode.HTML)
-    else:
-        await update.message.reply_text(f"❌ Ошибка обновления аналитики:\n{message}", parse_mode=ParseMode.HTML)
+    # Ключ один на весь бот: повторные запросы присоединяются к идущему пересчету,
+    # а не разбирают FIFO второй раз
+    await jobs.submit('analytics', "Обновление аналитики и FIFO",
+                      analytics_service.calculate_and_update_analytics_sheet,
+                      context.bot, update.effective_chat.id)
+
+
+@admin_only
+async def cancel_job_command(update: Update, context: CallbackContext) -> None:
+    job_id = context.args[0].lstrip('#') if context.args else ''
+    if not job_id.isdigit():
+        await update.message.reply_text("Использование: <code>/cancel_job ID</code>", parse_mode=ParseMode.HTML)
+        return
+    success, message = await jobs.cancel(int(job_id))
+    await update.message.reply_text(f"{'✅' if success else '❌'} {message}")
+
+
+@admin_only
+@per_user_limit
+async def reconcile_command(update: Update, context: CallbackContext) -> None:
+    apply = bool(context.args) and context.args[0].lower() == 'apply'
+    if not config.RECONCILE_EXCHANGES:
+        await update.message.reply_text("Не заданы биржи для сверки (RECONCILE_EXCHANGES или SYNC_EXCHANGES).")
+        return
+    await update.message.reply_text("⚙️ Запрашиваю балансы бирж для сверки...")
+    report = await reconciliation.reconcile(apply=apply)
+    await update.message.reply_text(reconciliation.format_report(report), parse_mode=ParseMode.HTML)
+
+
+@admin_only
+async def bot_status_command(update: Update, context: CallbackContext) -> None:
+    await update.message.reply_text(format_stats(), parse_mode=ParseMode.HTML)
@@ -1,52 +1,268 @@
 # deal_tracker/telegram_parser.py
+"""
+Разбор аргументов команд бота.
+
+parse_command_args_advanced делит токены на позиционные и именованные
+(ключ:значение) за один проход с заранее скомпилированными шаблонами.
+CommandSchema поверх него описывает аргументы команды декларативно (ArgSpec):
+значения сразу приводятся к типам (Decimal, int, datetime), а все ошибки
+собираются за один проход, так что /batch сообщает обо всех проблемах строки
+сразу. Даты в ISO-формате разбираются без dateutil.
+"""
 import re
-from typing import List, Dict, Tuple
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Any, Callable, Collection, Dict, List, Optional, Sequence, Tuple
+
+import config
+import utils
+
+_KEY_RE = re.compile(r"^([a-zA-Z_а-яА-Я][a-zA-Z0-9_а-яА-Я]*):(.*)$", re.DOTALL)
+_DECIMAL_RE = re.compile(r"^[+-]?(?:\d+(?:[.,]\d*)?|[.,]\d+)(?:[eE][+-]?\d+)?$")
+_INT_RE = re.compile(r"^\d+$")
+_ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?(?:Z|[+-]\d{2}:?\d{2})?$")
+
+
+def _unquote(value: str) -> str:
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in ('"', "'"):
+        return value[1:-1]
+    return value
+
+
+def _is_url(key_match: re.Match) -> bool:
+    """http://x.com похоже на ключ 'http' - но это ссылка."""
+    return key_match.group(2).startswith('//')
 
 
-def parse_command_args_advanced(args: List[str], num_positional_max: int) -> Tuple[List[str], Dict[str, str]]:
+def parse_command_args_advanced(args: List[str], num_positional_max: int,
+                                known_keys: Optional[Collection[str]] = None) -> Tuple[List[str], Dict[str, str]]:
     """
     Продвинутый парсер аргументов команды.
     Разделяет аргументы на позиционные и именованные (ключ:значение).
+    Токены после ключа без своего ключа дописываются к его значению
+    (notes:купил на откате); значение в кавычках освобождается от них.
+    Ссылки (http://...) ключами не считаются. Если задан known_keys, внутри
+    значения ключом считается только известный ключ (notes:см. ист:биржа).
     """
     positional_args = []
     named_args_dict = {}
-    arg_idx = 0
-    key_regex = r"^([a-zA-Z_а-яА-Я][a-zA-Z0-9_а-яА-Я]*):(.*)$"
-
-    # Сбор позиционных аргументов
-    while arg_idx < len(args):
-        current_token = args[arg_idx]
-        if re.match(key_regex, current_token) or len(positional_args) >= num_positional_max:
-            break
-        positional_args.append(current_token)
-        arg_idx += 1
-
-    # Сбор именованных аргументов
     current_key = None
-    value_buffer = []
-    while arg_idx < len(args):
-        token = args[arg_idx]
-        key_match = re.match(key_regex, token)
-        if key_match:
-            if current_key and value_buffer:
-                named_args_dict[current_key] = " ".join(value_buffer).strip()
-            current_key = key_match.group(1).lower()
-            value_part = key_match.group(2).strip()
-            value_buffer = []
-            if value_part:
-                if (value_part.startswith('"') and value_part.endswith('"')) or \
-                   (value_part.startswith("'") and value_part.endswith("'")):
-                    value_buffer.append(value_part[1:-1])
-                else:
-                    value_buffer.append(value_part)
-        elif current_key:
-            value_buffer.append(token)
-        arg_idx += 1
-
-    if current_key and value_buffer:
-        named_args_dict[current_key] = " ".join(value_buffer).strip()
-    elif current_key and not value_buffer:
-        # Для ключей без значения, например 'flag:'
+    value_buffer: List[str] = []
+
+    for token in args:
+        key_match = _KEY_RE.match(token)
+        if key_match is not None and (_is_url(key_match) or (
+                current_key and known_keys is not None and key_match.group(1).lower() not in known_keys)):
+            key_match = None
+        if key_match is None:
+            if current_key:
+                value_buffer.append(token)
+            elif not named_args_dict and len(positional_args) < num_positional_max:
+                positional_args.append(token)
+            continue
+        if current_key:
+            named_args_dict[current_key] = _unquote(" ".join(value_buffer).strip())
+        current_key = key_match.group(1).lower()
+        value_part = key_match.group(2).strip()
+        value_buffer = [value_part] if value_part else []
+        # Без значения ключ остается флагом ('flag:' -> "")
         named_args_dict[current_key] = ""
 
+    if current_key:
+        named_args_dict[current_key] = _unquote(" ".join(value_buffer).strip())
     return positional_args, named_args_dict
+
+
+# --- Типизированные значения ---
+
+
+def _to_str(value: str) -> str:
+    return value
+
+
+def _to_decimal(value: str) -> Decimal:
+    if not _DECIMAL_RE.match(value):
+        raise ValueError("ожидается число")
+    try:
+        return Decimal(value.replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError("ожидается число")
+
+
+def _to_positive_decimal(value: str) -> Decimal:
+    number = _to_decimal(value)
+    if number <= 0:
+        raise ValueError("ожидается число больше нуля")
+    return number
+
+
+def _to_int(value: str) -> int:
+    if not _INT_RE.match(value):
+        raise ValueError("ожидается целое число")
+    return int(value)
+
+
+def _local_timezone() -> timezone:
+    return timezone(timedelta(hours=config.TZ_OFFSET_HOURS))
+
+
+def _to_datetime(value: str) -> datetime:
+    """ISO-даты разбираются напрямую, прочие форматы - через dateutil."""
+    dt_obj = None
+    if _ISO_DATE_RE.match(value):
+        try:
+            dt_obj = datetime.fromisoformat(value)
+        except ValueError:
+            dt_obj = None
+    if dt_obj is None:
+        try:
+            dt_obj = utils.parse_datetime_flexible(value)
+        except (ValueError, OverflowError):
+            raise ValueError("не удалось распознать дату")
+    target_timezone = _local_timezone()
+    return dt_obj.astimezone(target_timezone) if dt_obj.tzinfo else dt_obj.replace(tzinfo=target_timezone)
+
+
+def now_local() -> datetime:
+    """Текущее время в часовом поясе TZ_OFFSET_HOURS (дата операции по умолчанию)."""
+    return datetime.now(timezone.utc).astimezone(_local_timezone())
+
+
+_CONVERTERS: Dict[str, Callable[[str], Any]] = {
+    'str': _to_str,
+    'decimal': _to_decimal,
+    'positive_decimal': _to_positive_decimal,
+    'int': _to_int,
+    'datetime': _to_datetime,
+}
+
+
+@dataclass(frozen=True)
+class ArgSpec:
+    """
+    Один аргумент команды. Для позиционного name - имя в подсказке (QTY),
+    для именованного - ключ (exch). field - имя в результате (по умолчанию name);
+    default - значение или функция без аргументов для отсутствующего аргумента.
+    """
+    name: str
+    kind: str = 'str'
+    field: Optional[str] = None
+    required: bool = False
+    default: Any = None
+
+    def __post_init__(self):
+        if self.kind not in _CONVERTERS:
+            raise ValueError(f"Неизвестный тип аргумента '{self.kind}' для '{self.name}'.")
+
+    @property
+    def target(self) -> str:
+        return self.field or self.name
+
+
+@dataclass
+class ParsedArgs:
+    values: Dict[str, Any] = field(default_factory=dict)
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+class CommandSchema:
+    """Позиционные и именованные аргументы команды с типами и обязательностью."""
+
+    def __init__(self, positional: Sequence[ArgSpec], named: Sequence[ArgSpec] = ()):
+        self.positional = list(positional)
+        self.named = {spec.name: spec for spec in named}
+
+    def parse(self, args: List[str]) -> ParsedArgs:
+        """Приводит аргументы к типам; все ошибки (пропуски, форматы, лишние ключи) - в errors."""
+        pos_args, named_args = parse_command_args_advanced(list(args), len(self.positional), self.named)
+        result = ParsedArgs()
+        for index, spec in enumerate(self.positional):
+            raw = pos_args[index] if index < len(pos_args) else None
+            self._convert(spec, raw, spec.name, result)
+        for key in named_args:
+            if key not in self.named:
+                result.errors.append(f"неизвестный ключ {key}:")
+        for key, spec in self.named.items():
+            self._convert(spec, named_args.get(key) or None, f"{key}:", result)
+        return result
+
+    @staticmethod
+    def _convert(spec: ArgSpec, raw: Optional[str], label: str, result: ParsedArgs) -> None:
+        if raw is None:
+            if spec.required:
+                result.errors.append(f"не указан {label}")
+            else:
+                result.values[spec.target] = spec.default() if callable(spec.default) else spec.default
+            return
+        try:
+            result.values[spec.target] = _CONVERTERS[spec.kind](raw)
+        except ValueError as e:
+            result.errors.append(f"{label} '{raw}' - {e}")
+
+
+# --- Схемы команд учета ---
+
+_OPERATION_NAMED = [
+    ArgSpec('date', 'datetime', field='timestamp', default=now_local),
+    ArgSpec('notes'),
+]
+
+TRADE_SCHEMA = CommandSchema(
+    positional=[ArgSpec('SYMBOL', field='symbol', required=True),
+                ArgSpec('QTY', 'positive_decimal', field='amount', required=True),
+                ArgSpec('PRICE', 'positive_decimal', field='price', required=True)],
+    named=[ArgSpec('exch', field='exchange', required=True),
+           *_OPERATION_NAMED,
+           ArgSpec('id', field='order_id'),
+           ArgSpec('fee', 'decimal', field='commission'),
+           ArgSpec('fee_asset', field='commission_asset'),
+           ArgSpec('sl', 'decimal'),
+           ArgSpec('tp1', 'decimal'),
+           ArgSpec('tp2', 'decimal'),
+           ArgSpec('tp3', 'decimal'),
+           ArgSpec('risk', 'decimal', field='risk_usd')],
+)
+
+_MOVEMENT_POSITIONAL = [ArgSpec('ASSET', field='asset', required=True),
+                        ArgSpec('AMOUNT', 'positive_decimal', field='amount', required=True)]
+_MOVEMENT_NAMED = [*_OPERATION_NAMED,
+                   ArgSpec('fee', 'decimal', field='fee_amount'),
+                   ArgSpec('fee_asset'),
+                   ArgSpec('tx_id', field='transaction_id_blockchain')]
+
+MOVEMENT_SCHEMAS: Dict[str, CommandSchema] = {
+    'DEPOSIT': CommandSchema(
+        _MOVEMENT_POSITIONAL,
+        [ArgSpec('dest_name', field='destination_name', required=True), *_MOVEMENT_NAMED]),
+    'WITHDRAWAL': CommandSchema(
+        _MOVEMENT_POSITIONAL,
+        [ArgSpec('source_name', required=True), *_MOVEMENT_NAMED]),
+    'TRANSFER': CommandSchema(
+        [*_MOVEMENT_POSITIONAL,
+         ArgSpec('FROM', field='source_name', required=True),
+         ArgSpec('TO', field='destination_name', required=True)],
+        _MOVEMENT_NAMED),
+}
+
+
+def parse_batch_lines(text: str) -> List[Tuple[int, str, List[str]]]:
+    """
+    Разбирает многострочное сообщение /batch: по одной операции в строке,
+    "buy BTC/USDT 0.01 60000 exch:binance" (слэш перед командой необязателен).
+    Первая строка может начинаться с самой команды /batch. Пустые строки и
+    строки с # пропускаются. Возвращает (номер строки, команда, аргументы).
+    """
+    operations = []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        tokens = line.split()
+        if line_no == 1 and tokens and tokens[0].lower().split('@')[0] == '/batch':
+            tokens = tokens[1:]
+        if not tokens or tokens[0].startswith('#'):
+            continue
+        operations.append((line_no, tokens[0].lstrip('/').lower(), tokens[1:]))
+    return operations
@@ -0,0 +1,63 @@
+# deal_tracker/tests/conftest.py
+"""
+Модули deal_tracker импортируются плоско (import config), а config читает
+окружение при импорте: каталог пакета добавляется в sys.path, а таблица и
+состояние переключаются на локальные во временном каталоге до первого импорта.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PACKAGE_DIR not in sys.path:
+    sys.path.insert(0, PACKAGE_DIR)
+
+_WORK_DIR = tempfile.mkdtemp(prefix='deal_tracker_tests_')
+os.environ['STATE_DIR'] = os.path.join(_WORK_DIR, 'state')
+os.environ['SHEETS_BACKEND'] = 'local'
+os.environ['LOCAL_SHEETS_PATH'] = ''
+os.environ['LOCAL_SHEETS_LATENCY_MS'] = '0'
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+# Листы учета со столбцами уровней сделки (SL/TP) - как в README
+LEDGER_HEADERS = {
+    'Core_Trades': ['Timestamp', 'Order_ID', 'Exchange', 'Symbol', 'Type', 'Amount', 'Price',
+                    'Total_Quote_Amount', 'Commission', 'Commission_Asset', 'Notes', 'Trade_ID', 'Trade_PNL',
+                    'SL', 'TP1', 'TP2', 'TP3', 'Risk_USD'],
+    'Fund_Movements': ['Movement_ID', 'Timestamp', 'Type', 'Asset', 'Amount', 'Source_Name',
+                       'Destination_Name', 'Fee_Amount', 'Fee_Asset', 'Transaction_ID_Blockchain', 'Notes'],
+    'Open_Positions': ['Symbol', 'Exchange', 'Net_Amount', 'Avg_Entry_Price', 'Current_Price',
+                       'Unrealized_PNL', 'Last_Updated', 'Is_Closed', 'Closed_At'],
+    'Account_Balances': ['Account_Name', 'Asset', 'Balance', 'Entity_Type', 'Last_Updated'],
+}
+
+
+def seed_ledger(headers=None) -> None:
+    """Пустые листы учета в памяти и чистый STATE_DIR; кэши модулей сбрасываются."""
+    import dedupe_index
+    import ledger_state
+    import sheets_service
+
+    shutil.rmtree(os.environ['STATE_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['STATE_DIR'])
+    sheets_service._get_spreadsheet().seed(headers or LEDGER_HEADERS)
+    sheets_service._header_cache.clear()
+    sheets_service._worksheet_cache.clear()
+    ledger_state.get_ledger_state().invalidate()
+    dedupe_index._dedupe_index.invalidate()
+
+
+@pytest.fixture
+def ledger():
+    """Пустой учет на локальном бэкенде."""
+    seed_ledger()
+    return LEDGER_HEADERS
+
+
+@pytest.fixture
+def reseed_ledger(ledger):
+    """Пересоздает пустой учет с другими заголовками листов."""
+    return seed_ledger
@@ -0,0 +1,60 @@
+# deal_tracker/tests/fake_exchange.py
+"""Фейковая биржа с интерфейсом CCXT для проверки синхронизации без сети."""
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from models import IngestResult
+
+
+class FakeExchange:
+    """Минимальная биржа с интерфейсом CCXT для fetch_my_trades/fetch_deposits/fetch_withdrawals."""
+
+    def __init__(self, exchange_id: str, trades=None, deposits=None, withdrawals=None):
+        self.id = exchange_id
+        self.has = {'fetchMyTrades': True, 'fetchDeposits': True, 'fetchWithdrawals': True}
+        self.markets: Dict[str, Any] = {}
+        self.trades = trades or []
+        self.deposits = deposits or []
+        self.withdrawals = withdrawals or []
+        self.calls: List[Tuple[str, Optional[str], Optional[int]]] = []
+
+    @staticmethod
+    def _page(items, since, limit, symbol=None):
+        selected = [i for i in items if (since is None or i['timestamp'] >= since)
+                    and (symbol is None or i.get('symbol') == symbol)]
+        return sorted(selected, key=lambda i: i['timestamp'])[:limit]
+
+    async def fetch_my_trades(self, symbol=None, since=None, limit=None, params=None):
+        self.calls.append(('fetch_my_trades', symbol, since))
+        return self._page(self.trades, since, limit, symbol)
+
+    async def fetch_deposits(self, code=None, since=None, limit=None, params=None):
+        self.calls.append(('fetch_deposits', code, since))
+        return self._page(self.deposits, since, limit)
+
+    async def fetch_withdrawals(self, code=None, since=None, limit=None, params=None):
+        self.calls.append(('fetch_withdrawals', code, since))
+        return self._page(self.withdrawals, since, limit)
+
+    async def close(self):
+        pass
+
+
+def sample_factory():
+    """Фабрика бирж с историей: депозит и 40 исполнений (по два на ордер) за последние часы."""
+    now_ms = int(time.time() * 1000)
+    trades = [{'id': str(i), 'order': f"o{i // 2}", 'timestamp': now_ms - (100 - i) * 60000,
+               'symbol': 'BTC/USDT', 'side': 'buy' if i % 4 < 2 else 'sell',
+               'amount': 0.001, 'price': 60000 + i, 'fee': {'cost': 0.01, 'currency': 'USDT'}}
+              for i in range(40)]
+    deposits = [{'id': 'd1', 'txid': 'fake-tx-1', 'timestamp': now_ms - 200 * 60000,
+                 'currency': 'USDT', 'amount': 10000, 'status': 'ok'}]
+
+    async def factory(exchange_id: str):
+        return FakeExchange(exchange_id, trades=trades, deposits=deposits)
+    return factory
+
+
+def dry_run_ingest(items: List[Any]) -> List[IngestResult]:
+    """Функция записи, принимающая все записи без обращения к таблице."""
+    return [IngestResult(index=i, success=True, message='dry-run') for i in range(len(items))]
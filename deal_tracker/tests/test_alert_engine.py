@@ -0,0 +1,151 @@
+# deal_tracker/tests/test_alert_engine.py
+import asyncio
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, List, Optional
+
+from alert_engine import PriceAlertEngine
+from models import PositionData, TradeData
+
+SYMBOL = 'BTC/USDT'
+EXCHANGE = 'binance'
+
+
+class _Sender:
+    """
+    send_alert, запоминающий отправленные тексты; accept=False - очередь отклоняет.
+    deliver=None - результат доставки не сообщается сразу, а копится в held.
+    """
+
+    def __init__(self):
+        self.sent: List[str] = []
+        self.accept = True
+        self.deliver: Optional[bool] = True
+        self.held: List[Callable[[bool], None]] = []
+
+    async def __call__(self, message: str, on_result: Callable[[bool], None]) -> bool:
+        if not self.accept:
+            return False
+        if self.deliver is None:
+            self.held.append(on_result)
+            return True
+        if self.deliver:
+            self.sent.append(message)
+        on_result(self.deliver)
+        return True
+
+
+def _trade(trade_id: str, **levels) -> TradeData:
+    return TradeData(timestamp=datetime(2024, 1, 1), exchange=EXCHANGE, symbol=SYMBOL, trade_type='BUY',
+                     amount=Decimal('1'), price=Decimal('100'), trade_id=trade_id,
+                     **{name: Decimal(value) for name, value in levels.items()})
+
+
+def _engine(sender: _Sender, store_path: str) -> PriceAlertEngine:
+    engine = PriceAlertEngine(send_alert=sender, fired_store_path=store_path)
+    engine.load_levels([_trade('t1', sl='90', tp1='110', tp2='120'), _trade('t2', sl='95', tp1='115')],
+                       [PositionData(symbol=SYMBOL, exchange=EXCHANGE, net_amount=Decimal('2'),
+                                     avg_entry_price=Decimal('100'))])
+    return engine
+
+
+def _tick(engine: PriceAlertEngine, price: str):
+    return asyncio.run(engine.on_price(SYMBOL.lower(), EXCHANGE.upper(), Decimal(price)))
+
+
+def _fired(levels) -> List[str]:
+    return sorted(level.fired_key for level in levels)
+
+
+def test_take_profits_fire_when_price_rises_through_them(tmp_path):
+    engine = _engine(_Sender(), str(tmp_path / 'fired.json'))
+
+    assert _tick(engine, '109.99') == []
+    assert _fired(_tick(engine, '110')) == ['t1:TP1']
+    assert _fired(_tick(engine, '125')) == ['t1:TP2', 't2:TP1']
+    assert engine.active_levels_count() == 2
+
+
+def test_stop_losses_fire_when_price_falls_through_them(tmp_path):
+    engine = _engine(_Sender(), str(tmp_path / 'fired.json'))
+
+    assert _tick(engine, '95.01') == []
+    assert _fired(_tick(engine, '95')) == ['t2:SL']
+    assert _fired(_tick(engine, '80')) == ['t1:SL']
+    assert engine.active_levels_count() == 3
+
+
+def test_level_fires_once(tmp_path):
+    sender = _Sender()
+    engine = _engine(sender, str(tmp_path / 'fired.json'))
+
+    assert _fired(_tick(engine, '111')) == ['t1:TP1']
+    for price in ('100', '111', '112', '111'):
+        assert _tick(engine, price) == []
+    assert len(sender.sent) == 1
+    assert 'TP1' in sender.sent[0] and 't1' in sender.sent[0]
+
+
+def test_rejected_alert_is_retried_on_next_tick(tmp_path):
+    sender = _Sender()
+    engine = _engine(sender, str(tmp_path / 'fired.json'))
+
+    sender.accept = False
+    assert _tick(engine, '111') == []
+    sender.accept = True
+    assert _fired(_tick(engine, '111')) == ['t1:TP1']
+
+
+def test_fired_levels_survive_reload(tmp_path):
+    store_path = str(tmp_path / 'fired.json')
+    engine = _engine(_Sender(), store_path)
+    _tick(engine, '111')
+    _tick(engine, '94')
+
+    sender = _Sender()
+    reloaded = _engine(sender, store_path)
+
+    assert reloaded.active_levels_count() == 3
+    assert _tick(reloaded, '111') == []
+    assert _fired(_tick(reloaded, '89')) == ['t1:SL']
+    assert len(sender.sent) == 1
+
+
+def test_undelivered_alert_returns_level_to_book(tmp_path):
+    sender = _Sender()
+    engine = _engine(sender, str(tmp_path / 'fired.json'))
+
+    sender.deliver = False
+    _tick(engine, '111')
+    assert engine.active_levels_count() == 5
+    sender.deliver = True
+    assert _fired(_tick(engine, '111')) == ['t1:TP1']
+    assert len(sender.sent) == 1
+
+
+def test_level_is_fired_only_after_delivery(tmp_path):
+    store_path = str(tmp_path / 'fired.json')
+    sender = _Sender()
+    engine = _engine(sender, store_path)
+
+    sender.deliver = None
+    assert _fired(_tick(engine, '111')) == ['t1:TP1']
+    # Пока алерт в очереди, уровень не срабатывает повторно и не считается сработавшим
+    assert _tick(engine, '112') == []
+    assert _engine(_Sender(), store_path).active_levels_count() == 5
+
+    sender.held.pop()(True)
+    assert _engine(_Sender(), store_path).active_levels_count() == 4
+
+
+def test_alert_lost_on_shutdown_fires_again(tmp_path):
+    sender = _Sender()
+    engine = _engine(sender, str(tmp_path / 'fired.json'))
+
+    sender.deliver = None
+    _tick(engine, '111')
+    sender.held.pop()(False)
+
+    assert engine.active_levels_count() == 5
+    sender.deliver = True
+    assert _fired(_tick(engine, '111')) == ['t1:TP1']
@@ -0,0 +1,62 @@
+# deal_tracker/tests/test_csv_import.py
+import io
+from datetime import datetime
+from decimal import Decimal
+
+import csv_import
+import exchange_sync
+import sheets_service
+import trade_logger
+
+BINANCE_HEADER = 'Date(UTC),Order ID,Trade ID,Pair,Side,Price,Executed,Amount,Fee\n'
+
+
+def _deposit(amount: str = '100000') -> None:
+    success, message = trade_logger.log_fund_movement('DEPOSIT', 'USDT', Decimal(amount), datetime(2024, 1, 1),
+                                                      destination_name='binance')
+    assert success, message
+
+
+def _import(text: str) -> csv_import.ImportStats:
+    return csv_import.import_csv(io.BytesIO(text.encode('utf-8')), 'binance_trades')
+
+
+def test_fills_of_one_order_are_imported_separately(ledger):
+    _deposit()
+    stats = _import(BINANCE_HEADER
+                    + '2024-01-02 10:00:01,111,5002,BTCUSDT,BUY,40000,0.2BTC,8000USDT,8USDT\n'
+                    + '2024-01-02 10:00:00,111,5001,BTCUSDT,BUY,40000,0.3BTC,12000USDT,12USDT\n')
+
+    assert (stats.accepted, stats.skipped, stats.rejected) == (2, 0, 0)
+    assert sorted(t.order_id for t in sheets_service.get_all_core_trades()) == ['111#5001', '111#5002']
+
+
+def test_fills_without_trade_id_are_told_apart(ledger):
+    _deposit()
+    header = 'Date(UTC),Order ID,Pair,Side,Price,Executed,Amount,Fee\n'
+    rows = ('2024-01-02 10:00:01,111,BTCUSDT,BUY,40000,0.2BTC,8000USDT,8USDT\n'
+            '2024-01-02 10:00:00,111,BTCUSDT,BUY,40000,0.3BTC,12000USDT,12USDT\n')
+
+    assert _import(header + rows).accepted == 2
+    assert _import(header + rows).skipped == 2
+
+
+def test_fill_from_csv_and_from_sync_share_a_key(ledger):
+    _deposit()
+    _import(BINANCE_HEADER + '2024-01-02 10:00:00,111,5001,BTCUSDT,BUY,40000,0.3BTC,12000USDT,12USDT\n')
+    synced = exchange_sync.trade_from_ccxt('binance', {
+        'symbol': 'BTC/USDT', 'side': 'buy', 'amount': 0.3, 'price': 40000, 'order': '111', 'id': '5001',
+        'timestamp': 1704189600000, 'fee': {'cost': 12, 'currency': 'USDT'}})
+
+    results = trade_logger.log_trades([synced])
+
+    assert results[0].duplicate
+    assert len(sheets_service.get_all_core_trades()) == 1
+
+
+def test_buy_with_fee_in_bought_coin_is_accepted(ledger):
+    _deposit()
+    stats = _import(BINANCE_HEADER + '2024-01-02 10:00:00,111,5001,BTCUSDT,BUY,40000,0.3BTC,12000USDT,0.0003BTC\n')
+
+    assert (stats.accepted, stats.rejected) == (1, 0), stats.errors
+    assert {b.asset: b.balance for b in sheets_service.get_all_balances()}['BTC'] == Decimal('0.2997')
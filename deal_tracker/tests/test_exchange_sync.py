@@ -0,0 +1,156 @@
+# deal_tracker/tests/test_exchange_sync.py
+import asyncio
+from typing import Any, List, Set
+
+import sheets_service
+from exchange_sync import CursorStore, ExchangeSyncer
+from fake_exchange import FakeExchange, dry_run_ingest, sample_factory
+from models import IngestResult
+from trade_logger import WRITE_FAILED_MESSAGE
+
+EXCHANGE = 'fakeexchange'
+START_MS = 1_700_000_000_000
+
+
+def _fill(i: int, timestamp: int) -> dict:
+    return {'id': f"f{i}", 'order': f"o{i}", 'timestamp': timestamp, 'symbol': 'BTC/USDT',
+            'side': 'buy', 'amount': 0.001, 'price': 60000 + i}
+
+
+def _fills(count: int, per_ms: int) -> List[dict]:
+    """count исполнений, по per_ms в каждой миллисекунде."""
+    return [_fill(i, START_MS + i // per_ms) for i in range(count)]
+
+
+class _Ledger:
+    """Идемпотентная запись по order_id, как индекс дубликатов trade_logger."""
+
+    def __init__(self, reject: Set[str] = ()):
+        self.order_ids: List[str] = []
+        self.reject = set(reject)
+
+    def ingest(self, items: List[Any]) -> List[IngestResult]:
+        results = []
+        for index, trade in enumerate(items):
+            if trade.order_id in self.order_ids:
+                results.append(IngestResult(index=index, success=False, message='дубликат', duplicate=True))
+            elif trade.order_id in self.reject:
+                results.append(IngestResult(index=index, success=False, message='Недостаточно средств'))
+            else:
+                self.order_ids.append(trade.order_id)
+                results.append(IngestResult(index=index, success=True, message='ok'))
+        return results
+
+
+def _syncer(exchange: FakeExchange, ledger: _Ledger, cursor_path: str, page_limit: int = 2) -> ExchangeSyncer:
+    async def factory(exchange_id: str):
+        return exchange
+
+    def no_movements(items: List[Any]) -> List[IngestResult]:
+        return [IngestResult(index=i, success=True, message='ok') for i in range(len(items))]
+
+    syncer = ExchangeSyncer(exchange_ids=[EXCHANGE], exchange_factory=factory,
+                            cursor_store=CursorStore(cursor_path), page_limit=page_limit,
+                            ingest_trades=ledger.ingest, ingest_movements=no_movements)
+    syncer._initial_since = lambda: START_MS
+    return syncer
+
+
+def _run(syncer: ExchangeSyncer):
+    return asyncio.run(syncer.sync_exchange(EXCHANGE, {'BTC/USDT'}))
+
+
+def test_same_millisecond_fills_across_page_boundary(tmp_path):
+    exchange = FakeExchange(EXCHANGE, trades=_fills(9, per_ms=3))
+    ledger = _Ledger()
+
+    report = _run(_syncer(exchange, ledger, str(tmp_path / 'cursors.json')))
+
+    assert report.error is None
+    assert sorted(ledger.order_ids) == sorted(f"o{i}#f{i}" for i in range(9))
+    assert report.trades_fetched == 9
+
+
+def test_page_of_single_millisecond_is_not_truncated(tmp_path):
+    exchange = FakeExchange(EXCHANGE, trades=_fills(7, per_ms=7))
+    ledger = _Ledger()
+
+    _run(_syncer(exchange, ledger, str(tmp_path / 'cursors.json')))
+
+    assert len(ledger.order_ids) == 7
+
+
+def test_cursor_persists_and_picks_up_late_fill_of_last_millisecond(tmp_path):
+    cursor_path = str(tmp_path / 'cursors.json')
+    fills = _fills(6, per_ms=3)
+    exchange = FakeExchange(EXCHANGE, trades=fills)
+    ledger = _Ledger()
+    _run(_syncer(exchange, ledger, cursor_path))
+    last_ms = START_MS + 1
+    assert CursorStore(cursor_path).get(EXCHANGE, 'trades:BTC/USDT') == last_ms
+
+    # Исполнение той же миллисекунды, появившееся у биржи после первого запуска
+    exchange.trades = fills + [_fill(6, last_ms), _fill(7, last_ms + 5)]
+    exchange.calls.clear()
+    report = _run(_syncer(exchange, ledger, cursor_path))
+
+    trade_calls = [call for call in exchange.calls if call[0] == 'fetch_my_trades']
+    assert trade_calls[0] == ('fetch_my_trades', 'BTC/USDT', last_ms)
+    assert len(ledger.order_ids) == 8 and len(set(ledger.order_ids)) == 8
+    assert report.accepted == 2 and report.duplicates == 3
+    assert CursorStore(cursor_path).get(EXCHANGE, 'trades:BTC/USDT') == last_ms + 5
+
+
+def test_rejected_fill_is_reported_and_skipped(tmp_path):
+    cursor_path = str(tmp_path / 'cursors.json')
+    exchange = FakeExchange(EXCHANGE, trades=_fills(9, per_ms=3))
+    ledger = _Ledger(reject={'o4#f4'})
+
+    report = _run(_syncer(exchange, ledger, cursor_path))
+
+    assert report.error is None
+    assert len(report.rejected) == 1
+    assert 'o4#f4' in report.rejected[0] and 'Недостаточно средств' in report.rejected[0]
+    assert len(ledger.order_ids) == 8
+    assert CursorStore(cursor_path).get(EXCHANGE, 'trades:BTC/USDT') == START_MS + 2
+
+
+def test_retryable_failure_keeps_cursor(tmp_path):
+    cursor_path = str(tmp_path / 'cursors.json')
+    exchange = FakeExchange(EXCHANGE, trades=_fills(6, per_ms=3))
+    ledger = _Ledger()
+    syncer = _syncer(exchange, ledger, cursor_path)
+    syncer.ingest_trades = lambda items: [IngestResult(index=i, success=False, message=WRITE_FAILED_MESSAGE)
+                                          for i in range(len(items))]
+
+    report = _run(syncer)
+
+    assert report.error and not report.rejected
+    assert CursorStore(cursor_path).get(EXCHANGE, 'trades:BTC/USDT') is None
+
+    report = _run(_syncer(exchange, ledger, cursor_path))
+
+    assert report.accepted == 6
+    assert CursorStore(cursor_path).get(EXCHANGE, 'trades:BTC/USDT') == START_MS + 1
+
+
+def test_dry_run_reads_sample_history(tmp_path):
+    syncer = ExchangeSyncer(exchange_ids=[EXCHANGE], exchange_factory=sample_factory(),
+                            cursor_store=CursorStore(str(tmp_path / 'cursors.json')),
+                            ingest_trades=dry_run_ingest, ingest_movements=dry_run_ingest)
+
+    report = asyncio.run(syncer.sync_exchange(EXCHANGE, {'BTC/USDT'}))
+
+    assert (report.movements_fetched, report.trades_fetched, report.accepted) == (1, 40, 41)
+
+
+def test_sync_into_ledger_is_idempotent(ledger, tmp_path):
+    syncer = ExchangeSyncer(exchange_ids=[EXCHANGE], exchange_factory=sample_factory(),
+                            cursor_store=CursorStore(str(tmp_path / 'cursors.json')))
+
+    first = asyncio.run(syncer.sync_exchange(EXCHANGE, {'BTC/USDT'}))
+    second = asyncio.run(syncer.sync_exchange(EXCHANGE, {'BTC/USDT'}))
+
+    assert (first.accepted, first.rejected) == (41, [])
+    assert second.accepted == 0
+    assert len(sheets_service.get_all_core_trades()) == 40
@@ -0,0 +1,105 @@
+# deal_tracker/tests/test_notifier.py
+import asyncio
+from typing import List, Tuple
+
+from telegram.error import BadRequest, RetryAfter
+
+from notifier import NotificationOutbox
+
+CHAT = 42
+
+
+class _Bot:
+    """Бот, запоминающий сообщения; errors - исключения для первых вызовов send_message."""
+
+    def __init__(self, errors=()):
+        self.messages: List[Tuple[int, str]] = []
+        self.errors = list(errors)
+
+    async def send_message(self, chat_id, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.messages.append((chat_id, text))
+
+
+def _outbox(bot: _Bot, **kwargs) -> NotificationOutbox:
+    params = dict(min_interval=0, coalesce_window=0.05, max_retries=2)
+    params.update(kwargs)
+    return NotificationOutbox(bot, **params)
+
+
+def _run_with(outbox: NotificationOutbox, messages: List[str], results: list) -> List[bool]:
+    async def scenario():
+        accepted = [outbox.enqueue(text, CHAT, on_result=results.append) for text in messages]
+        await outbox.flush(timeout=5)
+        return accepted
+    return asyncio.run(scenario())
+
+
+def test_burst_is_coalesced_into_one_message():
+    bot, results = _Bot(), []
+    outbox = _outbox(bot)
+
+    assert _run_with(outbox, ['a', 'b', 'c'], results) == [True, True, True]
+
+    assert len(bot.messages) == 1
+    assert bot.messages[0][1] == "🔔 Уведомлений: 3\n\na\n\nb\n\nc"
+    assert results == [True, True, True]
+    assert outbox.stats()['sent_alerts'] == 3
+
+
+def test_retry_after_is_waited_and_message_delivered():
+    bot, results = _Bot(errors=[RetryAfter(0)]), []
+    outbox = _outbox(bot)
+
+    _run_with(outbox, ['a'], results)
+
+    assert bot.messages == [(CHAT, 'a')]
+    assert results == [True]
+    assert outbox.stats()['retries'] == 1
+
+
+def test_delivery_failure_is_reported():
+    bot, results = _Bot(errors=[RetryAfter(0)] * 3), []
+    outbox = _outbox(bot)
+
+    _run_with(outbox, ['a'], results)
+
+    assert bot.messages == []
+    assert results == [False]
+    assert outbox.stats()['failed_alerts'] == 1
+
+
+def test_rejected_by_telegram_is_not_retried():
+    bot, results = _Bot(errors=[BadRequest('chat not found')]), []
+    outbox = _outbox(bot)
+
+    _run_with(outbox, ['a'], results)
+
+    assert results == [False]
+    assert outbox.stats()['retries'] == 0
+
+
+def test_overflow_rejects_and_is_reported_in_next_summary():
+    bot, results = _Bot(), []
+    outbox = _outbox(bot, max_queue=2)
+
+    assert _run_with(outbox, ['a', 'b', 'c'], results) == [True, True, False]
+
+    assert results == [True, True]
+    assert outbox.stats()['rejected'] == 1
+    assert 'отклонено сообщений: 1' in bot.messages[0][1]
+
+
+def test_close_reports_unsent_messages():
+    bot, results = _Bot(), []
+    outbox = _outbox(bot, coalesce_window=10)
+
+    async def scenario():
+        outbox.enqueue('a', CHAT, on_result=results.append)
+        await outbox.close(timeout=0.01)
+
+    asyncio.run(scenario())
+
+    assert bot.messages == []
+    assert results == [False]
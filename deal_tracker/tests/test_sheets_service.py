@@ -0,0 +1,46 @@
+# deal_tracker/tests/test_sheets_service.py
+from datetime import datetime
+from decimal import Decimal
+
+import sheets_service
+import trade_logger
+from sheets_service import _merge_contiguous_cells
+
+
+def _ranges(payload) -> list:
+    return [(item['range'], item['values']) for item in payload]
+
+
+def test_adjacent_columns_of_a_row_form_one_range():
+    payload = _merge_contiguous_cells([(2, 3, 'c'), (2, 1, 'a'), (2, 2, 'b'), (2, 5, 'e')])
+
+    assert _ranges(payload) == [('A2:C2', [['a', 'b', 'c']]), ('E2:E2', [['e']])]
+
+
+def test_equal_segments_of_consecutive_rows_form_a_block():
+    cells = [(row, col, f"{row}{col}") for row in (3, 4, 5) for col in (2, 3)]
+
+    assert _ranges(_merge_contiguous_cells(cells)) == [('B3:C5', [['32', '33'], ['42', '43'], ['52', '53']])]
+
+
+def test_gap_or_different_columns_start_a_new_block():
+    cells = [(2, 1, 'a2'), (3, 1, 'a3'), (5, 1, 'a5'), (6, 1, 'a6'), (6, 2, 'b6')]
+
+    assert _ranges(_merge_contiguous_cells(cells)) == [
+        ('A2:A3', [['a2'], ['a3']]), ('A5:A5', [['a5']]), ('A6:B6', [['a6', 'b6']])]
+
+
+def test_batch_update_fields_writes_only_given_columns(ledger):
+    now = datetime(2024, 1, 2, 10, 0)
+    trade_logger.log_fund_movement('DEPOSIT', 'USDT', Decimal('1000'), now, destination_name='binance')
+    for price in ('100', '110'):
+        trade_logger.log_trade('BUY', 'binance', 'BTC/USDT', Decimal('1'), Decimal(price), now)
+    trades = sheets_service.get_all_core_trades()
+    for trade in trades:
+        trade.sl, trade.tp1, trade.notes = Decimal('90'), Decimal('120'), 'не записывать'
+
+    assert sheets_service.batch_update_fields('Core_Trades', trades, ['sl', 'tp1'])
+
+    stored = sheets_service.get_all_core_trades()
+    assert [(t.sl, t.tp1) for t in stored] == [(Decimal('90'), Decimal('120'))] * 2
+    assert 'не записывать' not in [t.notes for t in stored]
@@ -0,0 +1,22 @@
+# deal_tracker/tests/test_stress_ledger.py
+"""
+Уменьшенный прогон stress_ledger.py. Он запускается отдельным процессом:
+рабочие процессы пишут в общий файл локальной таблицы, а config этого
+процесса уже настроен на таблицу в памяти.
+"""
+import os
+import subprocess
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_parallel_processes_and_threads_keep_ledger_consistent():
+    env = dict(os.environ, LOG_LEVEL='ERROR')
+    result = subprocess.run(
+        [sys.executable, os.path.join(PACKAGE_DIR, 'stress_ledger.py'),
+         '--processes', '2', '--threads', '3', '--ops', '3', '--latency-ms', '1'],
+        cwd=PACKAGE_DIR, env=env, capture_output=True, text=True, timeout=300)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Результат: OK' in result.stdout
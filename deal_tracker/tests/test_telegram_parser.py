@@ -0,0 +1,98 @@
+# deal_tracker/tests/test_telegram_parser.py
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import config
+import telegram_parser
+from telegram_parser import MOVEMENT_SCHEMAS, TRADE_SCHEMA, parse_batch_lines, parse_command_args_advanced
+
+LOCAL_TZ = timezone(timedelta(hours=config.TZ_OFFSET_HOURS))
+
+
+# --- Токенизатор ---
+
+
+def test_positional_and_named_args():
+    assert parse_command_args_advanced(['BTC/USDT', '0.1', 'exch:binance', 'fee:0,1'], 3) == (
+        ['BTC/USDT', '0.1'], {'exch': 'binance', 'fee': '0,1'})
+
+
+def test_value_collects_following_tokens_and_drops_quotes():
+    _, named = parse_command_args_advanced(['notes:"купил', 'на', 'откате"', 'flag:', 'Id:7'], 0)
+
+    assert named == {'notes': 'купил на откате', 'flag': '', 'id': '7'}
+
+
+def test_positional_limit_and_positional_after_key():
+    assert parse_command_args_advanced(['a', 'b', 'c', 'k:v', 'd'], 2) == (['a', 'b'], {'k': 'v d'})
+
+
+def test_url_is_not_a_key():
+    _, named = parse_command_args_advanced(['notes:see', 'http://x.com', 'https://y.org/a:b'], 0)
+
+    assert named == {'notes': 'see http://x.com https://y.org/a:b'}
+
+
+def test_unknown_key_inside_value_is_text_when_keys_are_known():
+    _, named = parse_command_args_advanced(['notes:ист:биржа', 'время:утро', 'fee:1'], 0, {'notes', 'fee'})
+
+    assert named == {'notes': 'ист:биржа время:утро', 'fee': '1'}
+
+
+# --- Схемы команд ---
+
+
+def test_trade_schema_converts_types():
+    parsed = TRADE_SCHEMA.parse(['BTC/USDT', '0,5', '60000', 'exch:binance', 'sl:55000', 'risk:100',
+                                 'date:2024-01-02', 'notes:see', 'http://x.com'])
+
+    assert parsed.ok, parsed.errors
+    values = parsed.values
+    assert (values['symbol'], values['amount'], values['price']) == ('BTC/USDT', Decimal('0.5'), Decimal('60000'))
+    assert (values['exchange'], values['sl'], values['risk_usd']) == ('binance', Decimal('55000'), Decimal('100'))
+    assert values['timestamp'] == datetime(2024, 1, 2, tzinfo=LOCAL_TZ)
+    assert values['notes'] == 'see http://x.com'
+    assert values['tp1'] is None and values['commission'] is None
+
+
+def test_trade_schema_reports_all_errors_at_once():
+    parsed = TRADE_SCHEMA.parse(['BTC/USDT', '-1', 'abc', 'typo:5'])
+
+    assert not parsed.ok
+    assert any(e.startswith('QTY') for e in parsed.errors)
+    assert any(e.startswith('PRICE') for e in parsed.errors)
+    assert 'неизвестный ключ typo:' in parsed.errors
+    assert 'не указан exch:' in parsed.errors
+
+
+def test_transfer_schema_positional_accounts():
+    parsed = MOVEMENT_SCHEMAS['TRANSFER'].parse(['USDT', '100', 'binance', 'bybit', 'fee:1'])
+
+    assert parsed.ok, parsed.errors
+    assert (parsed.values['source_name'], parsed.values['destination_name']) == ('binance', 'bybit')
+    assert parsed.values['fee_amount'] == Decimal('1')
+
+
+def test_batch_lines():
+    text = "/batch buy BTC/USDT 1 100 exch:binance\n\n# комментарий\n/deposit USDT 10 dest_name:binance"
+
+    assert parse_batch_lines(text) == [
+        (1, 'buy', ['BTC/USDT', '1', '100', 'exch:binance']),
+        (4, 'deposit', ['USDT', '10', 'dest_name:binance'])]
+
+
+# --- Даты ---
+
+
+def test_iso_dates_do_not_use_dateutil(monkeypatch):
+    def fail(value):
+        raise AssertionError(f"dateutil вызван для {value}")
+    monkeypatch.setattr(telegram_parser.utils, 'parse_datetime_flexible', fail)
+
+    assert telegram_parser._to_datetime('2024-01-02T10:30:00') == datetime(2024, 1, 2, 10, 30, tzinfo=LOCAL_TZ)
+    assert telegram_parser._to_datetime('2024-01-02 10:30+00:00') == datetime(2024, 1, 2, 10, 30, tzinfo=timezone.utc)
+    assert telegram_parser._to_datetime('2024-01-02').tzinfo == LOCAL_TZ
+
+
+def test_other_date_formats_fall_back_to_dateutil():
+    assert telegram_parser._to_datetime('Jan 2 2024 10:30') == datetime(2024, 1, 2, 10, 30, tzinfo=LOCAL_TZ)
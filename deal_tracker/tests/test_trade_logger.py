@@ -0,0 +1,79 @@
+# deal_tracker/tests/test_trade_logger.py
+from datetime import datetime
+from decimal import Decimal
+
+import ledger_state
+import sheets_service
+import trade_logger
+
+NOW = datetime(2024, 1, 2, 10, 0)
+
+
+def _balance(asset: str) -> Decimal:
+    state = ledger_state.get_ledger_state()
+    state.load()
+    return state.get_balance('binance', asset)
+
+
+def _fund(asset: str, amount: str) -> None:
+    success, message = trade_logger.log_fund_movement('DEPOSIT', asset, Decimal(amount), NOW,
+                                                      destination_name='binance')
+    assert success, message
+
+
+def test_buy_with_fee_in_bought_asset_is_netted(ledger):
+    _fund('USDT', '1000')
+
+    success, message = trade_logger.log_trade('BUY', 'binance', 'BTC/USDT', Decimal('0.01'), Decimal('40000'), NOW,
+                                              commission=Decimal('0.00001'), commission_asset='BTC')
+
+    assert success, message
+    assert _balance('BTC') == Decimal('0.00999')
+    assert _balance('USDT') == Decimal('600')
+
+
+def test_buy_with_fee_in_quote_asset_is_charged_on_top(ledger):
+    _fund('USDT', '1000')
+
+    success, message = trade_logger.log_trade('BUY', 'binance', 'BTC/USDT', Decimal('0.01'), Decimal('40000'), NOW,
+                                              commission=Decimal('0.4'), commission_asset='USDT')
+
+    assert success, message
+    assert _balance('BTC') == Decimal('0.01')
+    assert _balance('USDT') == Decimal('599.6')
+
+
+def test_buy_with_fee_in_third_asset_needs_its_balance(ledger):
+    _fund('USDT', '1000')
+
+    success, message = trade_logger.log_trade('BUY', 'binance', 'BTC/USDT', Decimal('0.01'), Decimal('40000'), NOW,
+                                              commission=Decimal('0.001'), commission_asset='BNB')
+
+    assert not success
+    assert 'BNB' in message
+    assert _balance('USDT') == Decimal('1000')
+
+
+def test_levels_are_stored_in_their_columns(ledger):
+    _fund('USDT', '1000')
+
+    success, message = trade_logger.log_trade('BUY', 'binance', 'BTC/USDT', Decimal('0.01'), Decimal('40000'), NOW,
+                                              sl=Decimal('38000'), tp1=Decimal('42000'), risk_usd=Decimal('20'))
+
+    assert success, message
+    trade = sheets_service.get_all_core_trades()[0]
+    assert (trade.sl, trade.tp1, trade.tp2, trade.risk_usd) == (Decimal('38000'), Decimal('42000'), None, Decimal('20'))
+
+
+def test_levels_without_columns_are_rejected(ledger, reseed_ledger):
+    headers = dict(ledger, Core_Trades=[h for h in ledger['Core_Trades'] if h not in ('SL', 'TP1', 'Risk_USD')])
+    reseed_ledger(headers)
+    _fund('USDT', '1000')
+
+    success, message = trade_logger.log_trade('BUY', 'binance', 'BTC/USDT', Decimal('0.01'), Decimal('40000'), NOW,
+                                              sl=Decimal('38000'), tp2=Decimal('44000'))
+
+    assert not success
+    assert 'SL' in message and 'TP2' not in message
+    assert sheets_service.get_all_core_trades() == []
+    assert _balance('USDT') == Decimal('1000')
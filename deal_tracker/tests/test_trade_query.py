@@ -0,0 +1,84 @@
+# deal_tracker/tests/test_trade_query.py
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import config
+import trade_logger
+import trade_query
+from models import TradeData
+from trade_query import TradeIndex
+
+START = datetime(2024, 1, 1, 12, 0)
+
+
+def _trade(i: int, symbol: str = 'BTC/USDT', exchange: str = 'binance') -> TradeData:
+    return TradeData(timestamp=START + timedelta(hours=i), exchange=exchange, symbol=symbol, trade_type='BUY',
+                     amount=Decimal('1'), price=Decimal(100 + i), trade_id=f"t{i}")
+
+
+def _ids(page) -> list:
+    return [t.trade_id for t in page.trades]
+
+
+def test_pages_go_from_newest_to_oldest():
+    index = TradeIndex([_trade(i) for i in range(7)])
+
+    pages = [index.query('BTC/USDT', page=n, page_size=3) for n in (1, 2, 3, 4)]
+
+    assert [_ids(p) for p in pages] == [['t6', 't5', 't4'], ['t3', 't2', 't1'], ['t0'], []]
+    assert {(p.pages, p.total) for p in pages} == {(3, 7)}
+
+
+def test_bounds_include_since_and_exclude_until():
+    index = TradeIndex([_trade(i) for i in range(7)])
+
+    page = index.query('BTC/USDT', since=START + timedelta(hours=2), until=START + timedelta(hours=5))
+
+    assert _ids(page) == ['t4', 't3', 't2']
+    assert page.total == 3
+
+
+def test_bounds_combine_with_pagination():
+    index = TradeIndex([_trade(i) for i in range(10)])
+
+    page = index.query(since=START + timedelta(hours=1), until=START + timedelta(hours=8), page=2, page_size=4)
+
+    assert _ids(page) == ['t3', 't2', 't1']
+    assert (page.page, page.pages, page.total) == (2, 2, 7)
+
+
+def test_aware_bounds_match_naive_local_timestamps():
+    index = TradeIndex([_trade(i) for i in range(3)])
+    local = timezone(timedelta(hours=config.TZ_OFFSET_HOURS))
+
+    page = index.query(since=(START + timedelta(hours=1)).replace(tzinfo=local).astimezone(timezone.utc))
+
+    assert _ids(page) == ['t2', 't1']
+
+
+def test_empty_range_and_unknown_symbol():
+    index = TradeIndex([_trade(i) for i in range(3)])
+
+    assert index.query('ETH/USDT').total == 0
+    empty = index.query(since=START + timedelta(hours=2), until=START + timedelta(hours=1))
+    assert (empty.trades, empty.pages, empty.total) == ([], 0, 0)
+
+
+def test_filters_by_symbol_exchange_and_pair():
+    index = TradeIndex([_trade(0), _trade(1, exchange='bybit'), _trade(2, symbol='ETH/USDT'),
+                        _trade(3, symbol='eth/usdt', exchange='Bybit')])
+
+    assert _ids(index.query('btc/usdt')) == ['t1', 't0']
+    assert _ids(index.query(exchange='BYBIT')) == ['t3', 't1']
+    assert _ids(index.query('ETH/USDT', 'bybit')) == ['t3']
+
+
+def test_cached_index_sees_new_trades(ledger, monkeypatch):
+    monkeypatch.setattr(trade_query, '_cache', trade_query._QueryCache())
+    trade_logger.log_fund_movement('DEPOSIT', 'USDT', Decimal('1000'), START, destination_name='binance')
+    assert trade_query.query_trades('BTC/USDT').total == 0
+
+    trade_logger.log_trade('BUY', 'binance', 'BTC/USDT', Decimal('1'), Decimal('100'), START)
+
+    assert trade_query.query_trades('BTC/USDT').total == 1
+    assert [p.exchange for p in trade_query.find_positions('BTC/USDT')] == ['binance']
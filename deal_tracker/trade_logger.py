@@ -3,32 +3,23 @@ import uuid
 from datetime import datetime
 import logging
 from decimal import Decimal
-from typing import List, Optional, Tuple, Dict, Any
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import sheets_service
 import config
-from models import TradeData, MovementData, PositionData, BalanceData
+import ledger_locks
+import sheets_service
+from dedupe_index import DedupeIndex, get_dedupe_index, INDEXED_SHEETS
+from ledger_state import LedgerState, LockedOperation, locked_operation
+from models import TradeData, MovementData, PositionData, IngestResult
 
 logger = logging.getLogger(__name__)
 
-# --- Вспомогательные функции, работающие с МОДЕЛЯМИ ---
-
-
-def _find_balance(account_name: str, asset: str, all_balances: List[BalanceData]) -> Optional[BalanceData]:
-    """Находит объект баланса в списке."""
-    account_name_lower = account_name.lower()
-    asset_upper = asset.upper()
-    for balance in all_balances:
-        if balance.account_name.lower() == account_name_lower and balance.asset.upper() == asset_upper:
-            return balance
-    return None
+# --- Вспомогательные функции, работающие с состоянием учета ---
 
 
-def _has_sufficient_balance(account_name: str, asset: str, required_amount: Decimal, all_balances: List[BalanceData]) -> bool:
-    """Проверяет достаточность баланса, работая со списком моделей."""
-    balance_obj = _find_balance(account_name, asset, all_balances)
-    current_balance = balance_obj.balance if balance_obj and balance_obj.balance is not None else Decimal(
-        '0')
+def _has_sufficient_balance(account_name: str, asset: str, required_amount: Decimal, state: LedgerState) -> bool:
+    """Проверяет достаточность баланса по in-memory состоянию."""
+    current_balance = state.get_balance(account_name, asset)
 
     is_sufficient = current_balance >= required_amount
     if not is_sufficient:
@@ -37,136 +28,263 @@ def _has_sufficient_balance(account_name: str, asset: str, required_amount: Deci
     return is_sufficient
 
 
-def _find_position(symbol: str, exchange: str, all_positions: List[PositionData]) -> Optional[PositionData]:
-    """Находит объект открытой позиции в списке."""
-    symbol_upper = symbol.upper()
-    exchange_lower = exchange.lower()
-    for pos in all_positions:
-        if pos.symbol.upper() == symbol_upper and pos.exchange.lower() == exchange_lower:
-            return pos
-    return None
+def _apply_balance_changes(changes: List[Dict[str, Any]], state: LedgerState) -> None:
+    for change in changes:
+        state.apply_balance_change(
+            change['account'], change['asset'], change['change'])
 
-# --- Основная логика ---
 
+JOURNAL_NOT_APPLIED_MESSAGE = "В журнале есть неприменённые записи, таблица недоступна. Повторите позже."
+WRITE_FAILED_MESSAGE = "Ошибка записи операции в таблицу."
+ATOMIC_ROLLBACK_MESSAGE = "Не записано: в пакете есть ошибочные операции, пакет отклонен целиком."
 
-def log_trade(
-    trade_type: str,
-    exchange: str,
-    symbol: str,
-    amount: Decimal,
-    price: Decimal,
-    timestamp: datetime,
-    **kwargs: Any
-) -> Tuple[bool, str]:
+
+def _flush_failure_result(operation_id: str, journaled: bool) -> Tuple[bool, str]:
     """
-    Логирует торговую операцию. Принимает чистые, типизированные данные.
-    Оркестрирует процесс: проверка балансов, запись сделки, обновление балансов и позиций.
+    Результат при неудачной записи пакета. Если пакет успел попасть в журнал,
+    операция считается принятой: он будет применен перед следующей операцией
+    или фоновым повтором (ledger_state.schedule_journal_replay).
     """
-    trade_id = str(uuid.uuid4())
-    log_context = f"TradeID: {trade_id}, {trade_type} {amount} {symbol} @ {price} on {exchange}"
-    logger.info(f"Начало логирования сделки. {log_context}")
+    if journaled:
+        logger.warning(
+            f"Операция {operation_id} сохранена в журнале и будет записана в таблицу повторно.")
+        return True, operation_id
+    return False, WRITE_FAILED_MESSAGE
+
+
+def _duplicate_message(item: Any) -> str:
+    if isinstance(item, TradeData):
+        return f"Дубликат: сделка с order_id {item.order_id} на {item.exchange} уже записана."
+    return f"Дубликат: движение с Tx ID {item.transaction_id_blockchain} уже записано."
+
+
+def _flush(operation: LockedOperation, index: DedupeIndex, description: str) -> bool:
+    """
+    Записывает изменения операции и сохраняет новые ключи индекса дубликатов.
+    Если пакет не попал даже в журнал, ключи этих записей недействительны.
+    """
+    if operation.flush(description=description):
+        index.save(operation.state.last_row_numbers(INDEXED_SHEETS))
+        return True
+    if not operation.state.last_flush_journaled():
+        index.invalidate()
+    return False
+
+
+def _operation_keys(items: List[Any]) -> List[ledger_locks.BalanceKey]:
+    """Ключи (счет, актив), балансы и позиции которых могут измениться при применении элементов."""
+    pairs = []
+    for item in items:
+        if isinstance(item, TradeData):
+            if item.symbol and item.symbol.count('/') == 1:
+                base_asset, quote_asset = item.symbol.split('/')
+                pairs += [(item.exchange, base_asset), (item.exchange, quote_asset),
+                          (item.exchange, item.commission_asset)]
+        else:
+            pairs += [(item.source_name, item.asset), (item.destination_name, item.asset)]
+    return ledger_locks.balance_keys_for(pairs)
+
+
+# Уровни сделки и столбцы Core_Trades, в которых они хранятся
+TRADE_LEVEL_FIELDS = ('sl', 'tp1', 'tp2', 'tp3', 'risk_usd')
+
+
+def _missing_level_columns(trade: TradeData) -> List[str]:
+    """Столбцы заданных у сделки уровней, которых нет на листе: такие значения не сохранились бы."""
+    return [sheets_service.FIELD_TO_SHEET_NAMES_MAP[name][0] for name in TRADE_LEVEL_FIELDS
+            if getattr(trade, name) is not None
+            and not sheets_service.has_field(config.CORE_TRADES_SHEET_NAME, name)]
+
 
-    base_asset, quote_asset = symbol.upper().split('/')
-    exchange_lower = exchange.lower()
+# --- Применение одной операции к состоянию учета ---
 
-    # --- НАЧАЛО ИСПРАВЛЕНИЯ ---
-    # Расчет PNL для продаж ДО создания объекта сделки
-    calculated_pnl = None
-    if trade_type.upper() == 'SELL':
-        all_positions = sheets_service.get_all_open_positions()
-        existing_pos = _find_position(symbol, exchange_lower, all_positions)
+
+def _apply_trade(trade: TradeData, state: LedgerState) -> Tuple[bool, str]:
+    """
+    Проверяет сделку по балансам состояния и, если все в порядке, применяет ее:
+    ставит строку в очередь, меняет балансы и позицию. При отказе состояние не меняется.
+    """
+    if not trade.symbol or trade.symbol.count('/') != 1:
+        return False, f"Некорректный символ '{trade.symbol}'. Ожидается формат BASE/QUOTE."
+    if trade.trade_type not in ('BUY', 'SELL'):
+        return False, f"Неизвестный тип сделки '{trade.trade_type}'."
+    if not trade.exchange or not trade.amount or trade.amount <= 0 or trade.price is None or trade.price < 0:
+        return False, "Некорректные данные сделки: биржа, количество или цена."
+    missing_columns = _missing_level_columns(trade)
+    if missing_columns:
+        return False, (f"На листе {config.CORE_TRADES_SHEET_NAME} нет столбцов {', '.join(missing_columns)}: "
+                       f"добавьте их или запишите сделку без этих уровней.")
+    base_asset, quote_asset = trade.symbol.split('/')
+    exchange_lower = trade.exchange
+
+    # Расчет PNL для продаж ДО записи сделки
+    if trade.trade_type == 'SELL' and trade.trade_pnl is None:
+        existing_pos = state.get_position(trade.symbol, exchange_lower)
         if existing_pos and existing_pos.avg_entry_price is not None:
-            calculated_pnl = (price - existing_pos.avg_entry_price) * amount
+            trade.trade_pnl = (
+                trade.price - existing_pos.avg_entry_price) * trade.amount
             logger.info(
-                f"Для продажи {symbol} рассчитан предварительный PNL: {calculated_pnl}")
-    # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
-
-    # 1. Создание объекта сделки с учетом рассчитанного PNL
-    trade = TradeData(
-        trade_id=trade_id,
-        timestamp=timestamp,
-        exchange=exchange_lower,
-        symbol=symbol.upper(),
-        trade_type=trade_type.upper(),
-        amount=amount,
-        price=price,
-        total_quote_amount=(amount * price),
-        trade_pnl=calculated_pnl,  # <--- PNL теперь добавляется сюда
-        notes=kwargs.get('notes'),
-        commission=kwargs.get('commission'),
-        commission_asset=kwargs.get('commission_asset'),
-        order_id=kwargs.get('order_id')
-    )
+                f"Для продажи {trade.symbol} рассчитан предварительный PNL: {trade.trade_pnl}")
 
-    # 2. Проверка балансов
-    all_balances = sheets_service.get_all_balances()
+    # Проверка балансов
     balance_changes: List[Dict[str, Any]] = []
 
     if trade.trade_type == 'BUY':
+        fee_asset = trade.commission_asset.upper() if trade.commission and trade.commission_asset else None
         required_quote = trade.total_quote_amount or Decimal(0)
-        if trade.commission and trade.commission_asset and trade.commission_asset.upper() == quote_asset:
+        if fee_asset == quote_asset:
             required_quote += trade.commission
-        if not _has_sufficient_balance(exchange_lower, quote_asset, required_quote, all_balances):
-            return False, f"Недостаточно {quote_asset} на счете {exchange}."
+        if not _has_sufficient_balance(exchange_lower, quote_asset, required_quote, state):
+            return False, f"Недостаточно {quote_asset} на счете {trade.exchange}."
         balance_changes.append(
             {'account': exchange_lower, 'asset': quote_asset, 'change': -required_quote})
-        balance_changes.append(
-            {'account': exchange_lower, 'asset': base_asset, 'change': trade.amount})
-        if trade.commission and trade.commission_asset and trade.commission_asset.upper() != quote_asset:
-            if not _has_sufficient_balance(exchange_lower, trade.commission_asset, trade.commission, all_balances):
+        if fee_asset == base_asset:
+            # Комиссия в покупаемом активе удерживается из полученного количества
+            if trade.commission > trade.amount:
+                return False, f"Комиссия {trade.commission} {base_asset} больше купленного количества."
+            balance_changes.append(
+                {'account': exchange_lower, 'asset': base_asset, 'change': trade.amount - trade.commission})
+        else:
+            balance_changes.append(
+                {'account': exchange_lower, 'asset': base_asset, 'change': trade.amount})
+        if fee_asset and fee_asset not in (quote_asset, base_asset):
+            if not _has_sufficient_balance(exchange_lower, trade.commission_asset, trade.commission, state):
                 return False, f"Недостаточно {trade.commission_asset} для комиссии."
             balance_changes.append(
                 {'account': exchange_lower, 'asset': trade.commission_asset, 'change': -trade.commission})
 
     elif trade.trade_type == 'SELL':
         # Проверяем баланс базового актива
-        if not _has_sufficient_balance(exchange_lower, base_asset, trade.amount, all_balances):
-            return False, f"Недостаточно {base_asset} на счете {exchange}."
+        if not _has_sufficient_balance(exchange_lower, base_asset, trade.amount, state):
+            return False, f"Недостаточно {base_asset} на счете {trade.exchange}."
         balance_changes.append(
             {'account': exchange_lower, 'asset': base_asset, 'change': -trade.amount})
         balance_changes.append({'account': exchange_lower, 'asset': quote_asset,
                                'change': trade.total_quote_amount or Decimal(0)})
         # Логика для комиссии при продаже, если она взимается отдельно, должна быть здесь
 
-    # 3. Запись основной транзакции
-    if not sheets_service.add_trade(trade):
-        return False, "Ошибка записи сделки в Core_Trades."
+    # Сделка, балансы и позиция применяются к состоянию; запись - одним пакетом при flush
+    state.add_record(config.CORE_TRADES_SHEET_NAME, trade)
+    _apply_balance_changes(balance_changes, state)
+    _sync_open_position(trade, state)
+    get_dedupe_index().add(trade)
+    return True, trade.trade_id
 
-    # 4. Обновление балансов
-    if not sheets_service.batch_update_balances(balance_changes):
-        logger.critical(
-            f"ТРЕБУЕТСЯ РУЧНОЕ ВМЕШАТЕЛЬСТВО! Сделка {trade_id} записана, но балансы НЕ обновлены!")
-        return False, "Критическая ошибка: балансы не обновлены после записи сделки."
 
-    # 5. Синхронизация открытых позиций
-    _sync_open_position(trade)
+def _apply_movement(movement: MovementData, state: LedgerState) -> Tuple[bool, str]:
+    """Проверяет и применяет движение средств к состоянию учета."""
+    if not movement.asset or not movement.amount or movement.amount <= 0:
+        return False, "Некорректные данные движения: актив или сумма."
+    if movement.movement_type in ['WITHDRAWAL', 'TRANSFER'] and movement.source_name:
+        if not _has_sufficient_balance(movement.source_name, movement.asset, movement.amount, state):
+            return False, f"Недостаточно {movement.asset} на счете {movement.source_name}."
+
+    balance_changes = []
+    if movement.source_name:
+        balance_changes.append({'account': movement.source_name,
+                               'asset': movement.asset, 'change': -movement.amount})
+    if movement.destination_name:
+        balance_changes.append({'account': movement.destination_name,
+                               'asset': movement.asset, 'change': movement.amount})
+
+    state.add_record(config.FUND_MOVEMENTS_SHEET_NAME, movement)
+    _apply_balance_changes(balance_changes, state)
+    get_dedupe_index().add(movement)
+    return True, movement.movement_id
+
+
+def _normalize_trade(trade: TradeData) -> TradeData:
+    """Приводит сделку к каноническому виду перед применением."""
+    trade.trade_id = trade.trade_id or str(uuid.uuid4())
+    trade.exchange = (trade.exchange or '').lower()
+    trade.symbol = (trade.symbol or '').upper()
+    trade.trade_type = (trade.trade_type or '').upper()
+    if trade.total_quote_amount is None and trade.amount is not None and trade.price is not None:
+        trade.total_quote_amount = trade.amount * trade.price
+    return trade
+
+
+def _normalize_movement(movement: MovementData) -> MovementData:
+    movement.movement_id = movement.movement_id or str(uuid.uuid4())
+    movement.movement_type = (movement.movement_type or '').upper()
+    movement.asset = (movement.asset or '').upper()
+    movement.source_name = movement.source_name.lower() if movement.source_name else None
+    movement.destination_name = movement.destination_name.lower(
+    ) if movement.destination_name else None
+    return movement
+
+
+# --- Основная логика ---
+
+
+def log_trade(
+    trade_type: str,
+    exchange: str,
+    symbol: str,
+    amount: Decimal,
+    price: Decimal,
+    timestamp: datetime,
+    **kwargs: Any
+) -> Tuple[bool, str]:
+    """
+    Логирует торговую операцию. Принимает чистые, типизированные данные.
+    Оркестрирует процесс: проверка балансов, запись сделки, обновление балансов и позиций.
+    """
+    trade = _normalize_trade(TradeData(
+        trade_id=str(uuid.uuid4()),
+        timestamp=timestamp,
+        exchange=exchange,
+        symbol=symbol,
+        trade_type=trade_type,
+        amount=amount,
+        price=price,
+        notes=kwargs.get('notes'),
+        commission=kwargs.get('commission'),
+        commission_asset=kwargs.get('commission_asset'),
+        order_id=kwargs.get('order_id'),
+        sl=kwargs.get('sl'), tp1=kwargs.get('tp1'), tp2=kwargs.get('tp2'), tp3=kwargs.get('tp3'),
+        risk_usd=kwargs.get('risk_usd')
+    ))
+    log_context = f"TradeID: {trade.trade_id}, {trade.trade_type} {amount} {trade.symbol} @ {price} on {exchange}"
+    logger.info(f"Начало логирования сделки. {log_context}")
+
+    with locked_operation(_operation_keys([trade])) as operation:
+        if not operation.journal_ok:
+            return False, JOURNAL_NOT_APPLIED_MESSAGE
+        index = get_dedupe_index()
+        index.sync()
+        if index.is_duplicate(trade):
+            logger.info(f"Сделка пропущена как дубликат. {log_context}")
+            return False, _duplicate_message(trade)
+        success, message = _apply_trade(trade, operation.state)
+        if not success:
+            return False, message
+        if not _flush(operation, index, f"trade {trade.trade_id}"):
+            return _flush_failure_result(trade.trade_id, operation.state.last_flush_journaled())
 
     logger.info(f"Сделка успешно залогирована. {log_context}")
-    return True, trade_id
+    return True, trade.trade_id
 
 
-def _sync_open_position(trade: TradeData):
-    """Обновляет, создает или удаляет запись в Open_Positions на основе сделки."""
-    all_positions = sheets_service.get_all_open_positions()
-    existing_pos = _find_position(trade.symbol, trade.exchange, all_positions)
+def _sync_open_position(trade: TradeData, state: LedgerState):
+    """Обновляет, создает или закрывает позицию в состоянии учета на основе сделки."""
+    existing_pos = state.get_position(trade.symbol, trade.exchange)
 
-    # Получаем финальный баланс базового актива после всех изменений
-    final_balances = sheets_service.get_all_balances()
-    final_base_asset_balance_obj = _find_balance(
-        trade.exchange, trade.symbol.split('/')[0], final_balances)
-    final_net_amount = final_base_asset_balance_obj.balance if final_base_asset_balance_obj else Decimal(
-        '0')
+    # Финальный баланс базового актива после всех изменений
+    final_net_amount = state.get_balance(
+        trade.exchange, trade.symbol.split('/')[0])
 
     # Порог для определения "нулевого" баланса
     zero_threshold = Decimal('1e-8')
 
     if final_net_amount <= zero_threshold:
         # Удаляем позицию, если она есть и баланс стал нулевым
-        if existing_pos and existing_pos.row_number:
+        if existing_pos:
             logger.info(
-                f"Закрытие позиции {trade.symbol} на {trade.exchange} (баланс {final_net_amount}). Удаление строки {existing_pos.row_number}.")
-            sheets_service.delete_row(
-                config.OPEN_POSITIONS_SHEET_NAME, existing_pos.row_number)
+                f"Закрытие позиции {trade.symbol} на {trade.exchange} (баланс {final_net_amount}). "
+                f"Строка {existing_pos.row_number} помечается закрытой.")
+            existing_pos.net_amount = final_net_amount
+            state.close_position(trade.symbol, trade.exchange)
         return
 
     # Если баланс не нулевой, обновляем или создаем позицию
@@ -189,10 +307,9 @@ def _sync_open_position(trade: TradeData):
         if existing_pos:
             logger.info(
                 f"Обновление позиции BUY для {trade.symbol}. Новая средняя: {new_avg_price}")
-            sheets_service.update_position(position_to_save)
         else:
             logger.info(f"Создание новой позиции BUY для {trade.symbol}.")
-            sheets_service.add_position(position_to_save)
+        state.upsert_position(position_to_save)
 
     elif trade.trade_type == 'SELL':
         if existing_pos:
@@ -201,7 +318,7 @@ def _sync_open_position(trade: TradeData):
             existing_pos.last_updated = datetime.now()
             logger.info(
                 f"Обновление позиции SELL для {trade.symbol}. Новый объем: {final_net_amount}")
-            sheets_service.update_position(existing_pos)
+            state.upsert_position(existing_pos)
         else:
             # Эта ситуация не должна возникать при корректной логике, но для надежности
             logger.error(
@@ -216,48 +333,145 @@ def log_fund_movement(
     **kwargs: Any
 ) -> Tuple[bool, str]:
     """Логирует движение средств (депозит, снятие, перевод)."""
-    movement_id = str(uuid.uuid4())
-    logger.info(
-        f"[LOGGER] Начало логирования движения средств. MoveID: {movement_id}")
-
-    source_name = kwargs.get('source_name')
-    destination_name = kwargs.get('destination_name')
-
-    movement = MovementData(
-        movement_id=movement_id, timestamp=timestamp, movement_type=movement_type.upper(),
-        asset=asset.upper(), amount=amount,
-        source_name=source_name.lower() if source_name else None,
-        destination_name=destination_name.lower() if destination_name else None,
+    movement = _normalize_movement(MovementData(
+        movement_id=str(uuid.uuid4()), timestamp=timestamp, movement_type=movement_type,
+        asset=asset, amount=amount,
+        source_name=kwargs.get('source_name'),
+        destination_name=kwargs.get('destination_name'),
         fee_amount=kwargs.get('fee_amount'), fee_asset=kwargs.get('fee_asset'),
         notes=kwargs.get('notes'), transaction_id_blockchain=kwargs.get('transaction_id_blockchain')
-    )
+    ))
+    logger.info(
+        f"[LOGGER] Начало логирования движения средств. MoveID: {movement.movement_id}")
+
+    with locked_operation(_operation_keys([movement])) as operation:
+        if not operation.journal_ok:
+            return False, JOURNAL_NOT_APPLIED_MESSAGE
+        index = get_dedupe_index()
+        index.sync()
+        if index.is_duplicate(movement):
+            logger.info(
+                f"[LOGGER] Движение {movement.transaction_id_blockchain} пропущено как дубликат.")
+            return False, _duplicate_message(movement)
+        success, message = _apply_movement(movement, operation.state)
+        if not success:
+            return False, message
 
-    if movement.movement_type in ['WITHDRAWAL', 'TRANSFER'] and movement.source_name:
-        all_balances = sheets_service.get_all_balances()
-        if not _has_sufficient_balance(movement.source_name, movement.asset, movement.amount, all_balances):
-            return False, f"Недостаточно {movement.asset} на счете {movement.source_name}."
+        logger.info(
+            f"[LOGGER] Запись движения и обновление балансов одним пакетом...")
+        if not _flush(operation, index, f"movement {movement.movement_id}"):
+            return _flush_failure_result(movement.movement_id, operation.state.last_flush_journaled())
 
     logger.info(
-        f"[LOGGER] Обращаюсь к sheets_service для добавления движения...")
-    if not sheets_service.add_movement(movement):
-        return False, "Ошибка записи движения средств."
+        f"[LOGGER] Движение средств {movement.movement_id} успешно залогировано.")
+    return True, movement.movement_id
 
-    balance_changes = []
-    if movement.source_name:
-        balance_changes.append({'account': movement.source_name,
-                               'asset': movement.asset, 'change': -movement.amount})
-    if movement.destination_name:
-        balance_changes.append({'account': movement.destination_name,
-                               'asset': movement.asset, 'change': movement.amount})
 
-    if balance_changes:
-        logger.info(
-            f"[LOGGER] Обращаюсь к sheets_service для обновления балансов...")
-        if not sheets_service.batch_update_balances(balance_changes):
-            logger.critical(
-                f"ТРЕБУЕТСЯ РУЧНОЕ ВМЕШАТЕЛЬСТВО! Движение {movement_id} записано, но балансы НЕ обновлены!")
-            return False, "Критическая ошибка: балансы не обновлены после записи движения."
+# --- Пакетное логирование ---
+
 
+def _ingest(items: List[Any], apply_func, kind: str, atomic: bool = False) -> List[IngestResult]:
+    """
+    Последовательно проверяет и применяет элементы к состоянию в памяти
+    (каждый следующий видит балансы после предыдущих), затем записывает
+    все принятые элементы одним пакетом. Блокируются все ключи пакета сразу.
+    При atomic=True пакет записывается только если приняты все элементы.
+    """
+    with locked_operation(_operation_keys(items)) as operation:
+        if not operation.journal_ok:
+            return [IngestResult(index=i, success=False, message=JOURNAL_NOT_APPLIED_MESSAGE)
+                    for i in range(len(items))]
+        state = operation.state
+        index = get_dedupe_index()
+        index.sync()
+        results = []
+        duplicates = 0
+        for i, item in enumerate(items):
+            # Дубликаты (в т.ч. внутри самого пакета) отсекаются проверкой по множеству
+            if index.is_duplicate(item):
+                duplicates += 1
+                results.append(IngestResult(index=i, success=False,
+                                            message=_duplicate_message(item), duplicate=True))
+                continue
+            try:
+                success, message = apply_func(item, state)
+            except Exception as e:
+                logger.error(
+                    f"Ошибка обработки элемента #{i} пакета ({kind}): {e}", exc_info=True)
+                success, message = False, f"Ошибка обработки: {e}"
+            results.append(IngestResult(index=i, success=success, message=message,
+                                        record_id=message if success else None))
+
+        accepted = sum(1 for r in results if r.success)
+        if atomic and accepted < len(items):
+            state.discard_pending()
+            index.invalidate()
+            for r in results:
+                if r.success:
+                    r.success, r.message, r.record_id = False, ATOMIC_ROLLBACK_MESSAGE, None
+            accepted = 0
+        if accepted and not _flush(operation, index, f"bulk {kind} x{accepted}"):
+            flushed, message = _flush_failure_result(
+                f"bulk {kind} x{accepted}", state.last_flush_journaled())
+            if not flushed:
+                for r in results:
+                    if r.success:
+                        r.success, r.message, r.record_id = False, message, None
     logger.info(
-        f"[LOGGER] Движение средств {movement_id} успешно залогировано.")
-    return True, movement_id
+        f"Пакетное логирование ({kind}): принято {accepted} из {len(items)}, дубликатов {duplicates}.")
+    return results
+
+
+def log_trades(trades: List[TradeData]) -> List[IngestResult]:
+    """Пакетно логирует сделки. Возвращает результат по каждой сделке в исходном порядке."""
+    return _ingest([_normalize_trade(t) for t in trades], _apply_trade, 'trades')
+
+
+def log_fund_movements(movements: List[MovementData]) -> List[IngestResult]:
+    """Пакетно логирует движения средств. Возвращает результат по каждому элементу."""
+    return _ingest([_normalize_movement(m) for m in movements], _apply_movement, 'movements')
+
+
+def log_balance_adjustments(
+    movements: List[MovementData],
+    targets: List[Decimal],
+    is_needed: Optional[Callable[[Decimal, Decimal], bool]] = None,
+) -> List[IngestResult]:
+    """
+    Корректирующие движения, доводящие баланс счета движения до targets[i].
+    Направление и сумма каждого движения пересчитываются под блокировкой ключа
+    по текущему балансу: операции, записанные после снимка, на котором считалась
+    разница, не искажают корректировку. is_needed(текущий, целевой) позволяет
+    пропустить корректировку, ставшую незначимой.
+    """
+    targets_by_item = {id(m): target for m, target in zip(movements, targets)}
+
+    def apply(movement: MovementData, state: LedgerState) -> Tuple[bool, str]:
+        account = movement.destination_name or movement.source_name
+        current = state.get_balance(account, movement.asset)
+        target = targets_by_item[id(movement)]
+        difference = target - current
+        if not difference or (is_needed and not is_needed(current, target)):
+            return False, f"Баланс {account}/{movement.asset} уже {current}, корректировка не нужна."
+        movement.movement_type = 'DEPOSIT' if difference > 0 else 'WITHDRAWAL'
+        movement.amount = abs(difference)
+        movement.source_name = None if difference > 0 else account
+        movement.destination_name = account if difference > 0 else None
+        return _apply_movement(movement, state)
+
+    return _ingest([_normalize_movement(m) for m in movements], apply, 'adjustments')
+
+
+def _apply_operation(item: Any, state: LedgerState) -> Tuple[bool, str]:
+    if isinstance(item, TradeData):
+        return _apply_trade(item, state)
+    return _apply_movement(item, state)
+
+
+def log_operations(items: List[Any], atomic: bool = True) -> List[IngestResult]:
+    """
+    Пакетно логирует сделки и движения вперемешку, в исходном порядке, одной
+    записью в таблицу. При atomic=True ошибка любого элемента отклоняет весь пакет.
+    """
+    normalized = [_normalize_trade(i) if isinstance(i, TradeData) else _normalize_movement(i) for i in items]
+    return _ingest(normalized, _apply_operation, 'operations', atomic)
@@ -0,0 +1,166 @@
+# deal_tracker/trade_query.py
+"""
+Запросы к сделкам и открытым позициям для /history и /average.
+
+Core_Trades читается целиком один раз и кэшируется вместе со вторичными
+индексами: по символу, по бирже и по паре (символ, биржа). Каждый индекс -
+список сделок, отсортированный по времени, с параллельным списком ключей,
+поэтому "последние N сделок символа за период" - это бинарный поиск границ
+и срез: O(log n + N).
+
+Кэш сбрасывается, когда меняется номер последней строки Core_Trades (одно
+чтение столбца вместо всего листа) или по истечении TRADE_QUERY_CACHE_TTL_SECONDS
+(на случай правок существующих строк). Позиции меняют количество и цену входа
+только вместе со сделками, поэтому их индекс живет вместе с индексом сделок.
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import config
+import sheets_service
+from models import PositionData, TradeData
+
+logger = logging.getLogger(__name__)
+
+
+def _ts_key(value: datetime) -> float:
+    """Ключ сортировки; время без зоны считается временем TZ_OFFSET_HOURS."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone(timedelta(hours=config.TZ_OFFSET_HOURS)))
+    return value.timestamp()
+
+
+class _TimeSeries:
+    """Сделки одного ключа индекса, отсортированные по времени."""
+
+    def __init__(self):
+        self.keys: List[float] = []
+        self.trades: List[TradeData] = []
+
+    def add(self, key: float, trade: TradeData) -> None:
+        self.keys.append(key)
+        self.trades.append(trade)
+
+    def bounds(self, since: Optional[datetime], until: Optional[datetime]) -> Tuple[int, int]:
+        lo = bisect.bisect_left(self.keys, _ts_key(since)) if since else 0
+        hi = bisect.bisect_left(self.keys, _ts_key(until)) if until else len(self.keys)
+        return lo, max(lo, hi)
+
+
+@dataclass
+class TradePage:
+    trades: List[TradeData]
+    page: int
+    pages: int
+    total: int
+
+
+class TradeIndex:
+    """Индексы сделок по символу, бирже и их паре."""
+
+    def __init__(self, trades: List[TradeData]):
+        self._all = _TimeSeries()
+        self._by_symbol: Dict[str, _TimeSeries] = {}
+        self._by_exchange: Dict[str, _TimeSeries] = {}
+        self._by_pair: Dict[Tuple[str, str], _TimeSeries] = {}
+        dated = sorted(((_ts_key(t.timestamp), t) for t in trades if t.timestamp and t.symbol),
+                       key=lambda item: item[0])
+        for key, trade in dated:
+            symbol = trade.symbol.upper()
+            exchange = (trade.exchange or '').lower()
+            self._all.add(key, trade)
+            self._by_symbol.setdefault(symbol, _TimeSeries()).add(key, trade)
+            self._by_exchange.setdefault(exchange, _TimeSeries()).add(key, trade)
+            self._by_pair.setdefault((symbol, exchange), _TimeSeries()).add(key, trade)
+
+    def __len__(self) -> int:
+        return len(self._all.keys)
+
+    def _series(self, symbol: Optional[str], exchange: Optional[str]) -> Optional[_TimeSeries]:
+        if symbol and exchange:
+            return self._by_pair.get((symbol.upper(), exchange.lower()))
+        if symbol:
+            return self._by_symbol.get(symbol.upper())
+        if exchange:
+            return self._by_exchange.get(exchange.lower())
+        return self._all
+
+    def query(self, symbol: Optional[str] = None, exchange: Optional[str] = None,
+              since: Optional[datetime] = None, until: Optional[datetime] = None,
+              page: int = 1, page_size: int = 10) -> TradePage:
+        """Сделки за [since, until), новые первыми, страница page (с 1)."""
+        series = self._series(symbol, exchange)
+        if series is None:
+            return TradePage([], 1, 0, 0)
+        lo, hi = series.bounds(since, until)
+        total = hi - lo
+        pages = math.ceil(total / page_size) if total else 0
+        page = max(1, page)
+        end = hi - (page - 1) * page_size
+        start = max(lo, end - page_size)
+        trades = series.trades[start:end][::-1] if end > lo else []
+        return TradePage(trades, page, pages, total)
+
+
+class PositionIndex:
+    """Открытые позиции по символу (одна позиция на каждую биржу)."""
+
+    def __init__(self, positions: List[PositionData]):
+        self._by_symbol: Dict[str, List[PositionData]] = {}
+        for position in positions:
+            if position.symbol:
+                self._by_symbol.setdefault(position.symbol.upper(), []).append(position)
+
+    def find(self, symbol: str) -> List[PositionData]:
+        return self._by_symbol.get(symbol.upper(), [])
+
+
+class _QueryCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trades: Optional[TradeIndex] = None
+        self._positions: Optional[PositionIndex] = None
+        self._last_row: Optional[int] = None
+        self._loaded_at = 0.0
+
+    def _refresh(self) -> None:
+        # Вызывается под self._lock
+        last_row = sheets_service.get_last_row_number(config.CORE_TRADES_SHEET_NAME)
+        expired = time.monotonic() - self._loaded_at > config.TRADE_QUERY_CACHE_TTL_SECONDS
+        if self._trades is not None and not expired and last_row is not None and last_row == self._last_row:
+            return
+        started = time.monotonic()
+        self._trades = TradeIndex(sheets_service.get_all_core_trades())
+        self._positions = PositionIndex(sheets_service.get_all_open_positions())
+        self._last_row = last_row
+        self._loaded_at = time.monotonic()
+        logger.info(f"Индекс сделок перестроен: {len(self._trades)} сделок за {self._loaded_at - started:.2f} с.")
+
+    def trades(self) -> TradeIndex:
+        with self._lock:
+            self._refresh()
+            return self._trades
+
+    def positions(self) -> PositionIndex:
+        with self._lock:
+            self._refresh()
+            return self._positions
+
+
+_cache = _QueryCache()
+
+
+def query_trades(symbol: Optional[str] = None, exchange: Optional[str] = None,
+                 since: Optional[datetime] = None, until: Optional[datetime] = None,
+                 page: int = 1, page_size: int = 10) -> TradePage:
+    return _cache.trades().query(symbol, exchange, since, until, page, page_size)
+
+
+def find_positions(symbol: str) -> List[PositionData]:
+    return _cache.positions().find(symbol)
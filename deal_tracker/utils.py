@@ -6,7 +6,7 @@
 import logging
 from datetime import datetime, timezone, timedelta
 from decimal import Decimal, InvalidOperation
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 
 from dateutil.parser import parse as parse_datetime_flexible
 import config
@@ -48,6 +48,26 @@ def parse_datetime_from_args(named_args: Dict[str, str]) -> datetime:
     return datetime.now(timezone.utc).astimezone(target_timezone)
 
 
+def parse_date_range_from_args(named_args: Dict[str, str]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """
+    Период из ключей from: и to: как [начало, конец). Дата без времени в to:
+    включает весь день. Некорректная дата - ValueError.
+    """
+    target_timezone = timezone(timedelta(hours=config.TZ_OFFSET_HOURS))
+    bounds = []
+    for key in ('from', 'to'):
+        value = named_args.get(key)
+        if not value:
+            bounds.append(None)
+            continue
+        dt_obj = parse_datetime_flexible(value)
+        dt_obj = dt_obj.astimezone(target_timezone) if dt_obj.tzinfo else dt_obj.replace(tzinfo=target_timezone)
+        if key == 'to' and ':' not in value:
+            dt_obj += timedelta(days=1)
+        bounds.append(dt_obj)
+    return bounds[0], bounds[1]
+
+
 def determine_entity_type(name: str) -> str:
     """Определяет тип сущности (биржа, кошелек) по имени."""
     if not name:
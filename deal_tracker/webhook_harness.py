@@ -0,0 +1,268 @@
+# deal_tracker/webhook_harness.py
+"""
+Нагрузочный стенд webhook-режима бота. Запускает bot_runner в режиме webhook
+против локальной таблицы (local_sheets) и поддельного Bot API, отправляет на
+webhook синтетические Update JSON и измеряет:
+- задержку команды: от отправки Update до вызова sendMessage ботом;
+- задержку подтверждения: сколько webhook держит HTTP-запрос (растет, когда
+  очередь обновлений BOT_UPDATE_QUEUE_SIZE заполнена);
+- пропускную способность: ответов в секунду.
+
+Поддельный Bot API отвечает на getMe, setWebhook, sendMessage и прочие методы,
+так что бот не обращается к api.telegram.org.
+
+Запуск:
+    python webhook_harness.py --updates 200 --concurrency 20 --command /portfolio
+"""
+import argparse
+import json
+import os
+import secrets
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import stress_ledger
+
+BOT_TOKEN = '123456:HARNESS'
+FIRST_USER_ID = 5000
+FIRST_CHAT_ID = 100000
+BUSY_PREFIX = '⏳'
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """Bot API, запоминающий время первого ответа бота в каждый чат."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _FakeBotApiHandler)
+        self.replies: Dict[int, float] = {}
+        self.reply_texts: Dict[int, str] = {}
+        self.calls: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self._message_ids = iter(range(1, 10 ** 9))
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def handle_method(self, method: str, params: Dict[str, str]):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method == 'getMe':
+                return {'id': 1, 'is_bot': True, 'first_name': 'Harness', 'username': 'harness_bot'}
+            if method in ('sendMessage', 'editMessageText'):
+                chat_id = int(params.get('chat_id', 0))
+                if method == 'sendMessage' and chat_id not in self.replies:
+                    self.replies[chat_id] = time.monotonic()
+                    self.reply_texts[chat_id] = str(params.get('text', ''))
+                return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private'}, 'text': str(params.get('text', ''))}
+            return True
+
+
+class _FakeBotApiHandler(BaseHTTPRequestHandler):
+    server: FakeBotApi
+
+    def do_POST(self):
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if 'json' in (self.headers.get('Content-Type') or ''):
+            params = json.loads(body or b'{}')
+        else:
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+        payload = json.dumps({'ok': True, 'result': self.server.handle_method(method, params)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def _seed_ledger() -> None:
+    """Несколько позиций, чтобы /portfolio, /history и /average возвращали данные."""
+    import trade_logger
+    started = datetime.now() - timedelta(days=1)
+    trade_logger.log_fund_movement('DEPOSIT', 'USDT', Decimal('100000'), started, destination_name='harness')
+    for i, symbol in enumerate(['BTC/USDT', 'ETH/USDT', 'SOL/USDT']):
+        for j in range(3):
+            trade_logger.log_trade('BUY', 'harness', symbol, Decimal('1'), Decimal(100 + 10 * j),
+                                   started + timedelta(minutes=10 * i + j))
+
+
+def _make_update(update_id: int, user_id: int, chat_id: int, text: str) -> bytes:
+    command_length = len(text.split()[0])
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Harness'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}],
+        },
+    }).encode('utf-8')
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _start_bot(work_dir: str, api: FakeBotApi, port: int, secret: str, users: int,
+               queue_size: Optional[int]) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_TOKEN': BOT_TOKEN,
+        'TELEGRAM_API_BASE_URL': api.base_url,
+        'TELEGRAM_ADMIN_IDS_STR': ','.join(str(FIRST_USER_ID + u) for u in range(users)),
+        'BOT_MODE': 'webhook',
+        'WEBHOOK_LISTEN': '127.0.0.1',
+        'WEBHOOK_PORT': str(port),
+        'WEBHOOK_URL': f"http://127.0.0.1:{port}",
+        'WEBHOOK_SECRET_TOKEN': secret,
+        'LOGS_DIR': os.path.join(work_dir, 'logs'),
+        # Регулярные задачи не должны мешать замеру
+        'ANALYTICS_REFRESH_INTERVAL_SECONDS': '0',
+        'DAILY_DIGEST_TIME': '',
+    })
+    if queue_size is not None:
+        env['BOT_UPDATE_QUEUE_SIZE'] = str(queue_size)
+    output = open(os.path.join(work_dir, 'bot_output.log'), 'w', encoding='utf-8')
+    return subprocess.Popen([sys.executable, 'bot_runner.py'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, stdout=output, stderr=subprocess.STDOUT)
+
+
+def _stop_bot(proc: subprocess.Popen) -> None:
+    if proc.poll() is not None:
+        return
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд webhook-режима бота.")
+    parser.add_argument('--updates', type=int, default=200, help="Сколько Update отправить")
+    parser.add_argument('--concurrency', type=int, default=20, help="Одновременных HTTP-запросов к webhook")
+    parser.add_argument('--users', type=int, default=10, help="Разных администраторов (лимит на пользователя)")
+    parser.add_argument('--command', default='/portfolio', help="Текст команды в каждом Update")
+    parser.add_argument('--queue-size', type=int, help="BOT_UPDATE_QUEUE_SIZE для бота")
+    parser.add_argument('--latency-ms', type=int, default=0, help="Задержка вызова локальной таблицы")
+    parser.add_argument('--timeout', type=float, default=120, help="Сколько ждать ответов, с")
+    parser.add_argument('--keep', action='store_true', help="Не удалять рабочий каталог")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='deal_tracker_webhook_')
+    stress_ledger._configure_env(work_dir, args.latency_ms)
+    import sheets_service
+    sheets_service._get_spreadsheet().seed(stress_ledger.SHEET_HEADERS)
+    _seed_ledger()
+
+    api = FakeBotApi()
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    port, secret = _free_port(), secrets.token_urlsafe(24)
+    proc = _start_bot(work_dir, api, port, secret, args.users, args.queue_size)
+    ok = False
+    try:
+        if not _wait_for_port(port, 30) or proc.poll() is not None:
+            print(f"Бот не запустился, см. {os.path.join(work_dir, 'bot_output.log')}")
+            args.keep = True
+            return 1
+
+        url = f"http://127.0.0.1:{port}/telegram"
+        sent: Dict[int, float] = {}
+        acks: List[float] = []
+        http_errors: List[str] = []
+
+        def post(i: int) -> None:
+            chat_id = FIRST_CHAT_ID + i
+            request = urllib.request.Request(
+                url, data=_make_update(i + 1, FIRST_USER_ID + i % args.users, chat_id, args.command),
+                headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret})
+            started = time.monotonic()
+            sent[chat_id] = started
+            try:
+                with urllib.request.urlopen(request, timeout=args.timeout) as response:
+                    response.read()
+                acks.append(time.monotonic() - started)
+            except Exception as e:
+                http_errors.append(str(e))
+
+        load_started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(post, range(args.updates)))
+
+        deadline = time.monotonic() + args.timeout
+        while len(api.replies) < len(sent) - len(http_errors) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        with api.lock:
+            replies = dict(api.replies)
+            texts = dict(api.reply_texts)
+        latencies = [replies[c] - sent[c] for c in replies if c in sent]
+        busy = sum(1 for c in replies if texts.get(c, '').startswith(BUSY_PREFIX))
+        elapsed = (max(replies.values()) if replies else time.monotonic()) - load_started
+
+        print(f"Команда {args.command}: отправлено {len(sent)}, ответов {len(replies)} "
+              f"(из них отклонено лимитом {busy}), ошибок HTTP {len(http_errors)}")
+        print(f"Задержка команды, мс: p50 {_percentile(latencies, 50) * 1000:.0f}, "
+              f"p95 {_percentile(latencies, 95) * 1000:.0f}, p99 {_percentile(latencies, 99) * 1000:.0f}, "
+              f"max {max(latencies, default=0) * 1000:.0f}")
+        print(f"Подтверждение webhook, мс: p50 {_percentile(acks, 50) * 1000:.0f}, "
+              f"p95 {_percentile(acks, 95) * 1000:.0f}, max {max(acks, default=0) * 1000:.0f}")
+        print(f"Пропускная способность: {len(replies) / elapsed:.1f} ответов/с за {elapsed:.1f} с")
+        for error in http_errors[:5]:
+            print(f"  ✗ {error}")
+        ok = len(replies) == len(sent) and not http_errors
+        print("Результат: OK" if ok else "Результат: ЕСТЬ ПОТЕРИ")
+    finally:
+        _stop_bot(proc)
+        api.shutdown()
+        if args.keep:
+            print(f"Рабочий каталог: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# deal_tracker/write_journal.py
+"""
+Журнал упреждающей записи (write-ahead journal) для пакетов изменений учета.
+Перед отправкой в Google Sheets пакет сохраняется на диск как "pending";
+после успешной записи помечается "committed". Пакеты содержат абсолютные
+значения строк, поэтому повторное применение (replay) безопасно.
+
+Журнал общий для всех процессов: каждая запись хранит pid владельца и ключи
+(счет, актив), а доступ к файлу идет под блокировкой 'journal'. Повторно
+применяются только пакеты, запись которых не идет прямо сейчас: отпущенные
+владельцем после ошибки ("released") или оставшиеся от завершившегося процесса.
+"""
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import config
+import ledger_locks
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_COMMITTED = 'committed'
+STATUS_RELEASED = 'released'
+
+
+def _journal_path() -> str:
+    return os.path.join(config.STATE_DIR, 'ledger_journal.jsonl')
+
+
+def _append_line(entry: Dict[str, Any]) -> None:
+    path = _journal_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_entries() -> List[Dict[str, Any]]:
+    try:
+        with open(_journal_path(), 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            # Оборванная последняя строка (сбой во время записи) - пакет не был отправлен
+            logger.warning("Пропущена поврежденная строка журнала записи.")
+    return entries
+
+
+def _pending_entries() -> List[Dict[str, Any]]:
+    entries = _read_entries()
+    committed = {e['id'] for e in entries if e.get('status') == STATUS_COMMITTED}
+    released = {e['id'] for e in entries if e.get('status') == STATUS_RELEASED}
+    pending = []
+    for e in entries:
+        if e.get('status') == STATUS_PENDING and e['id'] not in committed:
+            e['released'] = e['id'] in released
+            pending.append(e)
+    return pending
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _is_replayable(entry: Dict[str, Any]) -> bool:
+    pid = entry.get('pid')
+    if entry['released'] or pid is None:
+        return True
+    return pid != os.getpid() and not _is_process_alive(pid)
+
+
+def _mark_committed_unlocked(batch_id: str) -> None:
+    _append_line({'id': batch_id, 'status': STATUS_COMMITTED})
+    if not _pending_entries():
+        open(_journal_path(), 'w').close()
+
+
+def record_pending(data: List[Dict[str, Any]], capacity: Dict[str, int], description: str = "",
+                   keys: Iterable[Tuple[str, str]] = ()) -> Optional[str]:
+    """Сохраняет пакет перед отправкой. Возвращает id пакета или None, если журнал недоступен."""
+    batch_id = str(uuid.uuid4())
+    try:
+        with ledger_locks.file_lock('journal'):
+            _append_line({'id': batch_id, 'status': STATUS_PENDING, 'created_at': datetime.now().isoformat(),
+                          'pid': os.getpid(), 'description': description, 'keys': [list(k) for k in keys],
+                          'capacity': capacity, 'data': data})
+        return batch_id
+    except OSError as e:
+        logger.error(f"Не удалось записать пакет в журнал: {e}")
+        return None
+
+
+def release(batch_id: str) -> None:
+    """Отмечает, что владелец больше не пишет пакет: теперь его может применить любой процесс."""
+    try:
+        with ledger_locks.file_lock('journal'):
+            _append_line({'id': batch_id, 'status': STATUS_RELEASED})
+    except OSError as e:
+        logger.error(f"Не удалось отпустить пакет {batch_id} в журнале: {e}")
+
+
+def mark_committed(batch_id: str) -> None:
+    """Помечает пакет примененным. Когда незавершенных пакетов не остается, журнал очищается."""
+    try:
+        with ledger_locks.file_lock('journal'):
+            _mark_committed_unlocked(batch_id)
+    except OSError as e:
+        logger.error(f"Не удалось отметить пакет {batch_id} в журнале: {e}")
+
+
+def get_pending() -> List[Dict[str, Any]]:
+    """Пакеты, записанные в журнал, но не подтвержденные, в порядке записи."""
+    return _pending_entries()
+
+
+def has_pending() -> bool:
+    return bool(get_pending())
+
+
+def is_pending(batch_id: str) -> bool:
+    return any(e['id'] == batch_id for e in get_pending())
+
+
+def replay_pending(apply_batch: Callable[[List[Dict[str, Any]], Dict[str, int]], bool]) -> Optional[int]:
+    """
+    Под блокировкой журнала применяет пакеты, подлежащие повторной записи, в исходном порядке.
+    Версии ключей примененных пакетов меняются, чтобы другие процессы перечитали балансы.
+    Возвращает число примененных пакетов или None, если какой-то пакет применить не удалось.
+    """
+    with ledger_locks.file_lock('journal'):
+        replayed = 0
+        for entry in _pending_entries():
+            if not _is_replayable(entry):
+                continue
+            logger.warning(
+                f"Повторное применение пакета {entry['id']} из журнала ({entry.get('description', '')}).")
+            if not apply_batch(entry['data'], entry.get('capacity', {})):
+                return None
+            try:
+                _mark_committed_unlocked(entry['id'])
+            except OSError as e:
+                logger.error(f"Не удалось отметить пакет {entry['id']} в журнале: {e}")
+                return None
+            ledger_locks.touch_keys(tuple(k) for k in entry.get('keys', []))
+            replayed += 1
+        return replayed